@@ -1,43 +1,197 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, yaml, glob
-import subprocess
-import pandas as pd
 import gzip
 import re
 import string
 import shutil
-import numpy as np
-from matplotlib import pyplot as plt
-from nougat import common, align
-from nougat.pdf.peakdetect import peakdet 
-
-def run(global_config, sample_config):
-    sorted_libraries_by_insert = common._sort_libraries_by_insert(
-            sample_config)
+from nougat import common, align, scheduler, cache, resources, plan
+
+# what each step reads and writes, used to run independent steps together
+STEPS = dict((step.name, step) for step in [
+    scheduler.Step("trimmomatic", needs=["reads"], provides=["reads"],
+        state=["libraries"], threads=None),
+    scheduler.Step("fastqc", needs=["reads"], provides=[], state=["fastqc"],
+        threads=None),
+    scheduler.Step("abyss", needs=["reads"], provides=[], state=["abyss"],
+        threads=None),
+    scheduler.Step("kmergenie", needs=["reads"], provides=[],
+        state=["kmergenie"], threads=None),
+    scheduler.Step("align", needs=["reads", "reference"], provides=[],
+        state=["alignments"], threads=None),
+    ])
+
+# zoomed k-mer coverage plots: first and last coverage shown, file name
+KMER_PLOTS = [(1, 200, "kmer_coverage_1_200.png"),
+        (1, 500, "kmer_coverage_1_500.png"),
+        (15, 200, "kmer_coverage_15_200.png"),
+        (15, 500, "kmer_coverage_15_500.png")]
+
+
+def run(global_config, sample_config, journal=None):
     sample_config["commands"] = ""
+    if journal is not None:
+        sample_config = journal.replay(sample_config)
+    tools = _tools(sample_config)
+    sample_config = scheduler.run_steps([STEPS[tool] for tool in tools],
+            _run_step, global_config, sample_config,
+            resources.threads(sample_config), journal)
+    with open(common.run_dir(sample_config).join("{}.nougat".format(
+        sample_config.get("output", "sample"))), "w") as f:
+        yaml.dump(sample_config, f)
+
+
+def _tools(sample_config):
     if "tools" in sample_config:
-        """If so, execute them one after the other in the specified order
-        (might not work)"""
-        for command in sample_config["tools"]:
-            """with this I pick up at run time the correct function in the
-            current module"""
-            command_fn = getattr(sys.modules[__name__],
-                    "_run_{}".format(command))
-            """Update sample config, each command return sample_config and if
-            necessary it modifies it"""
-            sample_config = command_fn(global_config, sample_config,
-                    sorted_libraries_by_insert)
+        """If so, execute them in the specified order, steps that do not
+        depend on each other are run at the same time"""
+        tools = sample_config["tools"]
     else:
         #run default pipeline for QC
-        sample_config = _run_trimmomatic(global_config, sample_config,
-                sorted_libraries_by_insert)
-        sample_config = _run_fastqc(global_config, sample_config,
-                sorted_libraries_by_insert)
-        sample_config = _run_abyss(global_config, sample_config,
-                sorted_libraries_by_insert)
-    with open("{}.nougat".format(sample_config.get("output", "sample")), "w") as f:
-        yaml.dump(sample_config, f)
+        tools = ["trimmomatic", "fastqc", "abyss"]
+    for tool in tools:
+        if tool not in STEPS:
+            sys.exit("tool {} not available in QCcontrol, available tools "
+                    "are {}".format(tool, sorted(STEPS.keys())))
+    return tools
+
+
+def plan_steps(global_config, sample_config, run_plan):
+    """ adds to run_plan the tasks run() would execute, without touching
+    the filesystem"""
+    for tool in _tools(sample_config):
+        sorted_libraries_by_insert = common._sort_libraries_by_insert(
+                sample_config)
+        plan_fn = getattr(sys.modules[__name__], "_plan_{}".format(tool))
+        sample_config = plan_fn(global_config, sample_config,
+                sorted_libraries_by_insert, run_plan)
+    return run_plan
+
+
+def _plan_trimmomatic(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    program = global_config["Tools"]["trimmomatic"]["bin"]
+    if "adapters" not in sample_config:
+        sys.exit("running MP pipeline, adapters file to be used in trimming"
+                "are needed for Trimmomatic. Please specify them"
+                "in the sample configuration file and rerun")
+    adapterFile = sample_config["adapters"]
+    trimmomaticDir = os.path.join(run_plan.workdir, "Trimmomatic")
+    workers, library_threads, library_memory = _trimmomatic_workers(
+            sample_config, sorted_libraries_by_insert)
+    for library, libraryInfo in sorted_libraries_by_insert:
+        read1=libraryInfo["pair1"]
+        read2=libraryInfo["pair2"]
+        if read2 is None:
+            continue
+        read1_baseName = os.path.split(read1)[1].split(".")[0]
+        outputs = _trimmomatic_outputs(trimmomaticDir, read1, read2)
+        command, trimming = _trimmomatic_command(program, adapterFile, read1,
+                read2, library_threads, library_memory)
+        run_plan.add("trimmomatic.{}".format(library), "trimmomatic",
+                trimmomaticDir, [plan.shell(command + outputs + trimming,
+                "{}_trimmomatic.stdOut".format(read1_baseName),
+                "{}_trimmomatic.stdErr".format(read1_baseName))],
+                inputs=[read1, read2, adapterFile], outputs=outputs,
+                threads=library_threads, memory=library_memory)
+        libraryInfo["pair1"] = outputs[0]
+        libraryInfo["pair2"] = outputs[2]
+        libraryInfo["trimmomatic"] = os.path.join(trimmomaticDir,
+                "{}_trimmomatic.stdErr".format(read1_baseName))
+    return sample_config
+
+
+def _plan_fastqc(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    FastqcFolder = os.path.join(run_plan.workdir, "fastqc")
+    program=global_config["Tools"]["fastqc"]["bin"]
+    program_options=global_config["Tools"]["fastqc"]["options"]
+    memory = resources.split(resources.memory(sample_config), min(
+        resources.threads(sample_config), len(sorted_libraries_by_insert)))
+    for library, libraryInfo in sorted_libraries_by_insert:
+        read1=libraryInfo["pair1"]
+        read2=libraryInfo["pair2"]
+        command = _fastqc_command(program, program_options, read1, read2)
+        run_plan.add("fastqc.{}".format(library), "fastqc", FastqcFolder,
+                [plan.shell(command, "{}_fastqc.stdout".format(library),
+                "{}_fastqc.stderr".format(library), "a")],
+                inputs=[read1, read2],
+                outputs=[_fastqc_output(FastqcFolder, read1)], memory=memory)
+    sample_config["fastqc"] = FastqcFolder
+    return sample_config
+
+
+def _plan_abyss(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    ABySS_Kmer_Folder = os.path.join(run_plan.workdir, "abyss_kmer")
+    if "kmer" not in sample_config:
+        sys.exit("error in _run_abyss QCcontrol: kmer must be present in \
+                sample_config.yaml")
+    kmer = sample_config["kmer"]
+    program = global_config["Tools"]["abyss"]["bin"]
+    program = os.path.join(os.path.dirname(program), "ABYSS-P")
+    threads = resources.threads(sample_config)
+    command, reads = _abyss_kmer_command(program, threads, kmer,
+            sorted_libraries_by_insert)
+    commands = [plan.shell(command.format("histogram.hist"),
+        "ABySS_Kmer_Folder.stdOut", "ABySS_Kmer_Folder.stdErr", "a"),
+        ["rm", "preUnitgs.fa"]]
+    commands.extend(plan.python_call("QCcontrol", "_plotKmerFixed",
+        min_limit, max_limit, kmer, output_name) for min_limit, max_limit,
+        output_name in KMER_PLOTS)
+    commands.append(plan.python_call("QCcontrol", "_plotKmer", kmer,
+        "kmer_coverage.png"))
+    run_plan.add("abyss", "abyss", ABySS_Kmer_Folder, commands,
+            inputs=reads, outputs=["histogram.hist", "kmer_coverage.png"] +
+            [output_name for min_limit, max_limit, output_name in
+            KMER_PLOTS], threads=threads,
+            memory=resources.memory(sample_config))
+    sample_config["abyss"] = ABySS_Kmer_Folder
+    return sample_config
+
+
+def _plan_kmergenie(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    kmerdir = os.path.join(run_plan.workdir, "kmergenie")
+    kmer_input = os.path.join(kmerdir,
+            "{}kmerinput.txt".format(sample_config.get("output","")))
+    program = global_config["Tools"]["kmergenie"]["bin"]
+    program_options=global_config["Tools"]["kmergenie"]["options"]
+    if "kmergenie" in sample_config:
+        program_options=sample_config["kmergenie"]
+    threads = resources.threads(sample_config)
+    command = _kmergenie_command(program, kmer_input, program_options,
+            threads)
+    run_plan.add("kmergenie", "kmergenie", kmerdir, [plan.shell(command,
+        "kmergenie.stdOut", "kmergenie.stdErr"), plan.python_call(
+        "QCcontrol", "_kmergenie_plot", "histograms.dat")],
+        inputs=[libraryInfo[pair] for library, libraryInfo in
+        sorted_libraries_by_insert for pair in ["pair1", "pair2"]],
+        outputs=["histograms.dat", "histograms.dat.png"],
+        files={kmer_input: _kmergenie_input(sorted_libraries_by_insert)},
+        threads=threads, memory=resources.memory(sample_config))
+    sample_config["kmergenie"] = kmerdir
+    return sample_config
+
+
+def _plan_align(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    if "reference" not in sample_config:
+        print("reference sequence not provided, skypping alignment step.")
+        return sample_config
+    sample_config["alignments"] = align.plan_alignments(global_config,
+            sample_config, sorted_libraries_by_insert, run_plan, "align")
+    return sample_config
+
+
+def _run_step(tool, global_config, sample_config):
+    """with this I pick up at run time the correct function in the current
+    module, it returns sample_config modified if necessary"""
+    sorted_libraries_by_insert = common._sort_libraries_by_insert(
+            sample_config)
+    command_fn = getattr(sys.modules[__name__], "_run_{}".format(tool))
+    return command_fn(global_config, sample_config,
+            sorted_libraries_by_insert)
 
 
 def _run_align(global_config, sample_config,sorted_libraries_by_insert):
@@ -47,14 +201,14 @@ def _run_align(global_config, sample_config,sorted_libraries_by_insert):
         "Please provide a reference if you are intrested in aligning the reads",
         "against a reference")
         return sample_config
-    if not os.path.exists("alignments"):
-        os.makedirs("alignments")
-    os.chdir("alignments")
+    alignments_dir = common.run_dir(sample_config).subdir("alignments")
 
     sorted_libraries_by_insert =  align._align_reads(global_config,
-            sample_config,  sorted_libraries_by_insert) # align reads
+            sample_config,  sorted_libraries_by_insert,
+            alignments_dir) # align reads
     sorted_alignments_by_insert = align._merge_bam_files(global_config,
-            sample_config, sorted_libraries_by_insert) # merge alignments
+            sample_config, sorted_libraries_by_insert,
+            alignments_dir) # merge alignments
     sorted_alignments_by_insert = align.picard_CGbias(global_config,
             sample_config,sorted_alignments_by_insert) # compute picard stats
     sorted_alignments_by_insert = align.picard_collectInsertSizeMetrics(
@@ -62,56 +216,75 @@ def _run_align(global_config, sample_config,sorted_libraries_by_insert):
     sorted_alignments_by_insert = align.picard_markDuplicates(global_config,
             sample_config,sorted_alignments_by_insert)
 
-    os.chdir("..")
     sample_config["alignments"] = sorted_alignments_by_insert
 
     return sample_config
 
 
 def _run_fastqc(global_config, sample_config, sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    FastqcFolder = os.path.join(os.getcwd(), "fastqc")
-    if not os.path.exists(FastqcFolder):
-        os.makedirs(FastqcFolder)
+    FastqcFolder = common.run_dir(sample_config).subdir("fastqc").path
 
     program=global_config["Tools"]["fastqc"]["bin"]
     program_options=global_config["Tools"]["fastqc"]["options"]
+    # FastQC is single threaded: one library per thread
+    threads = resources.threads(sample_config)
+    jobs = []
     for library, libraryInfo in sorted_libraries_by_insert:
-        command = [program]
-        for option in program_options:
-            command.append(option)
         read1=libraryInfo["pair1"]
         read2=libraryInfo["pair2"]
-        command.append(read1)
-        if read2 is not None:
-            command.append(read2)
+        command = _fastqc_command(program, program_options, read1, read2)
         common.print_command(command)
         sample_config["commands"] += "\n" + common.get_command_str(command)
-        folder_output_name = os.path.join(FastqcFolder,
-                os.path.basename(read1).split(".fastq.gz")[0])
-        if not common.check_dryrun(sample_config) and not \
-                os.path.exists("{}_fastqc.zip".format(folder_output_name)):
-            fastq_stdOut = open(os.path.join(FastqcFolder,
-                    "{}_fastqc.stdout".format(library)), "a")
-            fastq_stdErr = open(os.path.join(FastqcFolder,
-                    "{}_fastqc.stderr".format(library)), "a")
-            subprocess.call(command, stdout=fastq_stdOut, stderr=fastq_stdErr)
+        step = cache.StepCache(command, inputs=[read1, read2],
+                outputs=[_fastqc_output(FastqcFolder, read1)],
+                tools=[program])
+        if not common.check_dryrun(sample_config) and not step.done():
+            jobs.append((command, os.path.join(FastqcFolder,
+                    "{}_fastqc.stdout".format(library)), os.path.join(
+                    FastqcFolder, "{}_fastqc.stderr".format(library)), "a",
+                    step, (), FastqcFolder))
+    common.run_in_parallel(_call_library, jobs, threads)
     sample_config["fastqc"] = FastqcFolder
     return sample_config
 
 
+def _fastqc_command(program, program_options, read1, read2):
+    command = [program]
+    command.extend(program_options)
+    command.append(read1)
+    if read2 is not None:
+        command.append(read2)
+    return command
+
+
+def _fastqc_output(FastqcFolder, read1):
+    return os.path.join(FastqcFolder, "{}_fastqc.zip".format(
+        os.path.basename(read1).split(".fastq.gz")[0]))
+
+
+def _call_library(command, stdout_name, stderr_name, mode, step,
+        temporaries=(), cwd=None):
+    """ runs the command of one library in cwd with its own stdout and
+    stderr, on success moves the temporary outputs in place and records the
+    step"""
+    returnValue = common.run_command(command, stdout=stdout_name,
+            stderr=stderr_name, mode=mode, cwd=cwd).returncode
+    if returnValue != 0:
+        print("error while running command: {}".format(command))
+        return returnValue
+    cache.commit_outputs(temporaries, step.outputs)
+    step.record()
+    return returnValue
+
+
 def _run_abyss(global_config, sample_config, sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    ABySS_Kmer_Folder = os.path.join(os.getcwd(), "abyss_kmer")
     if "kmer" not in sample_config:
         sys.exit("error in _run_abyss QCcontrol: kmer must be present in \
                 sample_config.yaml")
 
     kmer = sample_config["kmer"]
-    if not os.path.exists(ABySS_Kmer_Folder):
-        os.makedirs(ABySS_Kmer_Folder)
-
-    os.chdir(ABySS_Kmer_Folder)
+    kmer_dir = common.run_dir(sample_config).subdir("abyss_kmer")
+    ABySS_Kmer_Folder = kmer_dir.path
 
     program = global_config["Tools"]["abyss"]["bin"]
     program = os.path.join(os.path.dirname(program), "ABYSS-P")
@@ -119,53 +292,73 @@ def _run_abyss(global_config, sample_config, sorted_libraries_by_insert):
     if "abyss" in sample_config:
         program_options=sample_config["abyss"]
 
-    threads = 16 # default for UPPMAX
-    if "threads" in sample_config :
-        threads = sample_config["threads"]
+    threads = resources.threads(sample_config)
+
+    histogram = os.path.join(ABySS_Kmer_Folder, "histogram.hist")
+    histogram_tmp = cache.temporary_name(histogram)
+    command, reads = _abyss_kmer_command(program, threads, kmer,
+            sorted_libraries_by_insert)
+
+    step = cache.StepCache(command.format("histogram.hist"), inputs=reads,
+            outputs=[histogram], tools=[program])
+    common.print_command(command.format("histogram.hist"))
+    sample_config["commands"] += "\n" + common.get_command_str(
+            command.format("histogram.hist"))
 
+    if not common.check_dryrun(sample_config) and not step.done():
+        returnValue = kmer_dir.run(command.format(histogram_tmp),
+                stdout="ABySS_Kmer_Folder.stdOut",
+                stderr="ABySS_Kmer_Folder.stdErr", mode="a").returncode
+        if returnValue > 0:
+            print("ABySS kmer plotting failed: unkwnown reason")
+        else :
+            cache.commit_outputs([histogram_tmp], [histogram])
+            kmer_dir.run(["rm", "preUnitgs.fa"])
+            for min_limit, max_limit, output_name in KMER_PLOTS:
+                _plotKmerFixed(min_limit, max_limit, kmer, output_name,
+                        ABySS_Kmer_Folder)
+            _plotKmer(kmer, "kmer_coverage.png", ABySS_Kmer_Folder)
+            step.record()
+
+    sample_config["abyss"] = ABySS_Kmer_Folder
+    return sample_config
+
+
+def _abyss_kmer_command(program, threads, kmer, sorted_libraries_by_insert):
+    """ ABYSS-P command computing the k-mer coverage histogram (a template
+    taking the histogram name) and the reads it reads"""
     command = "mpirun -np {} {} ".format(threads, program)
     command += "-k {} ".format(kmer)
-    command += "--coverage-hist=histogram.hist -o preUnitgs.fa"
+    command += "--coverage-hist={} -o preUnitgs.fa"
+    reads = []
     for library, libraryInfo in sorted_libraries_by_insert:
         read1=libraryInfo["pair1"]
         read2=libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
         if orientation=="innie" or orientation=="outtie":
             command += " {} ".format(read1)
+            reads.append(read1)
             if read2 is not None:
                 command += " {} ".format(read2)
+                reads.append(read2)
         if orientation == "none":
             command += " {} ".format(read1)
+            reads.append(read1)
+    return command, reads
 
-    common.print_command(command)
-    sample_config["commands"] += "\n" + common.get_command_str(command)
 
-    if not common.check_dryrun(sample_config) and not \
-            os.path.exists("histogram.hist"):
-        ABySS_Kmer_stdOut = open("ABySS_Kmer_Folder.stdOut", "a")
-        ABySS_Kmer_stdErr = open("ABySS_Kmer_Folder.stdErr", "a")
-        returnValue = subprocess.call(command, shell=True, \
-                stdout=ABySS_Kmer_stdOut, stderr=ABySS_Kmer_stdErr)
-        if returnValue > 0:
-            print("ABySS kmer plotting failed: unkwnown reason")
-        else :
-            subprocess.call(("rm", "preUnitgs.fa"))
-            _plotKmerFixed(1,200, kmer, "kmer_coverage_1_200.png")
-            _plotKmerFixed(1,500, kmer, "kmer_coverage_1_500.png")
-            _plotKmerFixed(15,200, kmer, "kmer_coverage_15_200.png")
-            _plotKmerFixed(15,500, kmer, "kmer_coverage_15_500.png")
-            _plotKmer(kmer, "kmer_coverage.png")
-
-    os.chdir("..")
-    sample_config["abyss"] = ABySS_Kmer_Folder
-    return sample_config
-
-
-def _plotKmer(kmer, output_name):
-    """Kmer abundance as a single plot, suitable for the report
+def _plotKmer(kmer, output_name, folder=None):
+    """Kmer abundance as a single plot, suitable for the report, reads the
+    histogram of folder (by default the current one) and writes the plot in
+    it
     """
-    Kmer_histogram = pd.io.parsers.read_csv("histogram.hist", sep='\t',
-            header=None)
+    import numpy as np
+    import pandas as pd
+    from nougat.pdf.peakdetect import peakdet
+    plt = common.pyplot()
+    folder = folder or os.getcwd()
+    Kmer_histogram = pd.io.parsers.read_csv(os.path.join(folder,
+        "histogram.hist"), sep='\t', header=None)
     Kmer_coverage = Kmer_histogram[Kmer_histogram.columns[0]].tolist()
     Kmer_count = Kmer_histogram[Kmer_histogram.columns[1]].tolist()
 
@@ -213,17 +406,20 @@ def _plotKmer(kmer, output_name):
         linestyles='--')
     plt.text(peak, kcount_gradient[peak], str(peak))
 
-    plotname = "{}".format(output_name)
+    plotname = os.path.join(folder, "{}".format(output_name))
     plt.savefig(plotname)
     plt.clf()
     return 0
 
 
-def _plotKmerFixed(min_limit, max_limit, kmer, output_name):
+def _plotKmerFixed(min_limit, max_limit, kmer, output_name, folder=None):
     """Old kmerplot, kept just in case...
     """
-    Kmer_histogram = pd.io.parsers.read_csv("histogram.hist", sep='\t',
-            header=None)
+    import pandas as pd
+    plt = common.pyplot()
+    folder = folder or os.getcwd()
+    Kmer_histogram = pd.io.parsers.read_csv(os.path.join(folder,
+        "histogram.hist"), sep='\t', header=None)
     Kmer_coverage = Kmer_histogram[Kmer_histogram.columns[0]].tolist()
     Kmer_count = Kmer_histogram[Kmer_histogram.columns[1]].tolist()
     Kmer_freq = [Kmer_coverage[i]*Kmer_count[i] for i in \
@@ -242,7 +438,7 @@ def _plotKmerFixed(min_limit, max_limit, kmer, output_name):
     plt.vlines(kmer_freq_peak, 0, kmer_freq_peak_value, colors='r',
             linestyles='--')
     plt.text(kmer_freq_peak, kmer_freq_peak_value+2000, str(kmer_freq_peak))
-    plotname = "{}".format(output_name)
+    plotname = os.path.join(folder, "{}".format(output_name))
     plt.savefig(plotname)
     plt.clf()
     return 0
@@ -260,64 +456,88 @@ def _run_trimmomatic(global_config, sample_config, sorted_libraries_by_insert):
         sys.exit("Trimmomatic cannot be run as adapter file is not specified"
                 "or points to unknown position: {}".format(adapterFile))
 
-    mainDirectory = os.getcwd()
-    trimmomaticDir = os.path.join(mainDirectory, "Trimmomatic")
-    if not os.path.exists(trimmomaticDir):
-        os.makedirs(trimmomaticDir)
-    os.chdir(trimmomaticDir)
-    #now I am in running dir, I need to process one by one the libraries
-    threads = 8
-    if "threads" in sample_config:
-        threads = sample_config["threads"]
+    trimmomaticDir = common.run_dir(sample_config).subdir("Trimmomatic").path
+    # libraries are processed concurrently in trimmomaticDir, the threads and
+    # memory are split among the libraries run at the same time
+    workers, library_threads, library_memory = _trimmomatic_workers(
+            sample_config, sorted_libraries_by_insert)
 
+    jobs = []
     for library, libraryInfo in sorted_libraries_by_insert:
         read1=libraryInfo["pair1"]
         read2=libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
         if read2 is not None:
             read1_baseName = os.path.split(read1)[1].split(".")[0]
-            read2_baseName = os.path.split(read2)[1].split(".")[0]
-            output_read1_pair = os.path.join(trimmomaticDir,
-                    "{}.fastq.gz".format(read1_baseName))
-            output_read1_sing = os.path.join(trimmomaticDir,
-                    "{}_u.fastq.gz".format(read1_baseName))
-            output_read2_pair = os.path.join(trimmomaticDir,
-                    "{}.fastq.gz".format(read2_baseName))
-            output_read2_sing = os.path.join(trimmomaticDir,
-                    "{}_u.fastq.gz".format(read2_baseName))
-            command = ["java",  "-jar", program, "PE", "-threads",
-                    "{}".format(threads),  "-phred33",  read1, read2,
-                    output_read1_pair, output_read1_sing, output_read2_pair,
-                    output_read2_sing,
-                    "ILLUMINACLIP:{}:2:30:10".format(adapterFile),
-                    "LEADING:3", "TRAILING:3", "SLIDINGWINDOW:4:15",
-                    "MINLEN:30"]
-            common.print_command(command)
-            sample_config["commands"] += "\n" + common.get_command_str(command)
-
-            # do not execute is files have been already gennerated
-            if not common.check_dryrun(sample_config) and not \
-                    os.path.exists(output_read1_pair):
-                stdOut = open("{}_trimmomatic.stdOut".format(read1_baseName),
-                        "w")
-                stdErr = open("{}_trimmomatic.stdErr".format(read1_baseName),
-                        "w")
-                returnValue = subprocess.call(command, stdout=stdOut,
-                        stderr=stdErr) # run the program
-                if returnValue != 0:
-                    print("error while running command: {}".format(command))
+            outputs = _trimmomatic_outputs(trimmomaticDir, read1, read2)
+            output_read1_pair, output_read1_sing, output_read2_pair, \
+                    output_read2_sing = outputs
+            # outputs are written under temporary names and renamed at the end
+            temporaries = [cache.temporary_name(output) for output in outputs]
+            command, trimming = _trimmomatic_command(program, adapterFile,
+                    read1, read2, library_threads, library_memory)
+            common.print_command(command + outputs + trimming)
+            sample_config["commands"] += "\n" + common.get_command_str(
+                    command + outputs + trimming)
+
+            # do not execute if files have been already generated by the same
+            # command from the same reads
+            step = cache.StepCache(command + outputs + trimming,
+                    inputs=[read1, read2, adapterFile], outputs=outputs,
+                    tools=[program])
+            if not common.check_dryrun(sample_config) and not step.done():
+                jobs.append((command + temporaries + trimming,
+                        os.path.join(trimmomaticDir,
+                        "{}_trimmomatic.stdOut".format(read1_baseName)),
+                        os.path.join(trimmomaticDir,
+                        "{}_trimmomatic.stdErr".format(read1_baseName)), "w",
+                        step, temporaries, trimmomaticDir))
             libraryInfo["pair1"] = output_read1_pair
             libraryInfo["pair2"] = output_read2_pair
             libraryInfo["trimmomatic"] = os.path.join(trimmomaticDir,
                     "{}_trimmomatic.stdErr".format(read1_baseName))
-    os.chdir(mainDirectory)
+    common.run_in_parallel(_call_library, jobs, workers)
     return sample_config
 
 
+def _trimmomatic_workers(sample_config, sorted_libraries_by_insert):
+    """ libraries trimmed at the same time and the threads and memory of
+    each one"""
+    threads = resources.threads(sample_config)
+    paired_libraries = len([libraryInfo for library, libraryInfo in
+        sorted_libraries_by_insert if libraryInfo["pair2"] is not None])
+    workers = max(1, min(threads, paired_libraries))
+    return workers, resources.split(threads, workers), resources.split(
+            resources.memory(sample_config), workers)
+
+
+def _trimmomatic_outputs(trimmomaticDir, read1, read2):
+    """ trimmed pairs and singletons of read1 and read2"""
+    outputs = []
+    for read in [read1, read2]:
+        baseName = os.path.split(read)[1].split(".")[0]
+        outputs.extend([os.path.join(trimmomaticDir,
+            "{}.fastq.gz".format(baseName)), os.path.join(trimmomaticDir,
+            "{}_u.fastq.gz".format(baseName))])
+    return outputs
+
+
+def _trimmomatic_command(program, adapterFile, read1, read2, threads,
+        memory):
+    """ command (up to the output names) and trimming steps of a library"""
+    command = ["java", resources.java_heap(memory), "-jar", program, "PE",
+            "-threads", "{}".format(threads),  "-phred33",  read1, read2]
+    trimming = ["ILLUMINACLIP:{}:2:30:10".format(adapterFile), "LEADING:3",
+            "TRAILING:3", "SLIDINGWINDOW:4:15", "MINLEN:30"]
+    return command, trimming
+
+
 def _kmergenie_plot(hist_file):
     """Kmergenie outputs pdf plots. We want pngs without resorting to \
     imagemagick
     TODO: Abstract this to a common plotting function if possible"""
+    import pandas as pd
+    plt = common.pyplot()
     kgenie_hist = pd.io.parsers.read_csv(hist_file, sep=" ", header=0)
     kmer_lengths = kgenie_hist[kgenie_hist.columns[0]].tolist()
     genomic_kmers = kgenie_hist[kgenie_hist.columns[1]].tolist()
@@ -343,11 +563,8 @@ def _kmergenie_plot(hist_file):
 def _run_kmergenie(global_config, sample_config, sorted_libraries_by_insert):
     """Runs kmergenie to establish a recommended kmer size for assembly"""
 
-    maindir = os.getcwd()
-    kmerdir = os.path.join(maindir, "kmergenie")
-    if not os.path.exists(kmerdir):
-        os.makedirs(kmerdir)
-    os.chdir(kmerdir)
+    kmergenie_dir = common.run_dir(sample_config).subdir("kmergenie")
+    kmerdir = kmergenie_dir.path
 
     #Write a list of input fastq files for kmergenie
     kmer_input = os.path.join(kmerdir,
@@ -359,35 +576,37 @@ def _run_kmergenie(global_config, sample_config, sorted_libraries_by_insert):
     if "kmergenie" in sample_config:
         program_options=sample_config["kmergenie"]
 
-    threads = "" # Kmergenie will spawn number_of_cores - 1 threads by default
-    if "threads" in sample_config :
-        threads = sample_config["threads"]
-
-    cmd_list = [program, kmer_input]
-    for option in filter(None, program_options):
-        cmd_list.append(option)
-    if threads:
-        cmd_list.append("-t {}".format(threads))
-    command = " ".join(cmd_list)
+    threads = resources.threads(sample_config)
+    command = _kmergenie_command(program, kmer_input, program_options,
+            threads)
     common.print_command(command)
     sample_config["commands"] += "\n" + common.get_command_str(command)
 
 
     if not common.check_dryrun(sample_config):
         with open(kmer_input, "w") as f:
-            for lib, lib_info in sorted_libraries_by_insert:
-                f.write(lib_info["pair1"] + "\n")
-                f.write(lib_info["pair2"] + "\n")
+            f.write(_kmergenie_input(sorted_libraries_by_insert))
 
-        stdOut = open("kmergenie.stdOut", "w")
-        stdErr = open("kmergenie.stdErr", "w")
-        returnValue = subprocess.call(cmd_list, stdout=stdOut, stderr=stdErr)
+        returnValue = kmergenie_dir.run(command, stdout="kmergenie.stdOut",
+                stderr="kmergenie.stdErr").returncode
         if returnValue != 0:
             print("error while running command: {}".format(command))
         else:
-            _kmergenie_plot("histograms.dat")
+            _kmergenie_plot(kmergenie_dir.join("histograms.dat"))
     sample_config["kmergenie"] = kmerdir
-    os.chdir(maindir)
     return sample_config
 
 
+def _kmergenie_command(program, kmer_input, program_options, threads):
+    cmd_list = [program, kmer_input]
+    for option in filter(None, program_options):
+        cmd_list.append(option)
+    if threads:
+        cmd_list.append("-t {}".format(threads))
+    return " ".join(cmd_list)
+
+
+def _kmergenie_input(sorted_libraries_by_insert):
+    """ the list of fastq files read by kmergenie"""
+    return "".join("{}\n{}\n".format(lib_info["pair1"], lib_info["pair2"])
+            for lib, lib_info in sorted_libraries_by_insert)
@@ -1 +1,3 @@
-__import__('pkg_resources').declare_namespace(__name__)
+# pkgutil-style namespace package: unlike pkg_resources it costs nothing to
+# import, which matters for every command line tool
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
@@ -1,34 +1,236 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, yaml, glob
-import subprocess
+import re
 import string
 import sys
 import gzip
-import pandas as pd
-from nougat import common
-
-
-def _align_reads(global_config, sample_config, sorted_libraries_by_insert):
+from nougat import common, cache, plan, resources
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# bwa mem holds its index (about this many times the reference) in memory
+BWA_INDEX_FACTOR = 1.75
+# and a batch of reads per thread (MB)
+BWA_THREAD_MEMORY = 64
+# samtools sort running next to bwa mem gets one thread every this many
+SORT_THREADS_DIVISOR = 4
+# bwa mem gains little from more threads than these, more libraries are
+# aligned at the same time instead
+BWA_MEM_MAX_THREADS = 16
+# records of a library dealt in turn to each of its shards
+SHARD_BLOCK_RECORDS = 10000
+
+
+def _align_reads(global_config, sample_config, sorted_libraries_by_insert,
+        run_dir=None):
+    """ aligns each library in its own folder of run_dir (a common.RunDir,
+    by default the current directory).
+
+    The libraries are aligned at the same time as _alignment_workers says,
+    the largest first, sharing the threads of the step through a
+    resources.ThreadBudget. Without streaming a library sorting its unsorted
+    bam keeps only the threads of the sort, so that the next one can start
+    aligning meanwhile (with streaming the sort already runs next to the
+    alignment).
+
+    A library with more than one shard (see _shards) is split with
+    split_reads and its shards are aligned as libraries of their own, its
+    alignment is then the list of the sorted shards, merged in one go by
+    _merge_bam_files. The shards of the reads are removed once all aligned,
+    unless keep_tmp_files is among the flags"""
+    if run_dir is None:
+        run_dir = common.RunDir(os.getcwd())
     reference =  build_reference_bwa(global_config, sample_config)
-    #now prepare for alignment
-    for library, libraryInfo in sorted_libraries_by_insert:
+    aligner   = _program(global_config, "bwa")
+    samtools  = _program(global_config, "samtools")
+    streaming = _streaming_sort(global_config)
+    dryrun    = common.check_dryrun(sample_config)
+    libraries = _largest_first(sorted_libraries_by_insert)
+    alignments = sum(_shards(sample_config, libraryInfo) for library,
+            libraryInfo in libraries)
+    workers, threads, memory = _alignment_workers(sample_config, alignments,
+            streaming)
+    budget = resources.ThreadBudget(resources.threads(sample_config))
+    jobs = []
+    sharded = [] # (step, reads) of the libraries whose shards are aligned
+    for library, libraryInfo in libraries:
         read1 = libraryInfo["pair1"]
         read2 = libraryInfo["pair2"]
-        orientation = libraryInfo["orientation"]
-        insert      = libraryInfo["insert"]
-        std         = libraryInfo["std"]
-        threads     = 8
-        dryrun      = common.check_dryrun(sample_config)
-        if "threads" in sample_config:
-            threads  = sample_config["threads"]
-        libraryInfo["alignment"] = align_bwa_mem(global_config, read1, read2,
-                reference, threads, dryrun)
+        shards = _shards(sample_config, libraryInfo)
+        if shards == 1:
+            libraryInfo["alignment"] = _alignment_bam(run_dir, read1, read2,
+                    reference)
+            jobs.append((global_config, read1, read2, reference, threads,
+                dryrun, memory, run_dir, streaming, budget))
+            continue
+        libraryBase, mappingBase = _alignment_names(read1, read2, reference)
+        library_dir = run_dir.subdir(libraryBase)
+        reads_dir = library_dir.subdir("shards")
+        reads = [tuple(None if name is None else reads_dir.join(name) for
+            name in pair) for pair in _shard_names(read1, read2, shards)]
+        libraryInfo["alignment"] = [_alignment_bam(reads_dir, shard1, shard2,
+            reference) for shard1, shard2 in reads]
+        step = cache.StepCache([aligner, "mem", reference, read1, read2, "|",
+            samtools, "sort", "shards", shards, SHARD_BLOCK_RECORDS],
+            inputs=[reference, read1, read2],
+            outputs=libraryInfo["alignment"], tools=[aligner, samtools],
+            manifest=library_dir.join("{}.shards{}".format(mappingBase,
+            cache.STEP_CACHE_SUFFIX)))
+        if step.done():
+            continue
+        split_reads(read1, read2, shards, reads_dir, dryrun)
+        jobs.extend((global_config, shard1, shard2, reference, threads,
+            dryrun, memory, reads_dir, streaming, budget) for shard1, shard2
+            in reads)
+        sharded.append((step, reads))
+    common.run_in_parallel(align_bwa_mem, jobs, workers)
+    keep_shards = "keep_tmp_files" in sample_config.get("flags", [])
+    for step, reads in sharded:
+        if dryrun or not all(os.path.exists(alignment) for alignment in
+                step.outputs):
+            continue
+        step.record()
+        if not keep_shards:
+            for read in [read for pair in reads for read in pair if read]:
+                for path in [read, read + cache.STEP_CACHE_SUFFIX]:
+                    if os.path.exists(path):
+                        os.remove(path)
     return sorted_libraries_by_insert
 
 
-def _merge_bam_files(global_config, sample_config, sorted_libraries_by_insert):
-    BAMfiles = {};
+def _alignment_workers(sample_config, alignments, streaming=True):
+    """ alignments (libraries or shards) run at the same time and the
+    threads and memory of each one. parallel_alignments in the sample config
+    sets how many, by default enough for each bwa mem to get at most
+    BWA_MEM_MAX_THREADS; without streaming one more can be sorting
+    meanwhile"""
+    threads = resources.threads(sample_config)
+    aligning = sample_config.get("parallel_alignments") or \
+            -(-threads // BWA_MEM_MAX_THREADS)
+    aligning = max(1, min(aligning, alignments, threads))
+    workers = aligning
+    if not streaming and alignments > aligning:
+        workers += 1
+    return workers, resources.split(threads, aligning), resources.split(
+            resources.memory(sample_config), workers)
+
+
+def _shards(sample_config, libraryInfo):
+    """ shards the reads of a library are aligned in: shards of the
+    library, otherwise alignment_shards of the sample config, by default 1
+    (the library is aligned as a whole)"""
+    return max(1, int(libraryInfo.get("shards") or
+        sample_config.get("alignment_shards") or 1))
+
+
+def _shard_patterns(read1, read2):
+    """ file names of the shards of read1 and read2 (None for single end),
+    formatted with the shard number. The shards are named as a library of
+    their own by _alignment_names"""
+    libraryBase = _library_base(read1, read2)
+    if read2 is None:
+        return "{}.%04d.fastq.gz".format(libraryBase), None
+    return ("{}.%04d_1.fastq.gz".format(libraryBase),
+            "{}.%04d_2.fastq.gz".format(libraryBase))
+
+
+def _shard_names(read1, read2, shards):
+    """ (read1, read2) file names of each shard of a library"""
+    patterns = _shard_patterns(read1, read2)
+    return [tuple(None if pattern is None else pattern % shard for pattern in
+        patterns) for shard in range(shards)]
+
+
+def _split_command(read, shards, pattern):
+    """ shell command dealing the records of read, blocks of
+    SHARD_BLOCK_RECORDS in turn, to shards gzipped files named pattern %
+    shard. read is decompressed once, in a pipe, and each shard compressed
+    by its own gzip"""
+    decompress = "gzip -dc" if read.endswith(".gz") else "cat"
+    script = ("BEGIN { for (i = 0; i < n; i++) { shard[i] = sprintf(filter, "
+            "i); printf \"\" | shard[i] } } "
+            "{ print | shard[int((NR - 1) / lines) % n] } "
+            "END { for (i = 0; i < n; i++) if (close(shard[i]) != 0) "
+            "status = 1; exit status }")
+    return "{} {} | awk -v n={} -v lines={} -v filter={} {}".format(
+            decompress, quote(read), shards, 4 * SHARD_BLOCK_RECORDS,
+            quote("gzip -1 > {}".format(quote(pattern))), quote(script))
+
+
+def split_reads(read1, read2, shards, reads_dir, dryrun=False):
+    """ splits read1 and read2 (None for single end) in shards pairs of
+    files in reads_dir (a common.RunDir), record by record the same way, so
+    that the mates stay in the same shard. Both are split at the same time
+    and the shards renamed only once complete. Returns the (read1, read2)
+    of each shard"""
+    reads = [tuple(None if name is None else reads_dir.join(name) for name
+        in pair) for pair in _shard_names(read1, read2, shards)]
+    step = cache.StepCache(["split", shards, SHARD_BLOCK_RECORDS, read1,
+        read2], inputs=[read1, read2], outputs=[read for pair in reads for
+        read in pair if read is not None])
+    if step.done():
+        return reads
+    jobs = []
+    temporaries = []
+    outputs = []
+    for read, pattern in zip([read1, read2], _shard_patterns(read1, read2)):
+        if read is None:
+            continue
+        outputs.extend(reads_dir.join(pattern % shard) for shard in
+                range(shards))
+        pattern = cache.temporary_name(reads_dir.join(pattern))
+        temporaries.extend(pattern % shard for shard in range(shards))
+        command = _split_command(read, shards, pattern)
+        common.print_command(command)
+        jobs.append((["bash", "-o", "pipefail", "-c", command], None,
+            "split_{}.stdErr".format(len(jobs) + 1)))
+    if dryrun:
+        return reads
+    results = common.run_in_parallel(reads_dir.run, jobs, len(jobs))
+    if not all(result.success for result in results):
+        sys.exit("error while splitting {} in {} shards, see {}".format(
+            read1, shards, reads_dir.path))
+    cache.commit_outputs(temporaries, outputs)
+    step.record()
+    return reads
+
+
+def _largest_first(sorted_libraries_by_insert):
+    """ the libraries by decreasing size of their reads, so that the longest
+    alignments do not start last"""
+    def size(library):
+        library, libraryInfo = library
+        return sum(os.path.getsize(read) for read in [libraryInfo["pair1"],
+            libraryInfo["pair2"]] if read is not None and os.path.exists(read))
+    return sorted(sorted_libraries_by_insert, key=size, reverse=True)
+
+
+def _streaming_sort(global_config):
+    """ whether samtools can sort the output of bwa mem as it comes (i.e.,
+    reads from stdin and takes -T and -o, version 1.0 or later), the
+    version is the one in the tool cache"""
+    from nougat import toolcache
+    resolver = toolcache.ToolResolver(global_config)
+    tool = resolver.resolve(_program(global_config, "samtools"))
+    resolver.save()
+    if tool is None or tool.version is None:
+        return True
+    version = re.search(r"(\d+)\.\d+", tool.version)
+    return version is None or int(version.group(1)) >= 1
+
+
+def _merge_bam_files(global_config, sample_config, sorted_libraries_by_insert,
+        run_dir=None):
+    """ merges the alignments of each insert size in its own folder of
+    run_dir (a common.RunDir, by default the current directory). All the
+    sorted alignments of an insert size, the shards of its libraries
+    included, are merged by a single samtools merge, renamed only once
+    complete"""
+    if run_dir is None:
+        run_dir = common.RunDir(os.getcwd())
     reference = sample_config["reference"]
 
     samtools = "samtools"
@@ -39,57 +241,38 @@ def _merge_bam_files(global_config, sample_config, sorted_libraries_by_insert):
                 "path and not in global config, please make sure to install "
                 "bwa properly")
 
-    numInserts = 0
-    for library, libraryInfo in sorted_libraries_by_insert:
-        read1 = libraryInfo["pair1"]
-        read2 = libraryInfo["pair2"]
-        orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
-        alignment = libraryInfo["alignment"]
-        if insert not in BAMfiles:
-            BAMfiles[insert] = [alignment]
-            numInserts += 1
-        else:
-            BAMfiles[insert].append(alignment)
+    BAMfiles = _alignments_by_insert(sorted_libraries_by_insert)
+    numInserts = len(BAMfiles)
 
     BAMfilesMerged = {}
     for insert, insertGroup in BAMfiles.items():
-        dir_insert = "lib_{}".format(insert)
-        if numInserts == 1:
-            dir_insert = sample_config["output"]
-        if not os.path.exists(dir_insert):
-            os.makedirs(dir_insert)
-        os.chdir(dir_insert)
+        dir_insert, bamMerged = _merged_bam(sample_config, insert, numInserts)
+        insert_dir = run_dir.subdir(dir_insert)
+        bamMerged = insert_dir.join(bamMerged)
         #check if file is already present
-        bamMerged = "lib_{}.bam".format(insert)
-        if numInserts == 1:
-            bamMerged = "{}.bam".format(sample_config["output"])
 
         if os.path.exists(bamMerged):
-            BAMfilesMerged[insert] = [os.path.abspath(bamMerged), dir_insert]
-            os.chdir("..")
+            BAMfilesMerged[insert] = [bamMerged, dir_insert]
             continue # nothiing to be done for this insert
 
         if len(insertGroup) == 1: # only one sample file for this insert length
             cl = ["ln", "-s", insertGroup[0], bamMerged]
-            returnValue = subprocess.call(cl)
+            returnValue = insert_dir.run(cl).returncode
             if  not returnValue == 0:
                 sys.exit("error, while soft linking {}".format(insertGroup[0]))
         else:
-            command = [samtools, "merge",bamMerged]
-            for bamfile in insertGroup:
-                command.append(bamfile)
-
+            bamMerged_tmp = cache.temporary_name(bamMerged)
+            command = _merge_command(samtools, sample_config, bamMerged_tmp,
+                    insertGroup)
             common.print_command(command)
             returnValue = 0
             if not common.check_dryrun(sample_config):
-                returnValue = subprocess.call(command)
+                returnValue = insert_dir.run(command).returncode
                 if  not returnValue == 0:
                     sys.exit("error, while merging files {}".format(
                         insertGroup))
-        BAMfilesMerged[insert] = [os.path.abspath(bamMerged), dir_insert]
-        os.chdir("..")
+                cache.commit_outputs([bamMerged_tmp], [bamMerged])
+        BAMfilesMerged[insert] = [bamMerged, dir_insert]
 
     sorted_alignments_by_insert = []
     for key in sorted(BAMfilesMerged.keys()):
@@ -99,99 +282,135 @@ def _merge_bam_files(global_config, sample_config, sorted_libraries_by_insert):
 
 
 
-def picard_CGbias(global_config, sample_config, sorted_alignments_by_insert):
-    picard = "";
+def _merge_command(samtools, sample_config, bamMerged, BAMfiles):
+    """ samtools merge of sorted BAMfiles: a single k-way merge, however
+    many they are"""
+    return [samtools, "merge", "-@", "{}".format(resources.threads(
+        sample_config)), bamMerged] + BAMfiles
+
+
+def _alignments_by_insert(sorted_libraries_by_insert):
+    """ the alignments of the libraries grouped by insert size, the ones of
+    the shards of a library (a list) included one by one"""
+    BAMfiles = {}
+    for library, libraryInfo in sorted_libraries_by_insert:
+        alignment = libraryInfo["alignment"]
+        if not isinstance(alignment, list):
+            alignment = [alignment]
+        BAMfiles.setdefault(libraryInfo["insert"], []).extend(alignment)
+    return BAMfiles
+
+
+def _merged_bam(sample_config, insert, numInserts):
+    """ folder and name of the merged alignment of an insert size"""
+    if numInserts == 1:
+        return sample_config["output"], "{}.bam".format(
+                sample_config["output"])
+    return "lib_{}".format(insert), "lib_{}.bam".format(insert)
+
+
+def _picard_home(global_config):
+    picard = ""
     if os.environ.get('PICARD_HOME'):
         picard = os.environ.get('PICARD_HOME')
     elif "picard" in global_config["Tools"]:
         picard = global_config["Tools"]["picard"]["bin"]
+    return picard
+
+
+def _picard_CGbias_command(picard, sample_config, BAMfile):
+    output_header = os.path.basename(BAMfile).split(".bam")[0]
+    return ["java", resources.java_heap(resources.memory(sample_config)),
+            "-jar", os.path.join(picard, "CollectGcBiasMetrics.jar"),
+            "REFERENCE_SEQUENCE={}".format(sample_config["reference"]),
+            "INPUT={}".format(BAMfile),
+            "OUTPUT={}.collectGcBias.txt".format(output_header),
+            "CHART_OUTPUT={}.collectGcBias.pdf".format(output_header),
+            "ASSUME_SORTED=true", "VALIDATION_STRINGENCY=LENIENT",
+            "TMP_DIR=$TMPDIR"]
+
+
+def _picard_collectInsertSizeMetrics_command(picard, sample_config, BAMfile,
+        library):
+    output_header = os.path.basename(BAMfile).split(".bam")[0]
+    histWide = library * 2
+    return ["java", resources.java_heap(resources.memory(sample_config)),
+            "-jar", os.path.join(picard, "CollectInsertSizeMetrics.jar"),
+            "INPUT={}".format(BAMfile), "MINIMUM_PCT=0",
+            "HISTOGRAM_FILE={}.collectInsertSize.pdf".format(output_header),
+            "OUTPUT={}.collectInsertSize.txt".format(output_header),
+            "HISTOGRAM_WIDTH={}".format(histWide),
+            "VALIDATION_STRINGENCY=LENIENT", "TMP_DIR=$TMPDIR"]
+
+
+def _picard_markDuplicates_command(picard, sample_config, BAMfile):
+    output_header = os.path.basename(BAMfile).split(".bam")[0]
+    return ["java", resources.java_heap(resources.memory(sample_config)),
+            "-jar", os.path.join(picard, "MarkDuplicates.jar"),
+            "INPUT={}".format(BAMfile), "OUTPUT={}_noDup.bam".format(
+            output_header),"METRICS_FILE={0}.markDuplicates.txt".format(
+            output_header), "ASSUME_SORTED=true",
+            "VALIDATION_STRINGENCY=LENIENT", "TMP_DIR=$TMPDIR"]
+
+
+def picard_CGbias(global_config, sample_config, sorted_alignments_by_insert):
+    picard = _picard_home(global_config)
     for library, BAMfile, working_dir in sorted_alignments_by_insert:
-        os.chdir(working_dir)
+        insert_dir = common.RunDir(os.path.dirname(BAMfile))
         output_header = os.path.basename(BAMfile).split(".bam")[0]
-        command= ["java", "-Xmx16g", "-XX:PermSize=2g", "-jar",
-                os.path.join(picard, "CollectGcBiasMetrics.jar"),
-                "REFERENCE_SEQUENCE={}".format(sample_config["reference"]),
-                "INPUT={}".format(BAMfile), \
-                "OUTPUT={}.collectGcBias.txt".format(output_header),
-                "CHART_OUTPUT={}.collectGcBias.pdf".format(output_header),
-                "ASSUME_SORTED=true", "VALIDATION_STRINGENCY=LENIENT",
-                "TMP_DIR=$TMPDIR"]
+        command = _picard_CGbias_command(picard, sample_config, BAMfile)
         returnValue = 0;
         common.print_command(command)
-        if not os.path.exists("{}.collectGcBias.pdf".format(output_header)):
+        if not insert_dir.exists("{}.collectGcBias.pdf".format(output_header)):
             if not common.check_dryrun(sample_config):
-                stdOut = open("collectGcBias.stdOut", "w")
-                stdErr = open("collectGcBias.stdErr", "w")
-                returnValue = subprocess.call(command, stdout=stdOut,
-                        stderr=stdErr)
+                returnValue = insert_dir.run(command,
+                        stdout="collectGcBias.stdOut",
+                        stderr="collectGcBias.stdErr").returncode
                 if not returnValue == 0:
                     print("problem running collectGCBias")
-        os.chdir("..")
     return sorted_alignments_by_insert
 
 
 
 def picard_collectInsertSizeMetrics(global_config, sample_config,
         sorted_alignments_by_insert):
-    picard = "";
-    if os.environ.get('PICARD_HOME'):
-        picard = os.environ.get('PICARD_HOME')
-    elif "picard" in global_config["Tools"]:
-        picard = global_config["Tools"]["picard"]["bin"]
+    picard = _picard_home(global_config)
     for library, BAMfile, working_dir in sorted_alignments_by_insert:
-        os.chdir(working_dir)
+        insert_dir = common.RunDir(os.path.dirname(BAMfile))
         output_header = os.path.basename(BAMfile).split(".bam")[0]
-        histWide = library * 2
-        command= ["java", "-Xmx16g", "-XX:PermSize=2g", "-jar",
-                os.path.join(picard, "CollectInsertSizeMetrics.jar"),
-                "INPUT={}".format(BAMfile), "MINIMUM_PCT=0",
-                "HISTOGRAM_FILE={}.collectInsertSize.pdf".format(
-                output_header),
-                "OUTPUT={}.collectInsertSize.txt".format(output_header),
-                "HISTOGRAM_WIDTH={}".format(histWide),
-                "VALIDATION_STRINGENCY=LENIENT", "TMP_DIR=$TMPDIR"]
+        command = _picard_collectInsertSizeMetrics_command(picard,
+                sample_config, BAMfile, library)
         returnValue = 0;
         common.print_command(command)
-        if not os.path.exists("{}.collectInsertSize.pdf".format(
+        if not insert_dir.exists("{}.collectInsertSize.pdf".format(
             output_header)):
             if not common.check_dryrun(sample_config):
-                stdOut = open("collectInsertSize.stdOut", "w")
-                stdErr = open("collectInsertSize.stdErr", "w")
-                returnValue = subprocess.call(command, stdout=stdOut,
-                        stderr=stdErr)
+                returnValue = insert_dir.run(command,
+                        stdout="collectInsertSize.stdOut",
+                        stderr="collectInsertSize.stdErr").returncode
                 if not returnValue == 0:
                     print("problem running CollectInsertSizeMetrics")
-        os.chdir("..")
     return sorted_alignments_by_insert
 
 
 def picard_markDuplicates(global_config, sample_config,
         sorted_alignments_by_insert):
-    picard = "";
-    if os.environ.get('PICARD_HOME'):
-        picard = os.environ.get('PICARD_HOME')
-    elif "picard" in global_config["Tools"]:
-        picard = global_config["Tools"]["picard"]["bin"]
+    picard = _picard_home(global_config)
     for library, BAMfile, working_dir in sorted_alignments_by_insert:
-        os.chdir(working_dir)
+        insert_dir = common.RunDir(os.path.dirname(BAMfile))
         output_header = os.path.basename(BAMfile).split(".bam")[0]
-        command= ["java", "-Xmx16g", "-XX:PermSize=3g", "-jar",
-                os.path.join(picard, "MarkDuplicates.jar"),
-                "INPUT={}".format(BAMfile), "OUTPUT={}_noDup.bam".format(
-                output_header),"METRICS_FILE={0}.markDuplicates.txt".format(
-                output_header), "ASSUME_SORTED=true",
-                "VALIDATION_STRINGENCY=LENIENT", "TMP_DIR=$TMPDIR"]
+        command = _picard_markDuplicates_command(picard, sample_config,
+                BAMfile)
         returnValue = 0;
         common.print_command(command)
-        if not os.path.exists("{}.markDuplicates.txt".format(output_header)):
+        if not insert_dir.exists("{}.markDuplicates.txt".format(
+            output_header)):
             if not common.check_dryrun(sample_config):
-                stdOut = open("removeDup.stdOut", "w")
-                stdErr = open("removeDup.stdErr", "w")
-                returnValue = subprocess.call(command, stdout=stdOut,
-                        stderr=stdErr)
+                returnValue = insert_dir.run(command,
+                        stdout="removeDup.stdOut",
+                        stderr="removeDup.stdErr").returncode
                 if not returnValue == 0:
                     print("problem running MarkDuplicates")
-        os.chdir("..")
     return sorted_alignments_by_insert
 
 
@@ -216,46 +435,177 @@ def build_reference_bwa(global_config, sample_config):
     #otherwise I need to build the reference, in this case I build it locally
     if not os.path.exists(reference):
         sys.exit("error, reference file {} does not exists".format(reference))
-    # check if bwa index already created
-    current_dir           = os.getcwd() 
-    bwa_index_folder      = os.path.join(path_name, "bwa")
-    #if needed create directory
-    if not os.path.exists(bwa_index_folder):
-        os.makedirs(bwa_index_folder)
-    os.chdir(bwa_index_folder)
-    # if needed soft link the reference
-    if not os.path.exists(base_name):
-        #check and remove broken links
-        if os.path.lexists(base_name):
-            os.remove(base_name)
-        returnValue = subprocess.call(["ln", "-s", reference, base_name])
-        if not returnValue == 0:
-            sys.exit("error while trying to soft link reference sequence")
-    # now I have a soflinked copy
-    reference = os.path.join(path_name, "bwa", base_name)
-    # now check if index alredy build or not
-    if not os.path.exists("{}.bwt".format(reference)):
-        # then create the index sequence
-        bwa_stdOut = open("bwa_index.stdOut", "w")
-        bwa_stdErr = open("bwa_index.stdErr", "w")
-        command = [program, "index", reference]
-        common.print_command(command)
-        if not common.check_dryrun(sample_config):
-            returnValue = subprocess.call(command, stdout=bwa_stdOut,
-                    stderr=bwa_stdErr)
-            if  not returnValue == 0:
-                sys.exit("error, while indexing reference file {} "
-                        "with bwa index".format(reference))
+    # check if bwa index already created, if needed create directory (it
+    # might just be created by another sample of the batch)
+    bwa_index_folder = common.RunDir(os.path.join(path_name, "bwa"), True)
+    # samples run together share the index: the first one builds it, the
+    # others wait for the lock and find it ready
+    with common.file_lock(bwa_index_folder.join("{}.lock".format(base_name))):
+        # if needed soft link the reference
+        if not bwa_index_folder.exists(base_name):
+            #check and remove broken links
+            if os.path.lexists(bwa_index_folder.join(base_name)):
+                os.remove(bwa_index_folder.join(base_name))
+            returnValue = bwa_index_folder.run(["ln", "-s", reference,
+                base_name]).returncode
+            if not returnValue == 0:
+                sys.exit("error while trying to soft link reference sequence")
+        # now I have a soflinked copy
+        reference = os.path.join(path_name, "bwa", base_name)
+        # now check if index alredy build or not
+        if not os.path.exists("{}.bwt".format(reference)):
+            # then create the index sequence, under a temporary prefix so that
+            # an interrupted run does not leave a partial index behind
+            prefix = cache.temporary_name(reference)
+            command = [program, "index", "-p", prefix, reference]
+            common.print_command(command)
+            if not common.check_dryrun(sample_config):
+                returnValue = bwa_index_folder.run(command,
+                        stdout="bwa_index.stdOut",
+                        stderr="bwa_index.stdErr").returncode
+                if  not returnValue == 0:
+                    sys.exit("error, while indexing reference file {} "
+                            "with bwa index".format(reference))
+                # .bwt last, its presence tells that the index is complete
+                extensions = [".amb", ".ann", ".pac", ".sa", ".bwt"]
+                cache.commit_outputs(
+                        [prefix + extension for extension in extensions],
+                        [reference + extension for extension in extensions])
     #extra control to avoid problem with unexpected return value
     if not os.path.exists("{}.bwt".format(reference)):
         sys.exit("bwa index failed")
-    os.chdir(current_dir)
     return reference
 
 
 
 
-def align_bwa_mem(global_config, read1, read2, reference, threads, dryrun):
+def plan_alignments(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan, step, folder="alignments"):
+    """ adds to run_plan the tasks aligning the libraries (run in folder)
+    against the reference: index, split in shards (if asked), bwa mem and
+    sort, merge by insert size and picard statistics. Returns the
+    alignments as _merge_bam_files does"""
+    aligner  = _program(global_config, "bwa")
+    samtools = _program(global_config, "samtools")
+    picard   = _picard_home(global_config)
+    memory   = resources.memory(sample_config)
+    reference = os.path.abspath(sample_config["reference"])
+    path_name, base_name = os.path.split(reference)
+    index_folder = os.path.join(path_name, "bwa")
+    indexed = os.path.join(index_folder, base_name)
+    # make -j runs the libraries (or shards) together, each with its share
+    workers, library_threads, library_memory = _alignment_workers(
+            sample_config, sum(_shards(sample_config, libraryInfo) for
+            library, libraryInfo in sorted_libraries_by_insert))
+    run_plan.add("{}.bwa_index".format(step), step, index_folder,
+            [["ln", "-sf", reference, base_name], plan.shell([aligner,
+            "index", base_name], "bwa_index.stdOut", "bwa_index.stdErr")],
+            inputs=[reference], outputs=["{}{}".format(base_name, extension)
+            for extension in [".amb", ".ann", ".pac", ".sa", ".bwt"]],
+            memory=memory)
+    for library, libraryInfo in sorted_libraries_by_insert:
+        read1 = libraryInfo["pair1"]
+        read2 = libraryInfo["pair2"]
+        shards = _shards(sample_config, libraryInfo)
+        alignments = [(read1, read2, os.path.join(run_plan.workdir, folder))]
+        if shards > 1:
+            reads_dir = os.path.join(run_plan.workdir, folder,
+                    _library_base(read1, read2), "shards")
+            for read, pattern in zip([read1, read2],
+                    _shard_patterns(read1, read2)):
+                if read is None:
+                    continue
+                run_plan.add("{}.split.{}".format(step, os.path.basename(
+                    read)), step, reads_dir, ["set -o pipefail && {}".format(
+                    plan.shell(_split_command(read, shards, pattern),
+                    stderr="split.{}.stdErr".format(os.path.basename(read))))],
+                    inputs=[read], outputs=[pattern % shard for shard in
+                    range(shards)])
+            alignments = [(os.path.join(reads_dir, shard1), shard2 and
+                os.path.join(reads_dir, shard2), reads_dir) for shard1,
+                shard2 in _shard_names(read1, read2, shards)]
+        libraryInfo["alignment"] = []
+        for read1, read2, parent in alignments:
+            libraryBase, mappingBase = _alignment_names(read1, read2, indexed)
+            workdir = os.path.join(parent, libraryBase)
+            BAMsorted = "{}.bam".format(mappingBase)
+            # one line, $$ is the same shell: the bam is renamed once
+            # complete, the sort spills on the local disk of the node
+            BAMsorted_tmp = "tmp.$$.{}".format(BAMsorted)
+            sort_prefix = os.path.join("${SNIC_TMP:-${TMPDIR:-/tmp}}",
+                    "nougat.$$.{}".format(mappingBase))
+            run_plan.add("{}.bwa_mem.{}".format(step, libraryBase), step,
+                    workdir, ["set -o pipefail && {} && mv {} {}".format(
+                    plan.shell(_bwa_mem_sort_command(aligner, samtools, read1,
+                    read2, indexed, library_threads, library_memory,
+                    BAMsorted_tmp, sort_prefix), stderr="bwa.stdErr"),
+                    BAMsorted_tmp, BAMsorted)],
+                    inputs=[indexed + ".bwt", read1, read2],
+                    outputs=[BAMsorted], threads=library_threads,
+                    memory=library_memory)
+            libraryInfo["alignment"].append(os.path.join(workdir, BAMsorted))
+        if shards == 1:
+            libraryInfo["alignment"] = libraryInfo["alignment"][0]
+
+    BAMfiles = _alignments_by_insert(sorted_libraries_by_insert)
+    sorted_alignments_by_insert = []
+    for insert in sorted(BAMfiles):
+        insertGroup = BAMfiles[insert]
+        dir_insert, bamMerged = _merged_bam(sample_config, insert,
+                len(BAMfiles))
+        workdir = os.path.join(run_plan.workdir, folder, dir_insert)
+        if len(insertGroup) == 1:
+            command = ["ln", "-sf", insertGroup[0], bamMerged]
+        else:
+            command = _merge_command(samtools, sample_config, bamMerged,
+                    insertGroup)
+        BAMfile = os.path.join(workdir, bamMerged)
+        output_header = bamMerged.split(".bam")[0]
+        run_plan.add("{}.merge.{}".format(step, dir_insert), step, workdir,
+                [command], inputs=insertGroup, outputs=[bamMerged],
+                memory=memory)
+        for name, command, log, outputs in [
+                ("collectGcBias", _picard_CGbias_command(picard,
+                    sample_config, BAMfile), "collectGcBias",
+                    [".collectGcBias.txt", ".collectGcBias.pdf"]),
+                ("collectInsertSize",
+                    _picard_collectInsertSizeMetrics_command(picard,
+                    sample_config, BAMfile, insert), "collectInsertSize",
+                    [".collectInsertSize.txt",
+                    ".collectInsertSize.pdf"]),
+                ("markDuplicates", _picard_markDuplicates_command(picard,
+                    sample_config, BAMfile), "removeDup",
+                    ["_noDup.bam", ".markDuplicates.txt"])]:
+            run_plan.add("{}.{}.{}".format(step, name, dir_insert), step,
+                    workdir, [plan.shell(command, "{}.stdOut".format(log),
+                    "{}.stdErr".format(log))], inputs=[BAMfile],
+                    outputs=["{}{}".format(output_header, output) for output
+                    in outputs], memory=memory)
+        sorted_alignments_by_insert.append([insert, BAMfile, dir_insert])
+    return sorted_alignments_by_insert
+
+
+def _program(global_config, tool):
+    """ the binary of tool: the one in the global config, otherwise the one
+    on the PATH"""
+    if tool in global_config["Tools"]:
+        return global_config["Tools"][tool]["bin"]
+    return tool
+
+
+def align_bwa_mem(global_config, read1, read2, reference, threads, dryrun,
+        memory=None, run_dir=None, streaming=True, budget=None):
+    """ aligns a library with bwa mem and sorts it in a folder of run_dir (a
+    common.RunDir, by default the current directory), the sort buffers are
+    sized on memory (MB, by default the memory granted to the run). With
+    streaming the sort reads the output of bwa mem, otherwise (samtools
+    older than 1.0) it sorts an unsorted bam written first. The threads are
+    taken from budget (a resources.ThreadBudget) when one is shared with
+    other alignments"""
+    if memory is None:
+        memory = resources.detect_allocation().memory
+    if run_dir is None:
+        run_dir = common.RunDir(os.getcwd())
     aligner = "bwa"
     if "bwa" in global_config["Tools"]:
         aligner = global_config["Tools"]["bwa"]["bin"]
@@ -272,59 +622,176 @@ def align_bwa_mem(global_config, read1, read2, reference, threads, dryrun):
                 "path and not in global config, please make sure to install "
                 "bwa properly")
 
-    # extract base name
-    libraryBase = ""
-    if read2:
-        libraryBase = os.path.basename(read1).split("_1.fastq")[0]
+    libraryBase, mappingBase = _alignment_names(read1, read2, reference)
+    library_dir = run_dir.subdir(libraryBase)
+    BAMsorted   = library_dir.join("{}.bam".format(mappingBase))
+    BAMunsorted = library_dir.join("{}.unsorted.bam".format(mappingBase))
+
+    bwa_mem_command, samtools_view_command, samtools_sort_command = \
+            _bwa_mem_commands(aligner, samtools, read1, read2, reference,
+            threads, memory, BAMunsorted, mappingBase)
+    # the same step in both modes: an alignment is not redone by the other
+    step = cache.StepCache(bwa_mem_command + ["|"] + samtools_view_command +
+            ["|"] + samtools_sort_command, inputs=[reference, read1, read2],
+            outputs=[BAMsorted], tools=[aligner, samtools])
+    if step.done():
+        return BAMsorted
+    if budget is None:
+        budget = resources.ThreadBudget(threads)
+    # rather than waiting for all the threads, start with the ones left by
+    # a library sorting (thread counts do not change the step)
+    with budget.grant(threads, max(1, threads // 2)) as grant:
+        if streaming:
+            _align_bwa_mem_streaming(aligner, samtools, read1, read2,
+                    reference, grant.threads, memory, library_dir,
+                    mappingBase, step, dryrun)
+        else:
+            _align_bwa_mem_two_pass(aligner, samtools, read1, read2,
+                    reference, memory, library_dir, mappingBase, step, dryrun,
+                    grant)
+    return BAMsorted
+
+
+def _align_bwa_mem_two_pass(aligner, samtools, read1, read2, reference,
+        memory, library_dir, mappingBase, step, dryrun, grant):
+    """ bwa mem writing an unsorted bam, then samtools sort. Once aligned
+    grant (of a resources.ThreadBudget) keeps only the share of the threads
+    of a sort running next to bwa mem, which the sort runs with"""
+    BAMsorted   = library_dir.join("{}.bam".format(mappingBase))
+    BAMunsorted = library_dir.join("{}.unsorted.bam".format(mappingBase))
+    bwa_mem_command, samtools_view_command, samtools_sort_command = \
+            _bwa_mem_commands(aligner, samtools, read1, read2, reference,
+            grant.threads, memory, BAMunsorted, mappingBase)
+    # the unsorted bam is renamed only once complete
+    if not os.path.exists(BAMunsorted):
+        BAMunsorted_tmp = cache.temporary_name(BAMunsorted)
+        command = "{} | {} > {}".format(" ".join(bwa_mem_command),
+                " ".join(samtools_view_command), BAMunsorted_tmp)
+        common.print_command(command)
+        if not dryrun:
+            returnValue = library_dir.run(command, stdout="bwa.stdOut",
+                    stderr="bwa.stdErr").returncode
+            if returnValue == 0:
+                cache.commit_outputs([BAMunsorted_tmp], [BAMunsorted])
+
+    # the sort mostly waits on the disk, the next library can align meanwhile
+    grant.shrink(_sort_threads(grant.threads))
+    samtools_sort_command = _bwa_mem_commands(aligner, samtools, read1,
+            read2, reference, grant.threads, memory, BAMunsorted,
+            mappingBase)[2]
+    # samtools sort adds .bam to the output prefix
+    sorted_prefix = cache.temporary_name(library_dir.join(mappingBase))
+    samtools_sort_command[-1] = sorted_prefix
+    command = " ".join(samtools_sort_command)
+    common.print_command(command)
+    if not dryrun and os.path.exists(BAMunsorted):
+        returnValue = library_dir.run(command, stdout="sam_sort.stdOut",
+                stderr="sam_sort.stdErr").returncode
+        if returnValue == 0:
+            cache.commit_outputs(["{}.bam".format(sorted_prefix)],
+                    [BAMsorted])
+            step.record()
+            library_dir.run(["rm", BAMunsorted])
+
+
+def _align_bwa_mem_streaming(aligner, samtools, read1, read2, reference,
+        threads, memory, library_dir, mappingBase, step, dryrun):
+    """ bwa mem piped into samtools sort: no unsorted bam is written, the
+    sort spills to the node-local temporary folder and its output is renamed
+    only once the whole pipe succeeded"""
+    BAMsorted = library_dir.join("{}.bam".format(mappingBase))
+    BAMsorted_tmp = cache.temporary_name(BAMsorted)
+    sort_prefix = os.path.join(resources.local_tmp_dir(),
+            "nougat.{}.{}".format(os.getpid(), mappingBase))
+    command = _bwa_mem_sort_command(aligner, samtools, read1, read2,
+            reference, threads, memory, BAMsorted_tmp, sort_prefix)
+    common.print_command(command)
+    if dryrun:
+        return
+    # without pipefail a failing bwa mem would leave a truncated bam
+    returnValue = library_dir.run(["bash", "-o", "pipefail", "-c", command],
+            stdout="bwa.stdOut", stderr="bwa.stdErr").returncode
+    if returnValue == 0:
+        cache.commit_outputs([BAMsorted_tmp], [BAMsorted])
+        step.record()
     else:
-        libraryBase = os.path.basename(read1).split(".fastq")[0]
+        print("error while aligning {}: bwa mem or samtools sort failed, "
+                "see {}".format(mappingBase, library_dir.join("bwa.stdErr")))
+        for path in [BAMsorted_tmp] + glob.glob("{}.*.bam".format(
+                sort_prefix)):
+            if os.path.exists(path):
+                os.remove(path)
+
 
-    if not os.path.exists(libraryBase):
-        os.makedirs(libraryBase)
-    os.chdir(libraryBase)
+def _alignment_names(read1, read2, reference):
+    """ folder of a library and base name of its alignment"""
+    libraryBase = _library_base(read1, read2)
     mappingBase = "{}_to_{}".format(libraryBase,
             os.path.basename(reference).split(".fasta")[0])
-    BAMsorted   = "{}.bam".format(mappingBase)
-    BAMunsorted = "{}.unsorted.bam".format(mappingBase)
-    SAMMapped   = "{}.unsorted.sam".format(mappingBase)
-    if os.path.exists(os.path.abspath(BAMsorted)):
-        BAMsorted = os.path.abspath(BAMsorted)
-        os.chdir("..")
-        return BAMsorted
+    return libraryBase, mappingBase
+
+
+def _library_base(read1, read2):
+    if read2:
+        return os.path.basename(read1).split("_1.fastq")[0]
+    return os.path.basename(read1).split(".fastq")[0]
+
 
+def _alignment_bam(run_dir, read1, read2, reference):
+    """ the sorted alignment align_bwa_mem writes in run_dir"""
+    libraryBase, mappingBase = _alignment_names(read1, read2, reference)
+    return run_dir.join(libraryBase, "{}.bam".format(mappingBase))
 
+
+def _bwa_mem_commands(aligner, samtools, read1, read2, reference, threads,
+        memory, BAMunsorted, mappingBase):
+    """ bwa mem, samtools view (sam to unsorted bam) and samtools sort
+    commands of a library"""
     bwa_mem_command = [aligner, "mem", "-M", "-t", "{}".format(threads),
             reference, read1, read2]
     samtools_view_command = [samtools, "view", "-b", "-S",  "-u",  "-"]
+    samtools_sort_command = [samtools, "sort", "-@", "{}".format(threads),
+            "-m" , resources.sort_memory(memory, threads), BAMunsorted,
+            mappingBase]
+    return bwa_mem_command, samtools_view_command, samtools_sort_command
+
+
+def _bwa_mem_memory(reference, threads):
+    """ MB needed by bwa mem: its index (estimated from the reference when
+    not built yet) and a batch of reads per thread"""
+    index = ["{}{}".format(reference, extension) for extension in [".bwt",
+        ".sa", ".pac"]]
+    if all(os.path.exists(path) for path in index):
+        size = sum(os.path.getsize(path) for path in index)
+    elif os.path.exists(reference):
+        size = os.path.getsize(reference) * BWA_INDEX_FACTOR
+    else:
+        size = 0
+    return int(size / (1024 * 1024)) + BWA_THREAD_MEMORY * threads
 
-    if not os.path.exists(BAMunsorted):
-        command = "{} | {} > {}".format(" ".join(bwa_mem_command),
-                " ".join(samtools_view_command), BAMunsorted)
-        bwa_stdOut       = open("bwa.stdOut", "w")
-        bwa_stdErr       = open("bwa.stdErr", "w")
-        common.print_command(command)
-        if not dryrun:
-            subprocess.call(command, shell=True, stdout=bwa_stdOut,
-                    stderr=bwa_stdErr)
 
-    samtools_sort_command = [samtools, "sort", "-@", "{}".format(threads),
-            "-m" , "1G", BAMunsorted,  mappingBase]
-    command = " ".join(samtools_sort_command)
-    if not os.path.exists(BAMsorted):
-        stdOut       = open("sam_sort.stdOut", "w")
-        stdErr       = open("sam_sort.stdErr", "w")
-        common.print_command(command)
-        if not dryrun:
-            subprocess.call(command, shell=True, stdout=stdOut, stderr=stdErr)
+def _sort_threads(threads):
+    return max(1, threads // SORT_THREADS_DIVISOR)
 
-    if os.path.exists(BAMsorted) and os.path.exists(BAMunsorted):
-        subprocess.call(["rm", BAMunsorted])
-    BAMsorted = os.path.abspath(BAMsorted)
-    os.chdir("..")
-    return BAMsorted
+
+def _bwa_mem_sort_command(aligner, samtools, read1, read2, reference,
+        threads, memory, output, sort_prefix):
+    """ bwa mem piped into samtools sort writing output, the sort spills to
+    sort_prefix.NNNN.bam. The sort gets a share of the threads and the
+    memory bwa mem does not need, bwa mem the rest of the threads"""
+    sort_threads = _sort_threads(threads)
+    bwa_threads = max(1, threads - sort_threads)
+    sort_memory = max(0, memory - _bwa_mem_memory(reference, bwa_threads))
+    bwa_mem_command = [aligner, "mem", "-M", "-t", "{}".format(bwa_threads),
+            reference, read1, read2]
+    samtools_sort_command = [samtools, "sort", "-@", "{}".format(sort_threads),
+            "-m", resources.sort_memory(sort_memory, sort_threads), "-T",
+            sort_prefix, "-o", output, "-"]
+    return "{} | {}".format(plan._command_string(bwa_mem_command),
+            plan._command_string(samtools_sort_command))
 
 
-def align_bwa(read1, read2, reference):
+def align_bwa(read1, read2, reference, run_dir=None):
     aligner = "bwa"
     if "bwa" in global_config["Tools"]:
         program = global_config["Tools"]["bwa"]["bin"]
@@ -345,33 +812,31 @@ def align_bwa(read1, read2, reference):
     if read2:
         libraryBase = "{}_{}".format(libraryBase.split("_")[0],
                 libraryBase.split("_")[1])
-    if not os.path.exists(libraryBase):
-        os.makedirs(libraryBase)
-    os.chdir(libraryBase)
+    if run_dir is None:
+        run_dir = common.RunDir(os.getcwd())
+    library_dir = run_dir.subdir(libraryBase)
     mappingBase = "{}_to_{}".format(libraryBase,
             os.path.basename(reference).split(".fasta")[0])
-    BAMsorted   = "{}.bam".format(mappingBase)
-    BAMunsorted = "{}.unsorted.bam".format(mappingBase)
-    if os.path.exists(os.path.abspath(BAMsorted)):
-        BAMsorted = os.path.abspath(BAMsorted)
-        os.chdir("..")
+    BAMsorted   = library_dir.join("{}.bam".format(mappingBase))
+    BAMunsorted = library_dir.join("{}.unsorted.bam".format(mappingBase))
+    if os.path.exists(BAMsorted):
         return BAMsorted
 
     if not os.path.exists(BAMunsorted):
-        bwaAln_1 = "{}_1.sai".format(mappingBase);
-        bwaAln_2 = "{}_2.sai".format(mappingBase);
-        if not os.path.exists("{}_1.sai".format(mappingBase)):
+        bwaAln_1 = library_dir.join("{}_1.sai".format(mappingBase));
+        bwaAln_2 = library_dir.join("{}_2.sai".format(mappingBase));
+        if not os.path.exists(bwaAln_1):
             with open(bwaAln_1, "w") as fh:
-                returnValue = subprocess.call(["bwa", "aln", "-t", "8",
-                    reference, read1], stdout=fh)
+                returnValue = library_dir.run(["bwa", "aln", "-t", "8",
+                    reference, read1], stdout=fh).returncode
                 if  not returnValue == 0:
                     sys.exit("error, while aligning read {} \
                             against {}".format(read1, reference))
         if read2:
-            if not os.path.exists("{}_2.sai".format(mappingBase)):
+            if not os.path.exists(bwaAln_2):
                 with open(bwaAln_2, "w") as fh:
-                    returnValue = subprocess.call(["bwa", "aln", "-t",
-                        "8", reference, read2], stdout=fh)
+                    returnValue = library_dir.run(["bwa", "aln", "-t",
+                        "8", reference, read2], stdout=fh).returncode
                     if  not returnValue == 0:
                         sys.exit("error, while aligning read {} \
                                 against {}".format(read1, reference))
@@ -380,24 +845,18 @@ def align_bwa(read1, read2, reference):
                 cl1 = ["bwa", "sampe", "-P", "-s",  reference, bwaAln_1,
                         bwaAln_2, read1, read2]
                 cl2 = ["samtools", "view", "-Shb", "-F", "4", "-"]
-                p1 = subprocess.Popen(cl1, stdout=subprocess.PIPE)
-                p2 = subprocess.Popen(cl2, stdin=p1.stdout,
-                        stdout=fh).communicate()
-                p1.stdout.close()
+                library_dir.run("{} | {}".format(" ".join(cl1),
+                    " ".join(cl2)), stdout=fh)
             else:
                 cl1 = ["bwa", "samse",  reference, bwaAln_1, read1]
                 cl2 = ["samtools", "view", "-Shb", "-F", "4", "-"]
-                p1 = subprocess.Popen(cl1, stdout=subprocess.PIPE)
-                p2 = subprocess.Popen(cl2, stdin=p1.stdout,
-                        stdout=fh).communicate()
-                p1.stdout.close()
+                library_dir.run("{} | {}".format(" ".join(cl1),
+                    " ".join(cl2)), stdout=fh)
 
-    subprocess.call(["rm", bwaAln_1, bwaAln_2])
+    library_dir.run(["rm", bwaAln_1, bwaAln_2])
     BAMsortedHeader = "{}".format(mappingBase)
-    subprocess.call(["samtools", "sort",  BAMunsorted, BAMsortedHeader])
-    subprocess.call(["rm", BAMunsorted])
-    BAMsorted = os.path.abspath(BAMsorted)
-    os.chdir("..")
+    library_dir.run(["samtools", "sort",  BAMunsorted, BAMsortedHeader])
+    library_dir.run(["rm", BAMunsorted])
     return BAMsorted
 
 
@@ -414,12 +873,9 @@ def _run_pileup(global_config, bamfile):
                 "install samtools properly")
 
     pileupfile = bamfile.replace('.bam', '_coverage.csv')
-    pileup_cmd = "{} mpileup {} | awk '{print $2, $4}' > {}".format(samtools,
+    pileup_cmd = "{} mpileup {} | awk '{{print $2, $4}}' > {}".format(samtools,
             bamfile, pileupfile)
-    p1 = subprocess.Popen(pileup_cmd, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-    p1.wait()
-    if p1.returncode == 0:
+    if common.run_command(pileup_cmd).returncode == 0:
         return pileupfile
     else:
         print("Could not perform mpileup")
@@ -430,6 +886,8 @@ def plot_coverage(pileupfile, samplename=None):
     """
     Plot coverage from samtools pileup output
     """
+    import pandas as pd
+    plt = common.pyplot()
     if not samplename:
         samplename = pileupfile.split('.')[0]
 
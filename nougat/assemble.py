@@ -1,13 +1,26 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, yaml, glob
-import subprocess
 import string
 import sys
-from nougat import common
+import time
+import json
+import copy
+from collections import OrderedDict
+from nougat import common, cache, resources, plan
+from nougat import journal as step_journal
 
+# outputs of a completed assembler run, <output>.<extension> in its folder;
+# the assemblers not listed write a contig and a scaffold fasta
+ASSEMBLY_OUTPUTS = {
+    "trinity": ["fasta", "isoforms.results", "genes.results"],
+    "abyss_mergePairs": []}
 
-def run(global_config, sample_config):
+
+def run(global_config, sample_config, journal=None):
+    if journal is None:
+        journal = step_journal.Journal()
+    sample_config = journal.replay(sample_config)
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     #Check if the user has specified tools, if not select default list of tools
     if "tools" not in sample_config or len(sample_config["tools"]) == 0:
@@ -16,38 +29,376 @@ def run(global_config, sample_config):
     for command in sample_config["tools"]:
         command_fn = getattr( sys.modules[__name__] ,
                 "_run_{}".format(command))
+        if journal.done(command):
+            continue
+        before = copy.deepcopy(sample_config)
+        start = time.time()
+        journal.started(command)
+        common.set_profile_step(command)
+        assemblyDirectory = common.run_dir(sample_config).join(command)
+        step = _assembly_step(global_config, sample_config, command,
+                assemblyDirectory)
+        if os.path.exists(assemblyDirectory) and not step.done() and \
+                not common.check_dryrun(sample_config):
+            _check_assembly_folder(step, command, sample_config,
+                    assemblyDirectory)
         sample_config = command_fn(global_config, sample_config,
                 sorted_libraries_by_insert)
+        outputs = [output for output in _assembly_outputs(command,
+            sample_config, assemblyDirectory) if os.path.exists(output)]
+        if _assembly_complete(command, sample_config, assemblyDirectory) \
+                and not step.done():
+            step.record(outputs)
+        journal.record_step(command, before, sample_config, start, outputs)
+
+
+def plan_steps(global_config, sample_config, run_plan):
+    """ adds to run_plan the tasks run() would execute, without touching
+    the filesystem"""
+    tools = sample_config.get("tools") or ["soapdenovo"]
+    for assembler in tools:
+        sorted_libraries_by_insert = common._sort_libraries_by_insert(
+                sample_config)
+        plan_fn = getattr(sys.modules[__name__], "_plan_{}".format(assembler))
+        plan_fn(global_config, sample_config, sorted_libraries_by_insert,
+                run_plan)
+    return run_plan
+
+
+def _plan_assembly(run_plan, assembler, sample_config,
+        sorted_libraries_by_insert, commands, outputs=None, files=None):
+    """ adds the task of assembler, run in its assembly folder"""
+    if outputs is None:
+        outputs = ["{}.{}".format(sample_config["output"], extension) for
+                extension in ["ctg.fasta", "scf.fasta"]]
+    run_plan.add(assembler, assembler, assembler, commands,
+            inputs=[libraryInfo[pair] for library, libraryInfo in
+            sorted_libraries_by_insert for pair in ["pair1", "pair2"]],
+            outputs=outputs, files=files,
+            threads=resources.threads(sample_config),
+            memory=resources.memory(sample_config))
+
+
+def _plan_cleanup(sample_config, folder):
+    """ removal of the assembler working folder, unless kept"""
+    if "keep_tmp_files" in sample_config.get("flags", []):
+        return []
+    return [["rm", "-r", folder]]
+
+
+def _plan_data_links(run_plan, assembler, sorted_libraries_by_insert):
+    """ commands soft linking the reads in the DATA folder as
+    common.prepare_folder_structure does, and the libraries pointing to
+    the links"""
+    DataFolder = os.path.join(run_plan.workdir, assembler, "DATA")
+    commands = [["mkdir", "-p", DataFolder]]
+    linked = []
+    type = ["SE", "PE", "MP"]
+    for number, (library, libraryInfo) in enumerate(
+            sorted_libraries_by_insert, 1):
+        libraryInfo = dict(libraryInfo)
+        for pair, pairNumber in [("pair1", 1), ("pair2", 2)]:
+            newName = common._new_name(libraryInfo[pair],
+                    libraryInfo["orientation"], type, number, pairNumber,
+                    DataFolder)
+            if newName is not None:
+                commands.append(["ln", "-s", libraryInfo[pair], newName])
+            libraryInfo[pair] = newName
+        linked.append((library, libraryInfo))
+    return commands, linked
+
+
+def _plan_abyss(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    program = os.path.join(global_config["Tools"]["abyss"]["bin"],
+            "abyss-pe")
+    command = _abyss_command(program, resources.threads(sample_config),
+            sample_config.get("kmer", 54), outputName,
+            sorted_libraries_by_insert)
+    commands = [["mkdir", "-p", "runABySS"], "cd runABySS && {}".format(
+        plan.shell(command, "../abyss.stdOut", "../abyss.stdErr", "a")),
+        ["cp", os.path.join("runABySS", "{}-contigs.fa".format(outputName)),
+            "{}.ctg.fasta".format(outputName)],
+        ["cp", os.path.join("runABySS", "{}-scaffolds.fa".format(
+            outputName)), "{}.scf.fasta".format(outputName)]]
+    commands.extend(_plan_cleanup(sample_config, "runABySS"))
+    _plan_assembly(run_plan, "abyss", sample_config,
+            sorted_libraries_by_insert, commands)
+
+
+def _plan_allpaths(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    programBIN = global_config["Tools"]["allpaths"]["bin"]
+    inputs = _allpaths_inputs(sorted_libraries_by_insert)
+    ploidy = _allpaths_ploidy(global_config["Tools"]["allpaths"]["options"])
+    if inputs is None or ploidy is None:
+        print("allpaths cannot be run on this sample, not planned")
+        return
+    data_dir = os.path.join(run_plan.workdir, "allpaths", "data_dir")
+    assembly_dir = os.path.join("data_dir", "allpaths", "ASSEMBLIES", "run")
+    commands = [["mkdir", "-p", "data_dir"],
+            plan.shell(_allpaths_prepare_command(global_config, data_dir,
+            ploidy), "allpaths_PrepareAllPathsInputs.stdOut",
+            "allpaths_PrepareAllPathsInputs.stdErr"),
+            plan.shell(_allpaths_run_command(programBIN),
+            "allpaths_RunAllPathsLG.stdOut", "allpaths_RunAllPathsLG.stdErr"),
+            ["cp", os.path.join(assembly_dir, "final.contigs.fasta"),
+            "{}.ctg.fasta".format(outputName)],
+            ["cp", os.path.join(assembly_dir, "final.assembly.fasta"),
+            "{}.scf.fasta".format(outputName)]]
+    commands.extend(_plan_cleanup(sample_config, "data_dir"))
+    _plan_assembly(run_plan, "allpaths", sample_config,
+            sorted_libraries_by_insert, commands, files=inputs)
+
+
+def _plan_cabog(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    programBIN = global_config["Tools"]["cabog"]["bin"]
+    commands = [plan.shell(_cabog_fastqToCA_command(programBIN, outputName,
+        number, libraryInfo), stderr="cabogfastqToCA.stdErr") for number,
+        (library, libraryInfo) in enumerate(sorted_libraries_by_insert, 1)]
+    commands.append(plan.shell(_cabog_runCA_command(programBIN, outputName),
+        "cabog_runCA.stdOut", "cabog_runCA.stdErr"))
+    for extension in ["ctg.fasta", "scf.fasta"]:
+        commands.append(["mv", os.path.join("runCABOGfolder", "9-terminator",
+            "{}.{}".format(outputName, extension)),
+            "{}.{}".format(outputName, extension)])
+    commands.extend(_plan_cleanup(sample_config, "runCABOGfolder"))
+    _plan_assembly(run_plan, "cabog", sample_config,
+            sorted_libraries_by_insert, commands)
+
+
+def _plan_masurca(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    command, assemble_command = _masurca_commands(
+            global_config["Tools"]["masurca"]["bin"])
+    commands = [["mkdir", "-p", "runMASURCA"],
+            "cd runMASURCA && {}".format(plan.shell(command,
+            "../masurca.stdOut", "../masurca.stdErr")),
+            "cd runMASURCA && {}".format(plan.shell(assemble_command,
+            "../masurca.stdOut", "../masurca.stdErr", "a"))]
+    for extension in ["ctg.fasta", "scf.fasta"]:
+        commands.append(["cp", os.path.join("runMASURCA",
+            "CA/10-gapclose/genome.{}".format(extension)),
+            "{}.{}".format(outputName, extension)])
+    commands.extend(_plan_cleanup(sample_config, "runMASURCA"))
+    _plan_assembly(run_plan, "masurca", sample_config,
+            sorted_libraries_by_insert, commands, files={"configuration.txt":
+            _masurca_configuration(sample_config, sorted_libraries_by_insert)})
+
+
+def _plan_soapdenovo(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    command = _soapdenovo_command(global_config["Tools"]["soapdenovo"]["bin"],
+            sample_config.get("kmer", 54), resources.threads(sample_config))
+    commands = [["mkdir", "-p", "runSOAP"], "cd runSOAP && {}".format(
+        plan.shell(command, "../soap.stdOut", "../soap.stdErr")),
+        ["mv", os.path.join("runSOAP", "soapAssembly.scafSeq"),
+            "{}.scf.fasta".format(outputName)],
+        ["mv", os.path.join("runSOAP", "soapAssembly.contig"),
+            "{}.ctg.fasta".format(outputName)]]
+    commands.extend(_plan_cleanup(sample_config, "runSOAP"))
+    _plan_assembly(run_plan, "soapdenovo", sample_config,
+            sorted_libraries_by_insert, commands, files={"configuration.txt":
+            _soapdenovo_configuration(sorted_libraries_by_insert)})
+
+
+def _plan_spades(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    command = _spades_command(global_config["Tools"]["spades"]["bin"],
+            global_config["Tools"]["spades"]["options"], outputName,
+            sorted_libraries_by_insert)
+    commands = [plan.shell(command, "spades.stdOut", "spades.stdErr", "a"),
+            ["cp", os.path.join(outputName, "contigs.fasta"),
+            "{}.ctg.fasta".format(outputName)],
+            ["cp", os.path.join(outputName, "scaffolds.fasta"),
+            "{}.scf.fasta".format(outputName)]]
+    commands.extend(_plan_cleanup(sample_config, outputName))
+    _plan_assembly(run_plan, "spades", sample_config,
+            sorted_libraries_by_insert, commands)
+
+
+def _plan_trinity(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    outputName = sample_config["output"]
+    commands, linked = _plan_data_links(run_plan, "trinity",
+            sorted_libraries_by_insert)
+    trinity_commands = _trinity_commands(global_config, sample_config,
+            linked)
+    if trinity_commands is None:
+        print("trinity cannot be run on this sample, not planned")
+        return
+    command, abundance_command = trinity_commands
+    commands.append(plan.shell(command, "trinity.stdOut", "trinity.stdErr"))
+    commands.append("cd trinity && {}".format(plan.shell(abundance_command,
+        "../trinity.stdOut", "../trinity.stdErr", "a")))
+    outputs = []
+    for result, extension in [("Trinity.fasta", "fasta"),
+            ("RSEM.isoforms.results", "isoforms.results"),
+            ("RSEM.genes.results", "genes.results")]:
+        outputs.append("{}.{}".format(outputName, extension))
+        commands.append(["cp", os.path.join("trinity", result), outputs[-1]])
+    _plan_assembly(run_plan, "trinity", sample_config,
+            sorted_libraries_by_insert, commands, outputs)
+
+
+def _plan_abyss_mergePairs(global_config, sample_config,
+        sorted_libraries_by_insert, run_plan):
+    assembler = "abyss_mergePairs"
+    programBIN = global_config["Tools"][assembler]["bin"]
+    program_options = global_config["Tools"][assembler]["options"]
+    if assembler in sample_config:
+        program_options = sample_config[assembler]
+    commands, linked = _plan_data_links(run_plan, assembler,
+            sorted_libraries_by_insert)
+    outputs = []
+    for library, libraryInfo in linked:
+        read1 = libraryInfo["pair1"]
+        read2 = libraryInfo["pair2"]
+        if libraryInfo["orientation"] != "innie" or read2 is None:
+            continue
+        outputName = _abyss_mergePairs_output(read1)
+        commands.append(plan.shell(_abyss_mergePairs_command(programBIN,
+            program_options, outputName, read1, read2),
+            "mergePairs_{}.stdOut".format(outputName),
+            "mergePairs_{}.stdErr".format(outputName), "a"))
+        commands.append(["mv", "mergePairs_{}.stdErr".format(outputName),
+            "{}.txt".format(outputName)])
+        outputs.append("{}.txt".format(outputName))
+    _plan_assembly(run_plan, assembler, sample_config,
+            sorted_libraries_by_insert, commands, outputs)
+
+
+def _assembly_step(global_config, sample_config, assembler,
+        assemblyDirectory):
+    """ step cache of an assembler: options, reads and binaries, recorded
+    next to the assembly folder"""
+    libraries = common._sort_libraries_by_insert(sample_config)
+    settings = [global_config["Tools"].get(assembler),
+            sample_config.get(assembler)]
+    settings.extend(sample_config.get(key) for key in ["kmer", "genomeSize",
+        "output"])
+    settings.extend([libraryInfo.get(key) for library, libraryInfo in
+        libraries for key in ["orientation", "insert", "std"]])
+    command = [assembler, json.dumps(settings, sort_keys=True)]
+    reads = [libraryInfo[pair] for library, libraryInfo in libraries
+            for pair in ["pair1", "pair2"]]
+    tools = []
+    if "bin" in global_config["Tools"].get(assembler, {}):
+        tools.append(global_config["Tools"][assembler]["bin"])
+    return cache.StepCache(command, inputs=reads, tools=tools,
+            manifest="{}{}".format(assemblyDirectory,
+            cache.STEP_CACHE_SUFFIX))
+
+
+def _check_assembly_folder(step, assembler, sample_config,
+        assemblyDirectory):
+    """ adopts the complete assembly of a folder written before the step
+    caches, moves aside one left by a crashed run or computed from different
+    data/options so that it is assembled again"""
+    if not os.path.exists(step.manifest) and _assembly_complete(assembler,
+            sample_config, assemblyDirectory):
+        print("assembler {} folder computed by an earlier version, "
+                "using its assembly".format(assembler))
+        step.record(_assembly_outputs(assembler, sample_config,
+            assemblyDirectory))
+        return
+    stale = "{}.stale.{}".format(assemblyDirectory, int(time.time()))
+    print("assembler {} folder does not match a completed run, "
+            "moved to {}".format(assembler, stale))
+    os.rename(assemblyDirectory, stale)
+
+
+def _assembly_outputs(assembler, sample_config, assemblyDirectory):
+    """ the files a completed run of assembler leaves in its folder"""
+    outputName = sample_config["output"]
+    extensions = ASSEMBLY_OUTPUTS.get(assembler, ["ctg.fasta", "scf.fasta"])
+    return [os.path.join(assemblyDirectory, "{}.{}".format(outputName,
+        extension)) for extension in extensions]
+
+
+def _assembly_complete(assembler, sample_config, assemblyDirectory):
+    outputs = _assembly_outputs(assembler, sample_config, assemblyDirectory)
+    return len(outputs) > 0 and all(os.path.exists(output) for output in
+            outputs)
+
+
+def _save_assembly(assembly_dir, results, program="cp"):
+    """ copies (or moves, with program mv) the results of an assembler,
+    (source, output) pairs relative to assembly_dir, under temporary names
+    renamed once all of them are complete. Returns the exit code"""
+    temporaries = [cache.temporary_name(assembly_dir.join(output)) for
+            source, output in results]
+    for (source, output), temporary in zip(results, temporaries):
+        exit_code = assembly_dir.run([program, source, temporary]).returncode
+        if exit_code != 0:
+            for temporary in temporaries:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+            return exit_code
+    cache.commit_outputs(temporaries, [assembly_dir.join(output) for
+        source, output in results])
+    return 0
 
 
 def _run_abyss(global_config, sample_config, sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler                  = "abyss"
     outputName                 = sample_config["output"]
-    currentDirectory           = os.getcwd()
-    assemblyDirectory          = os.path.join(currentDirectory, assembler)
+    assemblyDirectory          = common.run_dir(sample_config).join(assembler)
     # in abyss case there is no exectuable
     programBIN                 = global_config["Tools"][assembler]["bin"]
     program_options            = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure("abyss", assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
-    assembler_stdOut = open("abyss.stdOut", "a")
-    assembler_stdErr = open("abyss.stdErr", "a")
     program=os.path.join(programBIN, "abyss-pe")
+    command = _abyss_command(program, resources.threads(sample_config),
+            sample_config.get("kmer", 54), outputName,
+            sorted_libraries_by_insert)
+
+    common.print_command(command)
+    if common.check_dryrun(sample_config):
+        return sample_config
 
+    returnValue = 0
+    returnValue = assembly_dir.subdir("runABySS").run(command,
+            stdout="../abyss.stdOut", stderr="../abyss.stdErr",
+            mode="a").returncode
+    flags = sample_config.get("flags", [])
+    if returnValue == 0 and not common.check_dryrun(sample_config):
+        if assembly_dir.exists("runABySS","{}-contigs.fa".format(
+            outputName)):
+            exit_code = _save_assembly(assembly_dir, [
+                (os.path.join("runABySS", "{}-contigs.fa".format(outputName)),
+                    "{}.ctg.fasta".format(outputName)),
+                (os.path.join("runABySS", "{}-scaffolds.fa".format(
+                    outputName)), "{}.scf.fasta".format(outputName))])
+            if not "keep_tmp_files" in flags and exit_code == 0:
+                assembly_dir.run(["rm", "-r", "runABySS"])
+        elif not common.check_dryrun(sample_config):
+            print("something wrong with ABySS -> no contig file generated")
+            return sample_config
+    else:
+        print("ABySS terminated with an error. Please check running folder",
+                "for more informations")
+    return sample_config
+
+
+def _abyss_command(program, threads, kmer, outputName,
+        sorted_libraries_by_insert):
     command = ""
     command += "{} ".format(program)
-    threads = 8 # default for UPPMAX
-    if "threads" in sample_config :
-        threads = sample_config["threads"]
     command += "np={} ".format(threads)
-    kmer = 54
-    if "kmer" in sample_config:
-        kmer = sample_config["kmer"]
     command += "k={} ".format(kmer)
 
     libraries = {}
@@ -103,58 +454,80 @@ def _run_abyss(global_config, sample_config, sorted_libraries_by_insert):
     command += "{} ".format(librariesSE)
     command += "{} ".format(librariesPE)
     command += "{} ".format(librariesMP)
-
-    common.print_command(command)
-    if common.check_dryrun(sample_config):
-        os.chdir("..")
-        return sample_config
-
-    os.makedirs(os.path.join(assemblyDirectory, "runABySS"))
-    os.chdir("runABySS")
-    returnValue = 0
-    returnValue = subprocess.call(command, stdout=assembler_stdOut,
-            stderr=assembler_stdErr, shell=True)
-    os.chdir("..")
-    flags = sample_config.get("flags", [])
-    if returnValue == 0 and not common.check_dryrun(sample_config):
-        if os.path.exists(os.path.join("runABySS","{}-contigs.fa".format(
-            outputName))):
-            subprocess.call(["cp", os.path.join("runABySS",
-                "{}-contigs.fa".format(outputName)),
-                "{}.ctg.fasta".format(outputName) ])
-            subprocess.call(["cp", os.path.join("runABySS",
-                "{}-scaffolds.fa".format(outputName)),
-                "{}.scf.fasta".format(outputName) ])
-            if not "keep_tmp_files" in flags:
-                subprocess.call(["rm", "-r", "runABySS"])
-        elif not common.check_dryrun(sample_config):
-            print("something wrong with ABySS -> no contig file generated")
-            return sample_config
-    else:
-        print("ABySS terminated with an error. Please check running folder",
-                "for more informations")
-    os.chdir("..")
-    return sample_config
+    return command
 
 
 def _run_allpaths(global_config, sample_config, sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler                  = "allpaths"
     outputName                 = sample_config["output"]
-    currentDirectory           = os.getcwd()
-    assemblyDirectory          = os.path.join(currentDirectory, assembler)
+    assemblyDirectory          = common.run_dir(sample_config).join(assembler)
     # in abyss case there is no exectuable
     programBIN                 = global_config["Tools"][assembler]["bin"]
     program_options            = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure("allpaths", assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
-    inGroups_file = open("in_groups.csv", "w")
-    inLibs_file   = open("in_libs.csv", "w")
-    inGroups_file.write("group_name, library_name, file_name\n")
-    inLibs_file.write("library_name, project_name, organism_name, type, "
+    inputs = _allpaths_inputs(sorted_libraries_by_insert)
+    if inputs is None:
+        return sample_config
+    for name, content in inputs.items():
+        with open(assembly_dir.join(name), "w") as input_file:
+            input_file.write(content)
+    #NOW RUN ALLPATHS FOR REAL
+    data_dir = assembly_dir.subdir("data_dir").path
+    ploidy = _allpaths_ploidy(program_options)
+    if ploidy is None:
+        return sample_config
+
+    command = _allpaths_prepare_command(global_config, data_dir, ploidy)
+    if common.check_dryrun(sample_config):
+        common.print_command(command)
+        common.print_command(_allpaths_run_command(programBIN))
+        return sample_config
+    common.print_command(command)
+    returnValue = assembly_dir.run(command,
+            stdout="allpaths_PrepareAllPathsInputs.stdOut",
+            stderr="allpaths_PrepareAllPathsInputs.stdErr").returncode
+    flags = sample_config.get("flags", [])
+    if returnValue == 0:
+        command = _allpaths_run_command(programBIN)
+        common.print_command(command)
+        returnValue = assembly_dir.run(command,
+                stdout="allpaths_RunAllPathsLG.stdOut",
+                stderr="allpaths_RunAllPathsLG.stdErr").returncode
+        if returnValue != 0:
+            print("ALLPATHS RunAllPathsLG terminated with an error. Please",
+                    "check running folder for more informations")
+            return sample_config
+        else: # save results
+            run_dir = os.path.join("data_dir", "allpaths", "ASSEMBLIES",
+                    "run")
+            if assembly_dir.exists(run_dir, "final.assembly.fasta"):
+                exit_code = _save_assembly(assembly_dir, [
+                    (os.path.join(run_dir, "final.contigs.fasta"),
+                        "{}.ctg.fasta".format(outputName)),
+                    (os.path.join(run_dir, "final.assembly.fasta"),
+                        "{}.scf.fasta".format(outputName))])
+                if not "keep_tmp_files" in flags and exit_code == 0:
+                    assembly_dir.run(["rm", "-r", "data_dir"])
+            else:
+                print("something wrong with Allpaths > no contig file generated")
+                return sample_config
+    else:
+        print("ALLPATHS PrepareAllPathInputs terminated with an error. "
+                "Please check running folder for more informations")
+        return sample_config
+    return sample_config
+
+
+def _allpaths_inputs(sorted_libraries_by_insert):
+    """ content of in_groups.csv and in_libs.csv, None if the libraries
+    cannot be assembled by allpaths"""
+    in_groups = "group_name, library_name, file_name\n"
+    in_libs = ("library_name, project_name, organism_name, type, "
             "paired, frag_size, frag_stddev, insert_size, insert_stddev, "
             "read_orientation,genomic_start, genomic_end\n")
     librariesForInLibs     = []
@@ -174,9 +547,9 @@ def _run_allpaths(global_config, sample_config, sorted_libraries_by_insert):
                 fqfile = fqfile.replace("_R1_", "_R?_")
             else:
                 print("error file format not supported {}".format(fqfile))
-                return sample_config
-            inGroups_file.write("PE{}, lib{}, {}\n".format(group_name, insert,
-                os.path.join(path, fqfile)))
+                return None
+            in_groups += "PE{}, lib{}, {}\n".format(group_name, insert,
+                os.path.join(path, fqfile))
             group_name += 1
             if insert not in librariesForInLibsDict:
                 librariesForInLibsDict[insert] = insert
@@ -189,10 +562,10 @@ def _run_allpaths(global_config, sample_config, sorted_libraries_by_insert):
             elif "_R1_" in fqfile:
                 fqfile = fqfile.replace("_R1_", "_R?_")
             else:
-                print("error file format not supported {}".format(file))
-                return sample_config
-            inGroups_file.write("MP{}, lib{}, {}\n".format(group_name, insert,
-                os.path.join(path, fqfile)))
+                print("error file format not supported {}".format(fqfile))
+                return None
+            in_groups += "MP{}, lib{}, {}\n".format(group_name, insert,
+                os.path.join(path, fqfile))
             group_name += 1
             if insert not in librariesForInLibsDict:
                 librariesForInLibsDict[insert] = insert
@@ -200,191 +573,198 @@ def _run_allpaths(global_config, sample_config, sorted_libraries_by_insert):
                         ", , {}, {}, outward, 0, 0\n".format(insert,insert, std))
         else:
             print("all paths support only innies and outties")
-    inGroups_file.close()
-    for lib in librariesForInLibs:
-        inLibs_file.write(lib)
-    inLibs_file.close()
-    #NOW RUN ALLPATHS FOR REAL
-    program=os.path.join(programBIN, "PrepareAllPathsInputs.pl")
-    os.mkdir("data_dir")
-    data_dir = os.path.join(os.getcwd(), "data_dir")
+    return OrderedDict([("in_groups.csv", in_groups),
+        ("in_libs.csv", in_libs + "".join(librariesForInLibs))])
+
+
+def _allpaths_ploidy(program_options):
     ploidy = "PLOIDY=1"
     if len(program_options) > 0:
         if len(program_options) >1:
             print("Running ALlpaths only one parameter accepted as option",
                     "here: PLOIDY=2")
-            return sample_config
+            return None
         if program_options[0] == "PLOIDY=2":
             ploidy = "PLOIDY=2"
         else:
             print("Running ALlpaths only one parameter accepted as option",
                     "here: PLOIDY=2")
-            return sample_config
+            return None
+    return ploidy
+
 
-    command = [program , "DATA_DIR={}".format(data_dir), ploidy, 
+def _allpaths_prepare_command(global_config, data_dir, ploidy):
+    program = os.path.join(global_config["Tools"]["allpaths"]["bin"],
+            "PrepareAllPathsInputs.pl")
+    return [program , "DATA_DIR={}".format(data_dir), ploidy,
             "PICARD_TOOLS_DIR={}".format(
-            global_config["Tools"]["picard"]["bin"]), 
+            global_config["Tools"]["picard"]["bin"]),
             "FORCE_PHRED=True", "PHRED_64=False"]
-    if common.check_dryrun(sample_config):
-        common.print_command(command)
-        program = os.path.join(programBIN, "RunAllPathsLG")
-        command = [program, "PRE=.", "REFERENCE_NAME=.", "DATA_SUBDIR=data_dir",
-                "RUN=allpaths", "SUBDIR=run"]
-        common.print_command(command)
-        os.chdir("..")
-        return sample_config
-    assembler_stdOut = open("allpaths_PrepareAllPathsInputs.stdOut", "w")
-    assembler_stdErr = open("allpaths_PrepareAllPathsInputs.stdErr", "w")
-    common.print_command(command)
-    returnValue = subprocess.call(command,  stdout=assembler_stdOut, 
-            stderr=assembler_stdErr)
-    assembler_stdOut.close()
-    assembler_stdErr.close()
-    flags = sample_config.get("flags", [])
-    if returnValue == 0:
-        program = os.path.join(programBIN, "RunAllPathsLG")
-        command = [program, "PRE=.", "REFERENCE_NAME=.", "DATA_SUBDIR=data_dir",
-                "RUN=allpaths", "SUBDIR=run", "HAPLOIDIFY=True"]
-        common.print_command(command)
-        assembler_stdOut = open("allpaths_RunAllPathsLG.stdOut", "w")
-        assembler_stdErr = open("allpaths_RunAllPathsLG.stdErr", "w")
-        returnValue = subprocess.call(command,  stdout=assembler_stdOut,
-                stderr=assembler_stdErr)
-        if returnValue != 0:
-            print("ALLPATHS RunAllPathsLG terminated with an error. Please",
-                    "check running folder for more informations")
-            os.chdir("..")
-            return sample_config
-        else: # save results
-            assembly_dir = os.path.join("data_dir", "allpaths", "ASSEMBLIES",
-                    "run")
-            if os.path.exists(os.path.join(assembly_dir,
-                "final.assembly.fasta")):
-                exit_code = subprocess.call(["cp", os.path.join(assembly_dir,
-                    "final.contigs.fasta"), "{}.ctg.fasta".format(outputName)])
-                exit_code += subprocess.call(["cp", os.path.join(assembly_dir,
-                    "final.assembly.fasta"), "{}.scf.fasta".format(outputName)])
-                if not "keep_tmp_files" in flags and exit_code == 0:
-                    subprocess.call(["rm", "-r", "data_dir"])
-            else:
-                print("something wrong with Allpaths > no contig file generated")
-                os.chdir("..")
-                return sample_config
-    else:
-        print("ALLPATHS PrepareAllPathInputs terminated with an error. "
-                "Please check running folder for more informations")
-        os.chdir("..")
-        return sample_config
-    os.chdir("..")
-    return sample_config
+
+
+def _allpaths_run_command(programBIN):
+    return [os.path.join(programBIN, "RunAllPathsLG"), "PRE=.",
+            "REFERENCE_NAME=.", "DATA_SUBDIR=data_dir", "RUN=allpaths",
+            "SUBDIR=run", "HAPLOIDIFY=True"]
 
 
 def _run_cabog(global_config, sample_config, sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler = "cabog"
     outputName = sample_config["output"]
-    currentDirectory = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     # in cabog case there is no exectuable
     programBIN = global_config["Tools"][assembler]["bin"]
     program_options = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure(assembler, assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
     sys.path.insert(0, programBIN)
     libraries = 1
     for library, libraryInfo in sorted_libraries_by_insert:
-        command_fastqToCA = os.path.join(programBIN, "fastqToCA")
-        read1=libraryInfo["pair1"]
-        read2=libraryInfo["pair2"]
-        orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
-        command_fastqToCA += " -libraryname "
-        command_fastqToCA += " {}_{}".format(outputName, libraries)
-        command_fastqToCA += " -insertsize "
-        command_fastqToCA += " {} {} ".format(insert,std)
-        command_fastqToCA += " -technology "
-        command_fastqToCA += " illumina "
-        command_fastqToCA += " -type "
-        command_fastqToCA += " illumina "
-        if orientation=="innie" or orientation=="none" :
-            command_fastqToCA += " -innie "
-            if read2 is None:
-                command_fastqToCA += " -reads "
-                command_fastqToCA += " {} ".format(read1)
-            else:
-                command_fastqToCA += " -mates "
-                command_fastqToCA += " {},{} ".format(read1, read2)
-        elif orientation=="outtie":
-            command_fastqToCA += " -outtie "
-            command_fastqToCA += " -mates "
-            command_fastqToCA += " {},{} ".format(read1, read2)
-        command_fastqToCA += " > "
-        command_fastqToCA += " {}_{}.frg ".format(outputName, libraries)
-
+        command_fastqToCA = _cabog_fastqToCA_command(programBIN, outputName,
+                libraries, libraryInfo)
         common.print_command(command_fastqToCA)
-        if not common.check_dryrun(sample_config):
-            cabog_stdOut = open("cabog_fastqToCA.stdOut", "w")
-            cabog_stdErr = open("cabogfastqToCA.stdErr", "w")
-            subprocess.call(command_fastqToCA, stderr=cabog_stdErr, shell=True)
-            cabog_stdOut.close()
-            cabog_stdErr.close()
+        if not common.check_dryrun(sample_config) and assembly_dir.run(
+                command_fastqToCA, stderr="cabogfastqToCA.stdErr",
+                mode="a").returncode != 0:
+            print("CABOG fastqToCA terminated with an error. Please check",
+                    "running folder for more informations")
+            return sample_config
         libraries += 1
-    command_runCA = os.path.join(programBIN, "runCA")
-    command_runCA += "  -d runCABOGfolder -p {} *frg".format(outputName)
+    command_runCA = _cabog_runCA_command(programBIN, outputName)
     common.print_command(command_runCA)
     if common.check_dryrun(sample_config):
         return sample_config
     returnValue = 0
-    cabog_stdOut = open("cabog_runCA.stdOut", "w")
-    cabog_stdErr = open("cabog_runCA.stdErr", "w")
-    returnValue = subprocess.call(command_runCA, stdout=cabog_stdOut,
-            stderr=cabog_stdErr, shell=True)
+    returnValue = assembly_dir.run(command_runCA,
+            stdout="cabog_runCA.stdOut",
+            stderr="cabog_runCA.stdErr").returncode
     flags = sample_config.get("flags", [])
     if returnValue == 0:
         #assembly succed, remove files and save assembly
-        if os.path.exists(os.path.join("runCABOGfolder","9-terminator",
-            "{}.ctg.fasta".format(outputName))):
-            subprocess.call(["mv", os.path.join("runCABOGfolder","9-terminator",
-                "{}.ctg.fasta".format(outputName)),
-                "{}.ctg.fasta".format(outputName)])
-            subprocess.call(["mv", os.path.join("runCABOGfolder","9-terminator",
-                "{}.scf.fasta".format(outputName)),
-                "{}.scf.fasta".format(outputName)])
-            if not "keep_tmp_files" in flags:
-                subprocess.call(["rm", "-r", "runCABOGfolder"])
+        if assembly_dir.exists("runCABOGfolder","9-terminator",
+            "{}.ctg.fasta".format(outputName)):
+            exit_code = _save_assembly(assembly_dir, [(os.path.join(
+                "runCABOGfolder", "9-terminator", "{}.{}".format(outputName,
+                extension)), "{}.{}".format(outputName, extension)) for
+                extension in ["ctg.fasta", "scf.fasta"]], "mv")
+            if not "keep_tmp_files" in flags and exit_code == 0:
+                assembly_dir.run(["rm", "-r", "runCABOGfolder"])
         else:
             print("something wrong with CABOG -> no contig file generated")
     else:
         print("CABOG terminated with an error. Please check running folder",
                 "for more informations")
-    os.chdir("..")
     return sample_config
 
 
+def _cabog_fastqToCA_command(programBIN, outputName, number, libraryInfo):
+    """ fastqToCA command converting the number-th library to a frg file"""
+    command_fastqToCA = os.path.join(programBIN, "fastqToCA")
+    read1=libraryInfo["pair1"]
+    read2=libraryInfo["pair2"]
+    orientation = libraryInfo["orientation"]
+    insert = libraryInfo["insert"]
+    std = libraryInfo["std"]
+    command_fastqToCA += " -libraryname "
+    command_fastqToCA += " {}_{}".format(outputName, number)
+    command_fastqToCA += " -insertsize "
+    command_fastqToCA += " {} {} ".format(insert,std)
+    command_fastqToCA += " -technology "
+    command_fastqToCA += " illumina "
+    command_fastqToCA += " -type "
+    command_fastqToCA += " illumina "
+    if orientation=="innie" or orientation=="none" :
+        command_fastqToCA += " -innie "
+        if read2 is None:
+            command_fastqToCA += " -reads "
+            command_fastqToCA += " {} ".format(read1)
+        else:
+            command_fastqToCA += " -mates "
+            command_fastqToCA += " {},{} ".format(read1, read2)
+    elif orientation=="outtie":
+        command_fastqToCA += " -outtie "
+        command_fastqToCA += " -mates "
+        command_fastqToCA += " {},{} ".format(read1, read2)
+    command_fastqToCA += " > "
+    command_fastqToCA += " {}_{}.frg ".format(outputName, number)
+    return command_fastqToCA
+
+
+def _cabog_runCA_command(programBIN, outputName):
+    command_runCA = os.path.join(programBIN, "runCA")
+    command_runCA += "  -d runCABOGfolder -p {} *frg".format(outputName)
+    return command_runCA
+
+
 def _run_masurca(global_config, sample_config,sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler = "masurca"
     outputName = sample_config["output"]
-    currentDirectory = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     # in cabog case there is no exectuable
     programBIN = global_config["Tools"][assembler]["bin"]
     program_options = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure(assembler, assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
 
-    masurca_config_file = open("configuration.txt", "w")
-    masurca_config_file.write("DATA\n")
-    allTheLetters = string.lowercase
+    with open(assembly_dir.join("configuration.txt"), "w") as \
+            masurca_config_file:
+        masurca_config_file.write(_masurca_configuration(sample_config,
+            sorted_libraries_by_insert))
+
+    if common.check_dryrun(sample_config):
+        return sample_config
+
+    masurca_dir = assembly_dir.subdir("runMASURCA")
+    command, assemble_command = _masurca_commands(programBIN)
+    common.print_command(command)
+
+    returnValue = masurca_dir.run(command, stdout="../masurca.stdOut",
+            stderr="../masurca.stdErr").returncode
+    if returnValue != 0:
+        print("MaSuRCA configuration terminated with an error. Please check",
+                "running folder for more informations")
+        return sample_config
+    if not masurca_dir.exists("assemble.sh"):
+        print("MaSuRCA: assemble.sh not created. Unknown failure")
+        return sample_config
+    command = assemble_command
+    common.print_command(command)
+    returnValue = masurca_dir.run(command, stdout="../masurca.stdOut",
+            stderr="../masurca.stdErr", mode="a").returncode
+    flags = sample_config.get("flags", [])
+    if returnValue == 0:
+        if assembly_dir.exists(
+            "runMASURCA","CA/10-gapclose/genome.scf.fasta"):
+            exit_code = _save_assembly(assembly_dir, [(os.path.join(
+                "runMASURCA", "CA/10-gapclose/genome.{}".format(extension)),
+                "{}.{}".format(outputName, extension)) for extension in
+                ["ctg.fasta", "scf.fasta"]])
+            if not "keep_tmp_files" in flags and exit_code == 0:
+                assembly_dir.run(["rm", "-r", "runMASURCA"])
+        else:
+            print("something wrong with MaSuRCA -> no contig file generated")
+    else:
+        print("MaSuRCA terminated with an error. Please check running folder",
+                "for more informations")
+        return sample_config
+    return sample_config
+
+
+def _masurca_configuration(sample_config, sorted_libraries_by_insert):
+    """ content of the MaSuRCA configuration.txt"""
+    configuration = []
+    configuration.append("DATA\n")
+    allTheLetters = string.ascii_lowercase
     libraryPE    = "p"
     libraryPEnum = 0
     libraryMP    = "m"
@@ -400,209 +780,205 @@ def _run_masurca(global_config, sample_config,sorted_libraries_by_insert):
             if read2 is not None:
                 configurationLine = "PE = {}{} {} {} {} {}".format(libraryPE,
                         allTheLetters[libraryPEnum], insert, std, read1, read2)
-                masurca_config_file.write("{}\n".format(configurationLine))
+                configuration.append("{}\n".format(configurationLine))
                 libraryPEnum += 1
                 #TODO: check when more than 21 PE libraries ae specified
         elif orientation=="outtie":
             configurationLine = "JUMP = {}{} {} {} {} {}".format(libraryMP, 
                     allTheLetters[libraryMPnum], insert, std, read1, read2)
-            masurca_config_file.write("{}\n".format(configurationLine))
+            configuration.append("{}\n".format(configurationLine))
             libraryMPnum += 1
             #TODO: check when more than 21 PE libraries ae specified
-    masurca_config_file.write("END\n")
+    configuration.append("END\n")
 
-    masurca_config_file.write("\n")
+    configuration.append("\n")
 
-    masurca_config_file.write("PARAMETERS\n")
+    configuration.append("PARAMETERS\n")
     #this is k-mer size for deBruijn graph values between 25 and 101 are 
     #supported, auto will compute the optimal size based on the read data 
     #and GC content
-    masurca_config_file.write("GRAPH_KMER_SIZE=auto\n")
+    configuration.append("GRAPH_KMER_SIZE=auto\n")
     #set this to 1 for Illumina-only assemblies and to 0 if you have 2x or 
     #more long (Sanger, 454) reads
-    masurca_config_file.write("USE_LINKING_MATES=1\n")
+    configuration.append("USE_LINKING_MATES=1\n")
     #this parameter is useful if you have too many jumping library mates. 
     #See manual for explanation about settings based on genome length
     if sample_config["genomeSize"] > 10000000:
-        masurca_config_file.write("LIMIT_JUMP_COVERAGE = 1000\n")
+        configuration.append("LIMIT_JUMP_COVERAGE = 1000\n")
     else:
-        masurca_config_file.write("LIMIT_JUMP_COVERAGE = 60\n")
+        configuration.append("LIMIT_JUMP_COVERAGE = 60\n")
     #these are the additional parameters to Celera Assembler.  do not worry 
     #about performance, number or processors or batch sizes -- these are 
     #computed automatically. for mammals do not set cgwErrorRate above 0.15!!!
     if sample_config["genomeSize"] > 1500000000:
-        masurca_config_file.write("CA_PARAMETERS = ovlMerSize=30 \
+        configuration.append("CA_PARAMETERS = ovlMerSize=30 \
                 cgwErrorRate=0.15 ovlMemory=4GB\n")
     else:
-        masurca_config_file.write("CA_PARAMETERS = ovlMerSize=30 \
+        configuration.append("CA_PARAMETERS = ovlMerSize=30 \
                 cgwErrorRate=0.25 ovlMemory=4GB\n")
     #auto-detected number of cpus to use
-    threads = 8 # default for UPPMAX
-    if "threads" in sample_config :
-        threads = sample_config["threads"]
-    masurca_config_file.write("NUM_THREADS= {}\n".format(threads))
+    threads = resources.threads(sample_config)
+    configuration.append("NUM_THREADS= {}\n".format(threads))
     #this is mandatory jellyfish hash size ---- jellyfish hash size, 
     #set this to about 10x the genome size.
     JF_SIZE = sample_config["genomeSize"] * 11
-    masurca_config_file.write("JF_SIZE={}\n".format(JF_SIZE))
+    configuration.append("JF_SIZE={}\n".format(JF_SIZE))
     #this specifies if we do (1) or do not (0) want to trim long runs of 
     #homopolymers (e.g. GGGGGGGG) from 3' read ends, use it for high GC genomes
-    masurca_config_file.write("DO_HOMOPOLYMER_TRIM=0\n")
-    masurca_config_file.write("END\n")
-    masurca_config_file.write("\n")
+    configuration.append("DO_HOMOPOLYMER_TRIM=0\n")
+    configuration.append("END\n")
+    configuration.append("\n")
 
-    masurca_config_file.close()
+    return "".join(configuration)
 
-    if common.check_dryrun(sample_config):
-        os.chdir("..")
-        return sample_config
 
-    masurca_stdOut = open("masurca.stdOut", "w")
-    masurca_stdErr = open("masurca.stdErr", "w")
-    os.mkdir("runMASURCA")
-    os.chdir("runMASURCA")
-    command = [os.path.join(programBIN,"bin/masurca") , "../configuration.txt"]
-    common.print_command(command)
-
-    subprocess.call(command, stdout=masurca_stdOut, stderr=masurca_stdErr)
-    if not os.path.exists("assemble.sh"):
-        print("MaSuRCA: assemble.sh not created. Unknown failure")
-        return sample_config
-    command = ["./assemble.sh"]
-    common.print_command(command)
-    returnValue = subprocess.call(command, stdout=masurca_stdOut,
-            stderr=masurca_stdErr)
-    os.chdir("..")
-    flags = sample_config.get("flags", [])
-    if returnValue == 0:
-        if os.path.exists(os.path.join(
-            "runMASURCA","CA/10-gapclose/genome.scf.fasta")):
-            subprocess.call(["cp", os.path.join(
-                "runMASURCA","CA/10-gapclose/genome.ctg.fasta"), 
-                "{}.ctg.fasta".format(outputName) ])
-            subprocess.call(["cp", os.path.join(
-                "runMASURCA","CA/10-gapclose/genome.scf.fasta"),
-                "{}.scf.fasta".format(outputName) ])
-            if not "keep_tmp_files" in flags:
-                subprocess.call(["rm", "-r", "runMASURCA"])
-        else:
-            print("something wrong with MaSuRCA -> no contig file generated")
-    else:
-        print("MaSuRCA terminated with an error. Please check running folder",
-                "for more informations")
-        return sample_config
-    os.chdir("..")
-    return sample_config
+def _masurca_commands(programBIN):
+    """ commands run in runMASURCA: configuration and assembly"""
+    return [[os.path.join(programBIN,"bin/masurca") , "../configuration.txt"],
+            ["./assemble.sh"]]
 
 
 def _run_soapdenovo(global_config, sample_config, sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler = "soapdenovo"
     outputName = sample_config["output"]
-    currentDirectory = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     # in cabog case there is no exectuable
     programBIN = global_config["Tools"][assembler]["bin"]
     program_options = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure(assembler, assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
     kmer = 54
     if "kmer" in sample_config:
         kmer = sample_config["kmer"]
-    threads = ["-p", "8"] # default for UPPMAX
-    if "threads" in sample_config:
-        threads = ["-p", "{}".format(sample_config["threads"])]
-    soap_config_file = open("configuration.txt", "w")
-    soap_config_file.write("max_rd_len=100\n")
-    #TODO make this a parameter in the options
-    rank = 1
-    for library, libraryInfo in sorted_libraries_by_insert:
-        soap_config_file.write("[LIB]\n")
-        read1 = libraryInfo["pair1"]
-        read2 = libraryInfo["pair2"]
-        orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
-        soap_config_file.write("avg_ins={}\n".format(insert))
-        soap_config_file.write("rank={}\n".format(rank))
-        rank += 1
-        soap_config_file.write("map_len=30\n")
-        if orientation=="innie" or orientation=="none":
-            soap_config_file.write("asm_flags=3\n")
-            soap_config_file.write("pair_num_cutoff=3\n")
-            soap_config_file.write("reverse_seq=0\n")
-            if read2 is None:
-                soap_config_file.write("q={}\n".format(read1))
-            else:
-                soap_config_file.write("q1={}\n".format(read1))
-                soap_config_file.write("q2={}\n".format(read2))
-        elif orientation=="outtie":
-            soap_config_file.write("asm_flags=2\n")
-            soap_config_file.write("pair_num_cutoff=5\n")
-            soap_config_file.write("reverse_seq=1\n")
-            soap_config_file.write("q1={}\n".format(read1))
-            soap_config_file.write("q2={}\n".format(read2))
-
-    soap_config_file.close()
-    assembler_stdOut = open("soap.stdOut", "w")
-    assembler_stdErr = open("soap.stdErr", "w")
-    os.makedirs(os.path.join(assemblyDirectory, "runSOAP"))
-    os.chdir("runSOAP")
-    #TODO : lots of missing options
-    command = [programBIN , "all", "-s", "../configuration.txt", "-K",
-            "{}".format(kmer), "-L", "500", "-o", "soapAssembly", threads[0],
-            threads[1] ]
+    with open(assembly_dir.join("configuration.txt"), "w") as \
+            soap_config_file:
+        soap_config_file.write(_soapdenovo_configuration(
+            sorted_libraries_by_insert))
+    soap_dir = assembly_dir.subdir("runSOAP")
+    command = _soapdenovo_command(programBIN, kmer,
+            resources.threads(sample_config))
     common.print_command(command)
     returnValue = 0
     if not common.check_dryrun(sample_config):
-        subprocess.call(command, stdout=assembler_stdOut,
-                stderr=assembler_stdErr)
+        returnValue = soap_dir.run(command, stdout="../soap.stdOut",
+                stderr="../soap.stdErr").returncode
     else:
-        os.chdir("..")
-        os.chdir("..")
         return sample_config
 
-    os.chdir("..")
     flags = sample_config.get("flags", [])
     if returnValue == 0:
-        if(os.path.exists(os.path.join("runSOAP","soapAssembly.scafSeq"))):
-            subprocess.call(["mv", os.path.join("runSOAP",
-                "soapAssembly.scafSeq"), "{}.scf.fasta".format(outputName)])
-            subprocess.call(["mv", os.path.join("runSOAP",
-                "soapAssembly.contig"), "{}.ctg.fasta".format(outputName)])
-            if not "keep_tmp_files" in flags:
-                subprocess.call(["rm", "-r", "runSOAP"])
+        if(assembly_dir.exists("runSOAP","soapAssembly.scafSeq")):
+            exit_code = _save_assembly(assembly_dir, [
+                (os.path.join("runSOAP", "soapAssembly.scafSeq"),
+                    "{}.scf.fasta".format(outputName)),
+                (os.path.join("runSOAP", "soapAssembly.contig"),
+                    "{}.ctg.fasta".format(outputName))], "mv")
+            if not "keep_tmp_files" in flags and exit_code == 0:
+                assembly_dir.run(["rm", "-r", "runSOAP"])
         else:
             print("something wrong with SOAPdenovo -> no contig file generated")
     else:
         print("SOAPdenovo terminated with an error. Please check running",
                 "folder for more informations")
-        os.chdir("..")
         return sample_config
-    os.chdir("..")
     return sample_config
 
 
+def _soapdenovo_configuration(sorted_libraries_by_insert):
+    """ content of the SOAPdenovo configuration.txt"""
+    configuration = []
+    configuration.append("max_rd_len=100\n")
+    #TODO make this a parameter in the options
+    rank = 1
+    for library, libraryInfo in sorted_libraries_by_insert:
+        configuration.append("[LIB]\n")
+        read1 = libraryInfo["pair1"]
+        read2 = libraryInfo["pair2"]
+        orientation = libraryInfo["orientation"]
+        insert = libraryInfo["insert"]
+        std = libraryInfo["std"]
+        configuration.append("avg_ins={}\n".format(insert))
+        configuration.append("rank={}\n".format(rank))
+        rank += 1
+        configuration.append("map_len=30\n")
+        if orientation=="innie" or orientation=="none":
+            configuration.append("asm_flags=3\n")
+            configuration.append("pair_num_cutoff=3\n")
+            configuration.append("reverse_seq=0\n")
+            if read2 is None:
+                configuration.append("q={}\n".format(read1))
+            else:
+                configuration.append("q1={}\n".format(read1))
+                configuration.append("q2={}\n".format(read2))
+        elif orientation=="outtie":
+            configuration.append("asm_flags=2\n")
+            configuration.append("pair_num_cutoff=5\n")
+            configuration.append("reverse_seq=1\n")
+            configuration.append("q1={}\n".format(read1))
+            configuration.append("q2={}\n".format(read2))
+
+    return "".join(configuration)
+
+
+def _soapdenovo_command(programBIN, kmer, threads):
+    """ SOAPdenovo command, run in runSOAP"""
+    #TODO : lots of missing options
+    return [programBIN , "all", "-s", "../configuration.txt", "-K",
+            "{}".format(kmer), "-L", "500", "-o", "soapAssembly", "-p",
+            "{}".format(threads)]
+
+
 def _run_spades(global_config, sample_config, sorted_libraries_by_insert):
     ########## ACQUIRE ALL THE INFO AND CREATE THE ASSEMBLY FOLDER
     assembler = "spades"
     outputName = sample_config["output"]
-    currentDirectory = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     # in cabog case there is no exectuable
     programBIN = global_config["Tools"][assembler]["bin"]
     program_options = global_config["Tools"][assembler]["options"]
     sorted_libraries_by_insert = common._sort_libraries_by_insert(sample_config)
     if _prepare_folder_structure(assembler, assemblyDirectory) == 0:
-        os.chdir(assemblyDirectory)
+        assembly_dir = common.RunDir(assemblyDirectory)
     else:
         return sample_config
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
 
+    command = _spades_command(programBIN, program_options, outputName,
+            sorted_libraries_by_insert)
+    common.print_command(command)
+    returnValue = 0
+    if not common.check_dryrun(sample_config):
+        returnValue = assembly_dir.run(command, stdout="spades.stdOut",
+                stderr="spades.stdErr", mode="a").returncode
+    else:
+        return sample_config
+
+    flags = sample_config.get("flags", [])
+    if returnValue == 0:
+        if assembly_dir.exists(outputName,"contigs.fasta"):
+            exit_code = _save_assembly(assembly_dir, [
+                (os.path.join(outputName, "contigs.fasta"),
+                    "{}.ctg.fasta".format(outputName)),
+                (os.path.join(outputName, "scaffolds.fasta"),
+                    "{}.scf.fasta".format(outputName))])
+            if not "keep_tmp_files" in flags and exit_code == 0:
+                assembly_dir.run(["rm", "-r", outputName])
+        else:
+            print("something wrong with SPADES -> no contig file generated")
+    else:
+        print("SPADES terminated with an error. Please check running folder",
+                "for more informations")
+
+    return sample_config
+
+
+def _spades_command(programBIN, program_options, outputName,
+        sorted_libraries_by_insert):
     command = ""
     command += "{} ".format(programBIN)
     for option in program_options:
@@ -633,53 +1009,62 @@ def _run_spades(global_config, sample_config, sorted_libraries_by_insert):
                     "failed earlier?".format(orientation))
 
     command += "-o {} ".format(outputName)
-    common.print_command(command)
-    returnValue = 0
-    if not common.check_dryrun(sample_config):
-        assembler_stdOut = open("spades.stdOut", "a")
-        assembler_stdErr = open("spades.stdErr", "a")
-        returnValue = subprocess.call(command, stdout=assembler_stdOut,
-                stderr=assembler_stdErr, shell=True)
-    else:
-        return sample_config
-
-    flags = sample_config.get("flags", [])
-    if returnValue == 0:
-        if os.path.exists(os.path.join(outputName,"contigs.fasta")):
-            subprocess.call(["cp", os.path.join(outputName,"contigs.fasta"),
-                "{}.ctg.fasta".format(outputName)])
-            subprocess.call(["cp", os.path.join(outputName,"scaffolds.fasta"),
-                "{}.scf.fasta".format(outputName)])
-            if not "keep_tmp_files" in flags:
-                subprocess.call(["rm", "-r", outputName])
-        else:
-            print("something wrong with SPADES -> no contig file generated")
-    else:
-        print("SPADES terminated with an error. Please check running folder",
-                "for more informations")
-
-    os.chdir("..")
-    return sample_config
+    return command
 
 
 def _run_trinity(global_config, sample_config, sorted_libraries_by_insert):
     print("running trinity ...")
     assembler = "trinity"
     outputName = sample_config["output"]
-    currentDirectory  = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     if common.directory_exists(assemblyDirectory):
         return sample_config
-    os.chdir(assemblyDirectory) # now I am in the assembly directory
+    assembly_dir = common.RunDir(assemblyDirectory)
     sorted_libraries_by_insert = common.prepare_folder_structure(
-            sorted_libraries_by_insert)
-     # in masurca case there is no exectuable as a make file must be created
-    programBIN = global_config["Tools"][assembler]["bin"] + "Trinity"
-    program_options = global_config["Tools"][assembler]["options"]
-    if assembler in sample_config:
-        program_options=sample_config[assembler]
+            sorted_libraries_by_insert, assemblyDirectory)
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
+    commands = _trinity_commands(global_config, sample_config,
+            sorted_libraries_by_insert)
+    if commands is None:
+        return sample_config
+    command, abundance_command = commands
+    print(" ".join(command))
 
+    returnValue = assembly_dir.run(" ".join(command),
+            stdout="trinity.stdOut", stderr="trinity.stdErr").returncode
+    if returnValue != 0:
+        print("Trinity terminated with an error. Please check running folder",
+                "for more informations")
+        return sample_config
+
+    # now align reads back to transcripts and estimate abundance
+    command = abundance_command
+    print(" ".join(command))
+    returnValue = assembly_dir.subdir("trinity").run(" ".join(command),
+            stdout="../trinity.stdOut", stderr="../trinity.stdErr",
+            mode="a").returncode
+    if returnValue != 0:
+        print("Trinity abundance estimation terminated with an error. Please",
+                "check running folder for more informations")
+        return sample_config
+
+    #now copy results
+    _save_assembly(assembly_dir, [
+        ("trinity/Trinity.fasta", "{}.fasta".format(outputName)),
+        ("trinity/RSEM.isoforms.results",
+            "{}.isoforms.results".format(outputName)),
+        ("trinity/RSEM.genes.results",
+            "{}.genes.results".format(outputName))])
+    return sample_config
+
+
+def _trinity_commands(global_config, sample_config,
+        sorted_libraries_by_insert):
+    """ Trinity assembly command and the command aligning the reads back to
+    the transcripts (run in the trinity folder), None if the libraries
+    cannot be assembled by Trinity"""
+    assembler = "trinity"
+    programBIN = global_config["Tools"][assembler]["bin"] + "Trinity"
     command = [programBIN]
     command.extend(["--seqType", "fq"])
     command.extend(["--JM", "100G"])
@@ -690,8 +1075,6 @@ def _run_trinity(global_config, sample_config, sorted_libraries_by_insert):
         read1 = libraryInfo["pair1"]
         read2 = libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
         if read2 is None:
             command.append("--single")
             command.append("{}".format(read1))
@@ -703,56 +1086,34 @@ def _run_trinity(global_config, sample_config, sorted_libraries_by_insert):
         else:
             print("trinity: somthing wrong or unexpected in the sample",
                     "config file")
-            return sample_config
+            return None
     command.extend(["--output", "trinity"])
-    assembler_stdOut = open("trinity.stdOut", "w")
-    assembler_stdErr = open("trinity.stdErr", "w")
-    print(" ".join(command))
-
-    returnValue = subprocess.call(" ".join(command), stdout=assembler_stdOut,
-            stderr=assembler_stdErr, shell=True)
 
-    # now align reads back to transcripts and estimate abundance
-    os.chdir("trinity")
     programBIN = global_config["Tools"][assembler]["bin"] + \
             "util/align_and_estimate_abundance.pl"
-    command = [programBIN]
-    command.extend(["--transcripts", "Trinity.fasta"])
-    command.extend(["--seqType", "fq"])
+    abundance_command = [programBIN]
+    abundance_command.extend(["--transcripts", "Trinity.fasta"])
+    abundance_command.extend(["--seqType", "fq"])
     for library, libraryInfo in sorted_libraries_by_insert:
         read1 = libraryInfo["pair1"]
         read2 = libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
         if read2 is not None and orientation == "innie":
-            command.append("--left")
-            command.append("{}".format(os.path.splitext(read1)[0]))
-            command.append("--right")
-            command.append("{}".format(os.path.splitext(read2)[0]))
+            abundance_command.append("--left")
+            abundance_command.append("{}".format(os.path.splitext(read1)[0]))
+            abundance_command.append("--right")
+            abundance_command.append("{}".format(os.path.splitext(read2)[0]))
 
-    command.extend(["--aln_method", "bowtie"])
-    command.extend(["--est_method", "RSEM"])
-    command.append("--debug")
-    command.append("--trinity_mode")
-    command.append("--prep_reference")
+    abundance_command.extend(["--aln_method", "bowtie"])
+    abundance_command.extend(["--est_method", "RSEM"])
+    abundance_command.append("--debug")
+    abundance_command.append("--trinity_mode")
+    abundance_command.append("--prep_reference")
 
     if "threads" in sample_config:
-        command.extend(["--thread_count", str(sample_config["threads"])])
-    print(" ".join(command))
-    returnValue = subprocess.call(" ".join(command), stdout=assembler_stdOut,
-            stderr=assembler_stdErr, shell=True)
-
-    #now copy results
-    os.chdir("..")
-    subprocess.call(["cp", "trinity/Trinity.fasta",
-        "{}.fasta".format(outputName)])
-    subprocess.call(["cp", "trinity/RSEM.isoforms.results",
-        "{}.isoforms.results".format(outputName)])
-    subprocess.call(["cp", "trinity/RSEM.genes.results",
-        "{}.genes.results".format(outputName)])
-    os.chdir(currentDirectory)
-    return sample_config
+        abundance_command.extend(["--thread_count",
+            str(sample_config["threads"])])
+    return command, abundance_command
 
 
 def _prepare_folder_structure(assembler,assemblyDirectory):
@@ -768,13 +1129,12 @@ def _run_abyss_mergePairs(global_config, sample_config,
     print("running abyss-mergepairs ...")
     assembler = "abyss_mergePairs"
     outputName = sample_config["output"]
-    currentDirectory  = os.getcwd()
-    assemblyDirectory = os.path.join(currentDirectory, assembler)
+    assemblyDirectory = common.run_dir(sample_config).join(assembler)
     if common.directory_exists(assemblyDirectory):
         return sample_config
-    os.chdir(assemblyDirectory) # now I am in the assembly directory
+    assembly_dir = common.RunDir(assemblyDirectory)
     sorted_libraries_by_insert = common.prepare_folder_structure(
-            sorted_libraries_by_insert)
+            sorted_libraries_by_insert, assemblyDirectory)
     # in abyss case there is no exectuable
     programBIN      = global_config["Tools"][assembler]["bin"]
     program_options = global_config["Tools"][assembler]["options"]
@@ -782,40 +1142,39 @@ def _run_abyss_mergePairs(global_config, sample_config,
         program_options=sample_config[assembler]
     ########### HERE IT START THE SPECIFIC ASSEMBLER PART
 
-    program=programBIN
-    command = []
-    command.append(program)
-    for option in program_options:
-            command.append(option)
-
-    libraries = {}
     for library, libraryInfo in sorted_libraries_by_insert:
         read1 = libraryInfo["pair1"]
         read2 = libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
-        insert = libraryInfo["insert"]
-        std = libraryInfo["std"]
-        outputNameArray  = read1.split('/')[-1].split('_')
-        outputName = "{}_{}".format(outputNameArray[0], outputNameArray[1])
-
+        outputName = _abyss_mergePairs_output(read1)
         if orientation=="innie":
             if read2 is not None:
-                currentCommand = command;
-                currentCommand.append('-o')
-                currentCommand.append(outputName)
-                currentCommand.append(read1)
-                currentCommand.append(read2)
-                abyss_stdOut = open("mergePairs_{}.stdOut".format(outputName),
-                        "a")
-                abyss_stdErr = open("mergePairs_{}.stdErr".format(outputName),
-                        "a")
+                command = _abyss_mergePairs_command(programBIN,
+                        program_options, outputName, read1, read2)
                 print(command)
-                subprocess.call(command, stdout=abyss_stdOut,
-                        stderr=abyss_stdErr)
+                returnValue = assembly_dir.run(command,
+                        stdout="mergePairs_{}.stdOut".format(outputName),
+                        stderr="mergePairs_{}.stdErr".format(outputName),
+                        mode="a").returncode
+                if returnValue != 0:
+                    print("abyss-mergepairs terminated with an error. Please",
+                            "check running folder for more informations")
+                    return sample_config
                 command_mv = ["mv", "mergePairs_{}.stdErr".format(outputName),
                         "{}.txt".format(outputName)]
-                subprocess.call(command_mv)
+                assembly_dir.run(command_mv)
 
-    os.chdir("..")
     return sample_config
 
+
+def _abyss_mergePairs_output(read1):
+    outputNameArray  = read1.split('/')[-1].split('_')
+    return "{}_{}".format(outputNameArray[0], outputNameArray[1])
+
+
+def _abyss_mergePairs_command(programBIN, program_options, outputName, read1,
+        read2):
+    command = [programBIN]
+    command.extend(program_options)
+    command.extend(["-o", outputName, read1, read2])
+    return command
@@ -0,0 +1,333 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from nougat import common
+
+# x values of the Nx/NGx curves (N1 ... N100)
+NX_STEPS = np.arange(1, 101)
+
+CONTIGUITY_FIELDS = ["assembly type", "# sequences", "assembly length",
+        "trim shorter than(bp)", "# trimmed sequences",
+        "trimmed assembly length", "N50", "N80", "NG50", "NG80",
+        "longest seq", "L50", "LG50", "# N", "GC"]
+
+# IUPAC nucleotide codes, upper case; lower case is soft-masked sequence
+IUPAC_CODES = "ACGTRYSWKMBDHVN"
+_UPPER = np.frombuffer(IUPAC_CODES.encode("ascii"), dtype=np.uint8)
+_LOWER = np.frombuffer(IUPAC_CODES.lower().encode("ascii"), dtype=np.uint8)
+_ACGT  = np.concatenate([_UPPER[:4], _LOWER[:4]])
+_GC    = np.frombuffer(b"GCgc", dtype=np.uint8)
+_N     = np.frombuffer(b"Nn", dtype=np.uint8)
+
+# sidecar cache written next to every scanned assembly
+STATS_CACHE_SUFFIX = ".nougat-stats.json"
+STATS_CACHE_VERSION = 1
+
+# contiguity fields summarised in the assembly reports
+REPORT_FIELDS = ["# sequences", "# trimmed sequences", "NG50", "NG80",
+        "longest seq", "assembly length", "trimmed assembly length"]
+
+
+class AssemblyStats(object):
+    """ contiguity and composition statistics of an assembly.
+
+    lengths holds all the sequence lengths (int64, longest first), every
+    other number is derived from it with vectorised numpy operations. Nx is
+    the length of the shortest sequence such that sequences at least as long
+    cover x% of the assembly length (NGx: of the expected genome size), Lx is
+    the number of sequences needed to get there."""
+
+    def __init__(self, lengths, min_length=0, genome_size=None, gaps=0, gc=0,
+            acgt=0):
+        self.lengths     = -np.sort(-np.asarray(lengths, dtype=np.int64))
+        self.cumulative  = np.cumsum(self.lengths)
+        self.min_length  = min_length
+        self.genome_size = genome_size
+        self.gaps        = gaps # number of N/n
+        self.gc          = gc   # number of G/C (any case)
+        self.acgt        = acgt # number of A/C/G/T (any case)
+        self.nx, self.lx   = self._curve(self.total_length)
+        self.ngx, self.lgx = self._curve(genome_size)
+
+    def _curve(self, target):
+        if not target or len(self.lengths) == 0:
+            empty = np.zeros(len(NX_STEPS), dtype=np.int64)
+            return empty, empty.copy()
+        thresholds = target * NX_STEPS / 100.0
+        index = np.searchsorted(self.cumulative, thresholds, side="left")
+        reached = index < len(self.lengths)
+        index = np.minimum(index, len(self.lengths) - 1)
+        return (np.where(reached, self.lengths[index], 0),
+                np.where(reached, index + 1, 0))
+
+    @property
+    def num_sequences(self):
+        return len(self.lengths)
+
+    @property
+    def total_length(self):
+        if len(self.cumulative) == 0:
+            return 0
+        return int(self.cumulative[-1])
+
+    @property
+    def longest(self):
+        if len(self.lengths) == 0:
+            return 0
+        return int(self.lengths[0])
+
+    @property
+    def num_long(self):
+        """ number of sequences of at least min_length bp"""
+        return int(np.count_nonzero(self.lengths >= self.min_length))
+
+    @property
+    def long_length(self):
+        """ assembly length considering only sequences of at least
+        min_length bp"""
+        num_long = self.num_long
+        if num_long == 0:
+            return 0
+        return int(self.cumulative[num_long - 1])
+
+    @property
+    def gc_fraction(self):
+        if self.acgt == 0:
+            return 0.0
+        return float(self.gc) / self.acgt
+
+    @property
+    def gap_fraction(self):
+        if self.total_length == 0:
+            return 0.0
+        return float(self.gaps) / self.total_length
+
+    def N(self, x):
+        return int(self.nx[x - 1])
+
+    def NG(self, x):
+        return int(self.ngx[x - 1])
+
+    def L(self, x):
+        return int(self.lx[x - 1])
+
+    def LG(self, x):
+        return int(self.lgx[x - 1])
+
+    def contiguity(self, assembly_type=""):
+        """ returns the statistics as a row of the contiguity table"""
+        return OrderedDict(zip(CONTIGUITY_FIELDS, [assembly_type,
+            self.num_sequences, self.total_length, self.min_length,
+            self.num_long, self.long_length, self.N(50), self.N(80),
+            self.NG(50), self.NG(80), self.longest, self.L(50), self.LG(50),
+            self.gaps, "{:.4f}".format(self.gc_fraction)]))
+
+
+class Composition(object):
+    """ base composition of one sequence (counts has shape (256,)) or of a
+    batch of sequences (shape (n, 256)): counts[..., b] is the number of
+    occurrences of byte b. Every property returns a scalar or, for a batch,
+    an array with one value per sequence."""
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def _sum(self, codes):
+        return self.counts[..., codes].sum(axis=-1)
+
+    def _fraction(self, numerator, denominator):
+        numerator = np.asarray(numerator, dtype=np.float64)
+        fraction = np.divide(numerator, denominator,
+                out=np.zeros_like(numerator), where=denominator > 0)
+        if fraction.ndim == 0:
+            return float(fraction)
+        return fraction
+
+    @property
+    def length(self):
+        return self.counts.sum(axis=-1)
+
+    @property
+    def acgt(self):
+        return self._sum(_ACGT)
+
+    @property
+    def gc(self):
+        return self._sum(_GC)
+
+    @property
+    def n(self):
+        return self._sum(_N)
+
+    @property
+    def soft_masked(self):
+        return self._sum(_LOWER)
+
+    def iupac(self):
+        """ returns an OrderedDict code -> count (both cases summed)"""
+        return OrderedDict((code, self.counts[..., upper] +
+            self.counts[..., lower]) for code, upper, lower in zip(
+            IUPAC_CODES, _UPPER, _LOWER))
+
+    @property
+    def gc_fraction(self):
+        """ G+C over A+C+G+T, ambiguous bases are not counted"""
+        return self._fraction(self.gc, self.acgt)
+
+    @property
+    def n_fraction(self):
+        return self._fraction(self.n, self.length)
+
+    @property
+    def soft_masked_fraction(self):
+        return self._fraction(self.soft_masked, self.length)
+
+
+def _byte_counts(sequence):
+    return np.bincount(np.frombuffer(sequence, dtype=np.uint8),
+            minlength=256)
+
+
+def base_composition(sequence):
+    """ counts every byte of sequence (bytes, bytearray or memoryview) in a
+    single pass"""
+    return Composition(_byte_counts(sequence))
+
+
+def batch_composition(sequences):
+    """ base composition of many sequences at once, the returned Composition
+    has one row per sequence"""
+    counts = np.zeros((len(sequences), 256), dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        counts[row] = _byte_counts(sequence)
+    return Composition(counts)
+
+
+def stats_cache_name(fasta):
+    return "{}{}".format(fasta, STATS_CACHE_SUFFIX)
+
+
+def scan_assembly(fasta, cache=True):
+    """ reads fasta once and returns the sequence names, their lengths (in
+    file order) and the Composition of the whole assembly.
+
+    With cache the result is stored in a sidecar json file (together with
+    the Nx curve) and reused as long as the fingerprint of fasta (size, mtime
+    and sampled hash) does not change."""
+    fingerprint = common.file_fingerprint(fasta) if cache else None
+    if cache:
+        cached = _load_stats_cache(fasta, fingerprint)
+        if cached is not None:
+            return cached
+    names = []
+    lengths = []
+    counts = np.zeros(256, dtype=np.int64)
+    for record in common.read_fasta(fasta):
+        names.append(record.name)
+        lengths.append(record.length)
+        counts += _byte_counts(record.sequence)
+    lengths = np.array(lengths, dtype=np.int64)
+    if cache:
+        _write_stats_cache(fasta, fingerprint, names, lengths, counts)
+    return names, lengths, Composition(counts)
+
+
+def _load_stats_cache(fasta, fingerprint):
+    try:
+        with open(stats_cache_name(fasta), "r") as cache_fd:
+            cached = json.load(cache_fd)
+        if cached["version"] != STATS_CACHE_VERSION or \
+                cached["fingerprint"] != fingerprint:
+            return None
+        counts = np.zeros(256, dtype=np.int64)
+        for byte, count in cached["counts"].items():
+            counts[int(byte)] = count
+        return (cached["names"], np.array(cached["lengths"], dtype=np.int64),
+                Composition(counts))
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None # missing, unreadable or stale: scan again
+
+
+def _write_stats_cache(fasta, fingerprint, names, lengths, counts):
+    stats = AssemblyStats(lengths)
+    composition = Composition(counts)
+    cached = OrderedDict([("version", STATS_CACHE_VERSION),
+        ("fingerprint", fingerprint),
+        ("names", names),
+        ("lengths", lengths.tolist()),
+        ("nx", stats.nx.tolist()),
+        ("lx", stats.lx.tolist()),
+        ("composition", OrderedDict((code, int(count)) for code, count in
+            composition.iupac().items())),
+        ("counts", OrderedDict((str(byte), int(counts[byte])) for byte in
+            np.flatnonzero(counts)))])
+    cache_file = stats_cache_name(fasta)
+    temporary = "{}.{}.tmp".format(cache_file, os.getpid())
+    try:
+        with open(temporary, "w") as cache_fd:
+            json.dump(cached, cache_fd)
+        os.rename(temporary, cache_file)
+    except (IOError, OSError):
+        # e.g., read-only assembly folder, the cache is only an aid
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def compute_assembly_stats(fasta, min_length=0, genome_size=None,
+        cache=True):
+    """ computes AssemblyStats reading fasta once, or not at all when its
+    stats cache is up to date"""
+    names, lengths, composition = scan_assembly(fasta, cache)
+    return AssemblyStats(lengths, min_length, genome_size,
+            int(composition.n), int(composition.gc), int(composition.acgt))
+
+
+def write_contiguity(outfile, assemblies):
+    """ writes the contiguity table, assemblies is a list of
+    (assembly type, AssemblyStats) pairs"""
+    with open(outfile, "w") as out:
+        out.write('\t'.join(CONTIGUITY_FIELDS))
+        out.write('\n')
+        for assembly_type, stats in assemblies:
+            out.write('\t'.join(map(str,
+                stats.contiguity(assembly_type).values())))
+            out.write('\n')
+
+
+def read_contiguity(stat_file):
+    """ parses a contiguity table, returns a dictionary assembly type -> row
+    (an OrderedDict field -> value)"""
+    rows = OrderedDict()
+    with open(stat_file, "r") as sf:
+        fields = sf.readline().rstrip("\n").split("\t")
+        for line in sf:
+            values = line.rstrip("\n").split("\t")
+            if len(values) > 1:
+                rows[values[0]] = OrderedDict(zip(fields, values))
+    return rows
+
+
+def report_row(contiguity):
+    """ selects from a contiguity row the columns shown in the reports"""
+    return [contiguity[field] for field in REPORT_FIELDS]
+
+
+def write_nx_curve(outfile, assemblies):
+    """ writes x, Nx and NGx (one pair of columns per assembly type) for
+    x = 1 ... 100"""
+    with open(outfile, "w") as out:
+        header = ["x"]
+        for assembly_type, stats in assemblies:
+            header.extend(["{} Nx".format(assembly_type),
+                "{} NGx".format(assembly_type)])
+        out.write('\t'.join(header))
+        out.write('\n')
+        for i, x in enumerate(NX_STEPS):
+            row = [x]
+            for assembly_type, stats in assemblies:
+                row.extend([stats.nx[i], stats.ngx[i]])
+            out.write('\t'.join(map(str, row)))
+            out.write('\n')
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import json
+import re
+import hashlib
+from nougat import common
+
+# manifest written next to the first output of a step
+STEP_CACHE_SUFFIX = ".nougat-step.json"
+
+# options taking a number of threads: they do not change the outputs
+THREAD_OPTIONS = ["-t", "-@", "-np", "-threads", "--threads", "--CPU",
+        "--thread_count"]
+# nor does the memory given to a JVM or to the samtools sort buffers
+_JAVA_HEAP = re.compile(r"^-Xmx\d+[kmgKMG]?$")
+_SORT_MEMORY = re.compile(r"^\d+[KMG]$")
+
+
+def _command_tokens(command):
+    """ the command line as a list of tokens with the number of threads and
+    the memory masked, so that changing the resources granted to a step does
+    not invalidate it"""
+    if isinstance(command, (list, tuple)):
+        command = " ".join(str(part) for part in command if part is not None)
+    tokens = command.split()
+    masked = []
+    for i, token in enumerate(tokens):
+        if i > 0 and tokens[i - 1] in THREAD_OPTIONS:
+            masked.append("*")
+        elif token.startswith("np="): # abyss-pe
+            masked.append("np=*")
+        elif _JAVA_HEAP.match(token):
+            masked.append("-Xmx*")
+        elif i > 0 and tokens[i - 1] == "-m" and _SORT_MEMORY.match(token):
+            masked.append("*")
+        else:
+            masked.append(token)
+    return masked
+
+
+def fingerprint(path):
+    """ fingerprint of a file, None if it does not exist"""
+    if os.path.isfile(path):
+        return common.file_fingerprint(path)
+    return None
+
+
+def tool_fingerprint(program):
+    """ fingerprint of the executable behind program, a changed binary
+    (i.e., a new version) invalidates the steps that used it"""
+    path = program
+    if os.path.sep not in program:
+        path = common.which(program)
+    if path and os.path.isfile(path):
+        return common.file_fingerprint(path)
+    return program
+
+
+def temporary_name(path):
+    """ name under which an output is written before being renamed to path,
+    the extension is kept as some tools pick the format from it"""
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, "tmp.{}.{}".format(os.getpid(), name))
+
+
+def commit_outputs(temporaries, outputs):
+    """ atomically moves the temporary outputs to their final names"""
+    for temporary, output in zip(temporaries, outputs):
+        os.rename(temporary, output)
+
+
+class StepCache(object):
+    """ tells whether a step has already been run with the same command,
+    inputs and tools.
+
+    The key is a hash of the command line (threads masked), of the
+    fingerprints (size, mtime, sampled hash) of the inputs and of the tools.
+    record() writes the key and the fingerprints of the outputs to a
+    manifest; done() is true only if the manifest has the same key and all
+    the outputs are still exactly the ones the step wrote, so partial files
+    left by a crash or changed inputs cause the step to be run again."""
+
+    def __init__(self, command, inputs=(), outputs=(), tools=(),
+            manifest=None):
+        self.outputs = [os.path.abspath(output) for output in outputs]
+        description = {
+            "command": _command_tokens(command),
+            "inputs": [[os.path.abspath(path), fingerprint(path)] for path
+                in inputs if path is not None],
+            "tools": [[tool, tool_fingerprint(tool)] for tool in tools]}
+        self.key = hashlib.sha1(json.dumps(description,
+            sort_keys=True).encode("utf-8")).hexdigest()
+        if manifest is None:
+            manifest = "{}{}".format(self.outputs[0], STEP_CACHE_SUFFIX)
+        self.manifest = os.path.abspath(manifest)
+
+    def done(self):
+        try:
+            with open(self.manifest, "r") as manifest_fd:
+                manifest = json.load(manifest_fd)
+            recorded = manifest["outputs"]
+            if manifest["key"] != self.key or \
+                    not set(self.outputs) <= set(recorded):
+                return False
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+        return all(fingerprint(output) == recorded[output] and
+                recorded[output] is not None for output in recorded)
+
+    def record(self, outputs=None):
+        """ to be called once the step succeeded, outputs defaults to the
+        ones given at creation"""
+        if outputs is None:
+            outputs = self.outputs
+        manifest = {"key": self.key, "outputs": dict((os.path.abspath(
+            output), fingerprint(output)) for output in outputs)}
+        temporary = temporary_name(self.manifest)
+        with open(temporary, "w") as manifest_fd:
+            json.dump(manifest, manifest_fd, sort_keys=True)
+        os.rename(temporary, self.manifest)
+
+    def forget(self):
+        if os.path.exists(self.manifest):
+            os.remove(self.manifest)
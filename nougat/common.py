@@ -5,6 +5,18 @@ import subprocess
 import datetime
 import time
 import types
+import gzip
+import hashlib
+import signal
+import fcntl
+import atexit
+import shutil
+import tempfile
+import contextlib
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 
 # Header levels
@@ -16,16 +28,49 @@ UL, OL = 0, 1
 # Alignment
 CENTER, LEFT, RIGHT = 'CENTER', 'LEFT', 'RIGHT'
 
-
-def prepare_folder_structure(sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    DataFolder = os.path.join(os.getcwd(), "DATA")
+# FASTA parsing: bytes read from disk at each call and width of written lines
+FASTA_CHUNK_SIZE = 8 * 1024 * 1024
+FASTA_LINE_WIDTH = 60
+_FASTA_WHITESPACE = b" \t\r\n"
+_FASTA_WHITESPACE_CHARS = (b" ", b"\t", b"\r", b"\n")
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# file_fingerprint hashes this many blocks of this size spread over the file
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+# executor: external programs run at the same time by this process and the
+# ones it starts (pipeline steps, batch samples), can be changed with
+# set_max_processes (or the NOUGAT_MAX_PROCESSES variable)
+MAX_PROCESSES = int(os.environ.get("NOUGAT_MAX_PROCESSES",
+    multiprocessing.cpu_count()))
+# seconds between two attempts to get a free slot
+PROCESS_SLOT_POLL = 0.1
+_process_log = []
+_process_log_lock = threading.Lock()
+# seconds given to a timed out program to terminate before being killed
+KILL_GRACE_PERIOD = 10
+
+# profile: one row per program run, appended to {output}.profile.tsv
+PROFILE_FIELDS = ["step", "tool", "version", "start", "wall", "user",
+        "system", "max_rss", "read_bytes", "write_bytes", "input_bytes",
+        "returncode", "command"]
+_profile_file = None
+_profile_step = None
+_tool_versions = {} # file name of a tool -> version, see set_tool_versions
+_profile_lock = threading.Lock()
+# interpreters, the tool is the script or jar they run
+_INTERPRETERS = ["java", "python", "python2", "python3", "perl", "bash", "sh"]
+
+
+def prepare_folder_structure(sorted_libraries_by_insert, folder=None):
+    """ soft links the reads in the DATA folder of folder (by default the
+    current one) giving them human readable names"""
+    DataFolder = os.path.join(folder or os.getcwd(), "DATA")
     if os.path.exists(DataFolder):
         sys.exit("DATA dir already exists: danger to over-write data: \
                 terminate execution")
     os.makedirs(DataFolder)
-    os.chdir(DataFolder)
-    CurrentDir = os.getcwd()
     #now prepare softlinks to data and give to libraries human readable names
     currentLibraryNumber = 1;
     type = ["SE", "PE", "MP"]
@@ -34,19 +79,16 @@ def prepare_folder_structure(sorted_libraries_by_insert):
         pair2 = libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
         pair1, pair2 = createSoftLinks(pair1, pair2, orientation, type,
-                currentLibraryNumber)
+                currentLibraryNumber, DataFolder)
         libraryInfo["pair1"] = pair1
         libraryInfo["pair2"] = pair2
         currentLibraryNumber += 1
-    os.chdir("..")
     return sorted_libraries_by_insert
 
-def update_sample_config(sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    DataFolder = os.path.join(os.getcwd(), "DATA")
+def update_sample_config(sorted_libraries_by_insert, folder=None):
+    DataFolder = os.path.join(folder or os.getcwd(), "DATA")
     if not os.path.exists(DataFolder):
         sys.exit("DATA dir does not exists: we should not be here!!!!")
-    os.chdir(DataFolder)
     currentLibraryNumber = 1
     type = ["SE", "PE", "MP"]
     for library, libraryInfo in sorted_libraries_by_insert:
@@ -54,23 +96,25 @@ def update_sample_config(sorted_libraries_by_insert):
         pair2 = libraryInfo["pair2"]
         orientation = libraryInfo["orientation"]
         libraryInfo["pair1"] = _new_name(pair1, orientation, type,
-                currentLibraryNumber, 1)
+                currentLibraryNumber, 1, DataFolder)
         libraryInfo["pair2"] = _new_name(pair2, orientation, type,
-                currentLibraryNumber, 2)
+                currentLibraryNumber, 2, DataFolder)
         currentLibraryNumber += 1
-    os.chdir("..")
     return sorted_libraries_by_insert
 
-def createSoftLinks(pair1, pair2, orientation, type, currentLibraryNumber):
-    pair1NewName = _new_name(pair1, orientation, type, currentLibraryNumber, 1)
-    pair2NewName = _new_name(pair2, orientation, type, currentLibraryNumber, 2)
+def createSoftLinks(pair1, pair2, orientation, type, currentLibraryNumber,
+        folder=None):
+    pair1NewName = _new_name(pair1, orientation, type, currentLibraryNumber, 1,
+            folder)
+    pair2NewName = _new_name(pair2, orientation, type, currentLibraryNumber, 2,
+            folder)
     os.symlink(pair1, pair1NewName)
     if pair2NewName is not None:
          os.symlink(pair2, pair2NewName)
     return pair1NewName, pair2NewName
 
 def _new_name(oldPathName, orientation, type, currentLibraryNumber,
-        pairNumber):
+        pairNumber, folder=None):
     if oldPathName is None:
         return oldPathName;
     oldName = os.path.split(oldPathName)[1]
@@ -83,7 +127,7 @@ def _new_name(oldPathName, orientation, type, currentLibraryNumber,
     elif orientation == "outtie":
         newName += "MP_{}.".format(pairNumber)
     newName += oldNameTail
-    newName = os.path.join(os.getcwd(), newName)
+    newName = os.path.join(folder or os.getcwd(), newName)
     return newName
 
 
@@ -97,6 +141,51 @@ def directory_exists(directory):
                 directory))
         return 1
 
+class RunDir(object):
+    """ the folder a step works in.
+
+    Programs are run with it as working directory and relative names are
+    resolved against it, the current directory of the process is never
+    changed: steps (and samples) can run at the same time in threads and a
+    step returning early cannot leave the others in the wrong folder."""
+
+    def __init__(self, path, create=False):
+        self.path = os.path.abspath(path)
+        if create and not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise # not just created by another step
+
+    def join(self, *names):
+        """ absolute path of names in this folder (absolute names are
+        returned unchanged)"""
+        return os.path.join(self.path, *names)
+
+    def subdir(self, name, create=True):
+        """ the RunDir of folder name in this one, created if needed"""
+        return RunDir(self.join(name), create)
+
+    def exists(self, *names):
+        return os.path.exists(self.join(*names))
+
+    def run(self, command, stdout=None, stderr=None, **kwargs):
+        """ run_command in this folder, stdout and stderr names are relative
+        to it"""
+        return run_command(command, stdout=stdout, stderr=stderr,
+                cwd=self.path, **kwargs)
+
+    def __str__(self):
+        return self.path
+
+
+def run_dir(sample_config):
+    """ the RunDir of a sample: its workdir if set (e.g., by a batch),
+    otherwise the current directory"""
+    return RunDir(sample_config.get("workdir") or os.getcwd())
+
+
 def which(program):
     import os
     def is_exe(fpath):
@@ -116,6 +205,563 @@ def which(program):
     return None
 
 
+class FastaRecord(namedtuple("FastaRecord", ["header", "length",
+        "sequence"])):
+    """ one entry of a fasta file: header (without '>'), sequence length and
+    the sequence itself as a bytearray (None in lengths_only mode)"""
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """ contig name, i.e., the header up to the first white space"""
+        fields = self.header.split()
+        if fields:
+            return fields[0]
+        return ""
+
+
+def read_fasta(fasta, lengths_only=False, chunk_size=FASTA_CHUNK_SIZE):
+    """ iterates over the records of a (multi-)fasta file.
+
+    The file is read in large binary chunks and each sequence is collected
+    into a bytearray with line terminators removed, so the cost is linear in
+    the file size whatever the line width. With lengths_only the sequence is
+    never built and only header and length are reported. gzip (and bgzip)
+    compressed files are decompressed on the fly."""
+    with open_fasta(fasta) as fasta_fd:
+        for record in _parse_fasta(fasta_fd, lengths_only, chunk_size):
+            yield record
+
+
+def is_gzipped(path):
+    with open(path, "rb") as fd:
+        return fd.read(2) == _GZIP_MAGIC
+
+
+def open_fasta(fasta):
+    """ opens a fasta file for binary reading, decompressing it if gzipped"""
+    if is_gzipped(fasta):
+        return gzip.open(fasta, "rb")
+    return open(fasta, "rb")
+
+
+def _parse_fasta(fasta_fd, lengths_only, chunk_size):
+    header   = None  # header of the record being read
+    sequence = bytearray()
+    length   = 0
+    pending  = b""   # header line split across two chunks
+    eof      = False
+    while not eof:
+        chunk = fasta_fd.read(chunk_size)
+        eof = not chunk
+        data = pending + chunk if pending else chunk
+        pending = b""
+        pos = 0
+        while pos < len(data):
+            if data[pos:pos + 1] == b">":
+                newline = data.find(b"\n", pos)
+                if newline == -1:
+                    if not eof:
+                        pending = data[pos:]
+                        break
+                    newline = len(data)
+                if header is not None:
+                    yield _fasta_record(header, length, sequence, lengths_only)
+                header = data[pos + 1:newline].rstrip().decode("utf-8",
+                        "replace")
+                sequence = bytearray()
+                length = 0
+                pos = newline + 1
+            else:
+                # sequence lines never contain '>', the next record starts
+                # right after the first '\n>' (or in the next chunk)
+                next_header = data.find(b"\n>", pos)
+                stop = len(data) if next_header == -1 else next_header + 1
+                block = data[pos:stop]
+                if header is not None: # ignore text before the first header
+                    if lengths_only:
+                        length += len(block) - sum(block.count(space)
+                                for space in _FASTA_WHITESPACE_CHARS)
+                    else:
+                        sequence += block.translate(None, _FASTA_WHITESPACE)
+                pos = stop
+    if header is not None:
+        yield _fasta_record(header, length, sequence, lengths_only)
+
+
+def _fasta_record(header, length, sequence, lengths_only):
+    if lengths_only:
+        return FastaRecord(header, length, None)
+    return FastaRecord(header, len(sequence), sequence)
+
+
+def write_fasta_record(fasta_fd, header, sequence,
+        line_width=FASTA_LINE_WIDTH):
+    """ writes a record to a fasta file opened in binary mode, the sequence
+    (any bytes-like object) is wrapped every line_width bases"""
+    fasta_fd.write(">{}\n".format(header).encode("utf-8"))
+    view = memoryview(sequence)
+    for start in range(0, len(view), line_width):
+        fasta_fd.write(view[start:start + line_width])
+        fasta_fd.write(b"\n")
+
+
+def file_fingerprint(path):
+    """ cheap identity of a file: size, mtime and a sha1 of
+    FINGERPRINT_SAMPLES blocks evenly spread over it (of the whole file if
+    small), so that it can be computed on huge files in milliseconds"""
+    stat = os.stat(path)
+    size = stat.st_size
+    digest = hashlib.sha1()
+    with open(path, "rb") as fd:
+        if size <= FINGERPRINT_SAMPLES * FINGERPRINT_SAMPLE_SIZE:
+            block = fd.read(FINGERPRINT_SAMPLE_SIZE)
+            while block:
+                digest.update(block)
+                block = fd.read(FINGERPRINT_SAMPLE_SIZE)
+        else:
+            last = size - FINGERPRINT_SAMPLE_SIZE
+            for sample in range(FINGERPRINT_SAMPLES):
+                fd.seek(sample * last // (FINGERPRINT_SAMPLES - 1))
+                digest.update(fd.read(FINGERPRINT_SAMPLE_SIZE))
+    return {"size": size, "mtime": stat.st_mtime, "sha1": digest.hexdigest()}
+
+
+class ProcessResult(namedtuple("ProcessResult", ["command", "returncode",
+        "wall", "user", "system", "max_rss", "read_bytes", "write_bytes",
+        "timed_out"])):
+    """ outcome of a program run through run_command: exit status (negative
+    if killed by a signal), wall time, user and system CPU seconds, peak
+    resident memory in KB and bytes read from and written to storage (None
+    where /proc is not available). Times and memory include the children of
+    the program, e.g., all the commands of a shell pipeline."""
+    __slots__ = ()
+
+    @property
+    def success(self):
+        return self.returncode == 0 and not self.timed_out
+
+
+class _ProcessSlots(object):
+    """ the slots of the programs run at the same time: a running program
+    holds a POSIX lock on one of the slots files of folder, which is shared
+    with the processes started from this one through the
+    NOUGAT_PROCESS_SLOTS variable. These locks are not inherited by forked
+    processes and are dropped by the system when a process dies, so a
+    killed step does not keep its slots."""
+
+    def __init__(self, folder, slots):
+        self.folder = folder
+        self.slots = max(1, slots)
+        self._held = set() # slots taken by the threads of this process
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ waits for a free slot, held until the end of the with block"""
+        slot, slot_fd = self._acquire()
+        try:
+            yield slot
+        finally:
+            fcntl.lockf(slot_fd, fcntl.LOCK_UN)
+            slot_fd.close()
+            with self._lock:
+                self._held.discard(slot)
+
+    def _acquire(self):
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+        while True:
+            for slot in range(self.slots):
+                # POSIX locks do not exclude the threads of a process
+                with self._lock:
+                    if slot in self._held:
+                        continue
+                    self._held.add(slot)
+                slot_fd = open(os.path.join(self.folder,
+                    "slot{}".format(slot)), "a")
+                try:
+                    fcntl.lockf(slot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot, slot_fd
+                except (IOError, OSError):
+                    slot_fd.close()
+                    with self._lock:
+                        self._held.discard(slot)
+            time.sleep(PROCESS_SLOT_POLL)
+
+
+def _process_slots_folder():
+    """ the slots folder of the pipeline, created by its first process in
+    the temporary folder and removed when that process exits"""
+    folder = os.environ.get("NOUGAT_PROCESS_SLOTS")
+    if not folder:
+        folder = os.path.join(tempfile.gettempdir(),
+                "nougat-slots.{}".format(os.getpid()))
+        os.environ["NOUGAT_PROCESS_SLOTS"] = folder
+        atexit.register(shutil.rmtree, folder, True)
+    return folder
+
+
+_process_slots = _ProcessSlots(_process_slots_folder(), MAX_PROCESSES)
+
+
+def set_max_processes(max_processes):
+    """ changes how many programs run_command runs at the same time, the
+    processes started afterwards inherit the new limit"""
+    global MAX_PROCESSES, _process_slots
+    MAX_PROCESSES = max_processes
+    _process_slots = _ProcessSlots(_process_slots.folder, max_processes)
+
+
+def process_log():
+    """ the ProcessResult of every program run so far by this process"""
+    with _process_log_lock:
+        return list(_process_log)
+
+
+def run_command(command, stdout=None, stderr=None, mode="w", stdin=None,
+        timeout=None, check=False, cwd=None):
+    """ runs an external program and returns its ProcessResult.
+
+    command is a list of arguments or a string run through the shell (for
+    pipes and redirections). stdout and stderr are file names, opened with
+    mode and closed here, or open files; None inherits ours. After timeout
+    seconds the program (with its whole process group) is terminated, as it
+    is when the wait is interrupted (e.g., by Ctrl-C). At most MAX_PROCESSES
+    programs run at the same time in this process and the ones it starts,
+    the others wait for a free slot. With check a failure stops the
+    pipeline. The program runs in cwd (by default the current directory),
+    against which relative stdout and stderr names are resolved."""
+    shell = not isinstance(command, (list, tuple))
+    if not shell:
+        command = [str(argument) for argument in command]
+    input_bytes = _input_bytes(command, cwd) if _profile_file else None
+    with _process_slots.slot():
+        out = _open_output(stdout, mode, cwd)
+        err = _open_output(stderr, mode, cwd)
+        try:
+            start = time.time()
+            process = subprocess.Popen(command, shell=shell, stdin=stdin,
+                    stdout=out, stderr=err, preexec_fn=os.setsid, cwd=cwd)
+            status, rusage, io, timed_out = _wait_process(process.pid,
+                    timeout)
+            process.returncode = _exit_code(status)
+            wall = time.time() - start
+        finally:
+            for handle, name in [(out, stdout), (err, stderr)]:
+                if handle is not None and handle is not name:
+                    handle.close()
+    result = ProcessResult(command, process.returncode, wall,
+            rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+            io.get("read_bytes"), io.get("write_bytes"), timed_out)
+    with _process_log_lock:
+        _process_log.append(result)
+    if _profile_file:
+        _write_profile_row(result, start, input_bytes)
+    if check and not result.success:
+        if not shell:
+            command = " ".join(command)
+        sys.exit("error while running command: {} (exit status {}{})".format(
+            command, result.returncode,
+            ", timed out" if timed_out else ""))
+    return result
+
+
+def _open_output(output, mode, cwd=None):
+    if output is None or hasattr(output, "write"):
+        return output
+    return open(os.path.join(cwd or "", output), mode)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _read_process_io(pid):
+    """ storage bytes read and written by pid and its reaped children"""
+    io = {}
+    try:
+        with open("/proc/{}/io".format(pid)) as io_fd:
+            for line in io_fd:
+                key, value = line.split(":")
+                io[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+
+def _wait_process(pid, timeout):
+    """ waits for pid collecting exit status, resource usage and I/O, kills
+    its process group once timeout seconds are over or if the wait is
+    interrupted"""
+    deadline = None if timeout is None else time.time() + timeout
+    interval = 0.01
+    io = {}
+    timed_out = False
+    killed = False
+    try:
+        while True:
+            io = _read_process_io(pid) or io
+            if hasattr(os, "waitid"):
+                # wait without reaping, so /proc/pid/io has the final counts
+                if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG |
+                        os.WNOWAIT) is not None:
+                    io = _read_process_io(pid) or io
+                    _, status, rusage = os.wait4(pid, 0)
+                    return status, rusage, io, timed_out
+            else:
+                reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+                if reaped:
+                    return status, rusage, io, timed_out
+            if deadline is not None and time.time() > deadline and not killed:
+                if not timed_out:
+                    timed_out = True
+                    _signal_group(pid, signal.SIGTERM)
+                    deadline = time.time() + KILL_GRACE_PERIOD
+                else:
+                    _signal_group(pid, signal.SIGKILL)
+                    killed = True
+            time.sleep(interval)
+            interval = min(interval * 2, 1.0)
+    except BaseException:
+        # e.g., Ctrl-C: the program runs in its own session and does not get
+        # it, so it is killed here rather than left running
+        _signal_group(pid, signal.SIGKILL)
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass # already reaped
+        raise
+
+
+def _signal_group(pid, signal_number):
+    try:
+        os.killpg(pid, signal_number)
+    except OSError:
+        pass # already terminated
+
+
+def profile_file_name(sample_config):
+    return "{}.profile.tsv".format(sample_config.get("output", "sample"))
+
+
+def start_profile(path, resume=False):
+    """ from now on every program run through run_command is appended to the
+    profile path, a tab separated file with PROFILE_FIELDS columns. Without
+    resume an existing profile is moved aside like the journal."""
+    global _profile_file
+    path = os.path.abspath(path)
+    if os.path.exists(path) and (not resume or
+            _profile_header(path) != PROFILE_FIELDS):
+        os.rename(path, "{}.{}".format(path, int(time.time())))
+    if not os.path.exists(path):
+        with open(path, "w") as profile_fd:
+            profile_fd.write("\t".join(PROFILE_FIELDS) + "\n")
+    _profile_file = path
+
+
+def _profile_header(path):
+    with open(path, "r") as profile_fd:
+        return profile_fd.readline().rstrip("\n").split("\t")
+
+
+def set_tool_versions(versions):
+    """ versions of the tools (keyed by file name, as in the tool column)
+    written in the profile rows from now on"""
+    _tool_versions.update(versions)
+
+
+def set_profile_step(step):
+    """ pipeline step the programs run from now on are accounted to"""
+    global _profile_step
+    _profile_step = step
+
+
+def _tool_name(command):
+    """ program (and sub-command, e.g., bwa mem) a command line runs"""
+    if isinstance(command, (list, tuple)):
+        tokens = list(command)
+    else:
+        tokens = command.split()
+    tokens = [token for token in tokens if "=" not in token or
+            token.startswith("-")]
+    if not tokens:
+        return ""
+    position = 0
+    if os.path.basename(tokens[0]) in _INTERPRETERS:
+        position = 1
+        while position < len(tokens) - 1 and tokens[position].startswith("-"):
+            position += 1
+    program = tokens[min(position, len(tokens) - 1)].split() or [""]
+    name = os.path.basename(program[0]) # e.g., the command of bash -c
+    following = tokens[position + 1:position + 2]
+    if following and following[0].isalpha() and \
+            not os.path.exists(following[0]):
+        name = "{} {}".format(name, following[0])
+    return name
+
+
+def _input_bytes(command, cwd=None):
+    """ size of the existing files named on the command line (relative to
+    cwd), a measure of the input of a program"""
+    if isinstance(command, (list, tuple)):
+        tokens = list(command)
+    else:
+        tokens = command.split()
+    seen = set()
+    size = 0
+    for previous, token in zip(tokens, tokens[1:]):
+        if previous in (">", ">>", "2>", "&>"):
+            continue # output redirected to an existing file
+        path = os.path.join(cwd or "", token.split("=", 1)[-1])
+        if path not in seen and os.path.isfile(path):
+            seen.add(path)
+            size += os.path.getsize(path)
+    return size
+
+
+def _write_profile_row(result, start, input_bytes):
+    command = result.command
+    if isinstance(command, (list, tuple)):
+        command = " ".join(command)
+    tool = _tool_name(result.command)
+    row = [_profile_step or "", tool, _tool_versions.get(tool.split(" ")[0]),
+            "{:.0f}".format(start), "{:.2f}".format(result.wall),
+            "{:.2f}".format(result.user), "{:.2f}".format(result.system),
+            result.max_rss, result.read_bytes, result.write_bytes, input_bytes,
+            result.returncode, " ".join(command.split())]
+    line = "\t".join("" if value is None else str(value) for value in row)
+    with _profile_lock:
+        # a single append per row, so that concurrent steps can share it
+        with open(_profile_file, "a") as profile_fd:
+            profile_fd.write(line + "\n")
+
+
+def read_profile(path):
+    """ parses a profile, numeric columns are converted (None if missing)"""
+    rows = []
+    with open(path, "r") as profile_fd:
+        fields = profile_fd.readline().rstrip("\n").split("\t")
+        for line in profile_fd:
+            values = line.rstrip("\n").split("\t")
+            if len(values) != len(fields):
+                continue # row cut by a crash
+            row = dict(zip(fields, values))
+            for field in fields:
+                if field in ("step", "tool", "version", "command"):
+                    continue
+                row[field] = float(row[field]) if row[field] else None
+            rows.append(row)
+    return rows
+
+
+def profile_summary(rows):
+    """ totals per (step, tool): calls, wall and CPU time, bytes read,
+    written and given as input; peak memory is the maximum"""
+    summary = OrderedDict()
+    for row in rows:
+        key = (row["step"], row["tool"])
+        if key not in summary:
+            summary[key] = {"calls": 0, "wall": 0.0, "cpu": 0.0,
+                    "max_rss": 0, "read_bytes": 0, "write_bytes": 0,
+                    "input_bytes": 0, "failed": 0}
+        total = summary[key]
+        total["calls"] += 1
+        total["wall"] += row["wall"] or 0
+        total["cpu"] += (row["user"] or 0) + (row["system"] or 0)
+        total["max_rss"] = max(total["max_rss"], row["max_rss"] or 0)
+        for field in ("read_bytes", "write_bytes", "input_bytes"):
+            total[field] += row[field] or 0
+        if row["returncode"] != 0:
+            total["failed"] += 1
+    return summary
+
+
+def resource_usage_table(profiles):
+    """ rows (header first) of the resource usage table of the reports,
+    profiles is a list of (label, profile file) pairs; missing profiles are
+    skipped, None is returned if there is nothing to show"""
+    table = [["run", "step", "tool", "calls", "wall", "CPU", "peak RSS",
+        "read", "written", "input"]]
+    for label, path in profiles:
+        if not os.path.exists(path):
+            continue
+        for (step, tool), total in profile_summary(read_profile(path)).items():
+            calls = str(total["calls"])
+            if total["failed"]:
+                calls += " ({} failed)".format(total["failed"])
+            table.append([label, step, tool, calls,
+                _format_seconds(total["wall"]), _format_seconds(total["cpu"]),
+                _format_bytes(total["max_rss"] * 1024),
+                _format_bytes(total["read_bytes"]),
+                _format_bytes(total["write_bytes"]),
+                _format_bytes(total["input_bytes"])])
+    if len(table) == 1:
+        return None
+    return table
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m".format(hours, minutes)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+def _format_bytes(size):
+    if size < 1024:
+        return "{:.0f}B".format(size)
+    for unit in ["KB", "MB", "GB"]:
+        size /= 1024.0
+        if size < 1024:
+            return "{:.1f}{}".format(size, unit)
+    return "{:.1f}TB".format(size / 1024.0)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ exclusive lock on path (created if needed), held until the end of
+    the with block; used by the processes of a batch that build a shared
+    resource, e.g., a reference index"""
+    with open(path, "a") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+
+def pyplot():
+    """ matplotlib.pyplot with a non interactive backend, imported by the
+    steps that plot when they run: matplotlib is slow to import"""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    return plt
+
+
+def run_in_parallel(function, jobs, workers):
+    """ calls function(*job) for every job in at most workers threads and
+    returns the results in job order. Meant for jobs spending their time
+    waiting on external programs."""
+    if workers <= 1 or len(jobs) <= 1:
+        return [function(*job) for job in jobs]
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        return pool.map(lambda job: function(*job), jobs)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def _sort_libraries_by_insert(sample_config):
     sorted_libraries_by_insert = sorted(sample_config["libraries"].items(),
@@ -143,8 +789,12 @@ def print_command(command):
 
 
 def _check_pipeline(sample_config, global_config):
-    """ check that user specified commands are supported by this pipeline"""
+    """ check that user specified commands are supported by this pipeline,
+    binaries and versions are resolved through the tool cache and the
+    versions are written in the profile"""
+    from nougat import toolcache
     print("checking tool consistency:")
+    resolver = toolcache.ToolResolver(global_config)
 
     pipeline     = sample_config["pipeline"]
     user_tools   = sample_config["tools"] #might be empty
@@ -187,7 +837,6 @@ def _check_pipeline(sample_config, global_config):
                     "command.".format(tool))
 
         tool_bin = global_config["Tools"][tool]["bin"]
-        print(tool_bin)
         """this step is a case by case step as several special cases are 
         present"""
         special_tools = ["allpaths", "abyss", "cabog", "masurca",  "trinity",
@@ -222,19 +871,26 @@ def _check_pipeline(sample_config, global_config):
                             "sample_config section.".format(tool_bin))
 
             for binary in binaries_to_check:
-                if not which(binary):
+                if not resolver.resolve(binary):
+                    resolver.save()
                     sys.exit("tool {} requires availability of binary {} but "
                             "pipeline did not find it. Please check the tool "
                             "installation. If you are not planning to run this "
                             "tool specify the list of to be run tools in the "
                             "sample_config section.".format(tool, binary))
         else:
-            if not which(tool_bin):
+            if not resolver.resolve(tool_bin):
+                 resolver.save()
                  sys.exit("Error: tool {} requires full path to binaries in "
                          "config file. Path {} does not exists. Please modify "
                          "the global config.If you are not planning to run "
                          "this tool specify the list of to be run tools in the "
                          "sample_config section.".format(tool, tool_bin))
+    resolver.save()
+    for binary, resolved in resolver.resolved.items():
+        print("{} {}".format(resolved.path, resolved.version or
+            "(version unknown)"))
+    set_tool_versions(resolver.versions())
     print("all tools the pipeline is going to use appear properly installed.")
     return
 
@@ -2,13 +2,26 @@ from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, yaml, glob
 import argparse
-from nougat import evaluete, assemble, QCcontrol, align, common
+import time
+import multiprocessing
+import traceback
+from nougat import common, journal, plan, registry, resources
 
 
 def main(args):
     with open(args.global_config) as in_handle:
         global_config = yaml.load(in_handle)
-    with open(args.sample_config) as sample_config_handle:
+    sample_configs = _sample_config_files(args.sample_config)
+    allocation = resources.detect_allocation(args.threads, args.memory)
+    print("resources: {} cpus, {}MB of memory ({})".format(allocation.cpus,
+        allocation.memory, allocation.source))
+    if args.plan is not None:
+        return write_plans(global_config, sample_configs, args.plan,
+                allocation, args.parallel_samples)
+    if len(sample_configs) > 1:
+        return run_batch(global_config, sample_configs, allocation,
+                args.parallel_samples, args.resume)
+    with open(sample_configs[0]) as sample_config_handle:
         sample_config = yaml.load(sample_config_handle)
 
     check_consistency(global_config,sample_config)
@@ -17,7 +30,7 @@ def main(args):
                "not executed")
 
     if sample_config["pipeline"] in global_config["Pipelines"]:
-        run_analys(global_config, sample_config)
+        run_analys(global_config, sample_config, args.resume, allocation)
     else:
         sys.exit("Error: pipeline {} is not one of the supported \
                 ones:{}".format(sample_config["pipeline"], 
@@ -26,17 +39,187 @@ def main(args):
     return 0
 
 
-def run_analys(global_config, sample_config):
+def _sample_config_files(patterns):
+    """ the sample configuration files given on the command line, each one
+    can be a glob pattern (e.g., plate1/*.yaml)"""
+    sample_configs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            sys.exit("Error: sample configuration {} does not exist".format(
+                pattern))
+        sample_configs.extend(match for match in matches
+                if match not in sample_configs)
+    return sample_configs
+
+
+def run_batch(global_config, sample_configs, allocation=None,
+        parallel_samples=None, resume=False):
+    """ runs the pipeline on many samples in this allocation.
+
+    Each sample runs in its own process and in its own working directory
+    (named after its output), at most parallel_samples at the same time; the
+    cpus and memory of the allocation are split among the samples running
+    together unless a sample config asks for its own. Resources built next
+    to a shared reference (e.g., the bwa index) are built once and then
+    reused."""
+    jobs, parallel_samples = _batch_jobs(global_config, sample_configs,
+            allocation, parallel_samples)
+    print("running {} samples, {} at a time".format(len(jobs),
+        parallel_samples))
+    # plain processes rather than a Pool: the pipelines start processes of
+    # their own, which pool workers are not allowed to do
+    pending = list(jobs)
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < parallel_samples:
+            sample_config, working_dir = pending.pop(0)
+            process = multiprocessing.Process(target=_run_sample,
+                    args=(global_config, sample_config, working_dir, resume))
+            process.start()
+            running.append((sample_config["output"], working_dir, process))
+        finished = [entry for entry in running if not entry[2].is_alive()]
+        if not finished:
+            time.sleep(1)
+            continue
+        for sample, working_dir, process in finished:
+            process.join()
+            running.remove((sample, working_dir, process))
+            if process.exitcode == 0:
+                print("sample {} done".format(sample))
+            else:
+                failed.append(sample)
+                print("sample {} failed, see {}".format(sample,
+                    os.path.join(working_dir, "{}.log".format(sample))))
+    if failed:
+        sys.exit("Error: {} of {} samples failed: {}".format(len(failed),
+            len(jobs), ", ".join(failed)))
+    return 0
+
+
+def _batch_jobs(global_config, sample_configs, allocation=None,
+        parallel_samples=None):
+    """ the (sample_config, working_dir) of each sample of a batch, with
+    the resources of allocation split among the parallel_samples run at the
+    same time, and parallel_samples itself"""
+    if allocation is None:
+        allocation = resources.detect_allocation()
+    threads = allocation.cpus
+    jobs = []
+    working_dirs = set()
+    for sample_config_file in sample_configs:
+        with open(sample_config_file) as sample_config_handle:
+            sample_config = yaml.load(sample_config_handle)
+        _absolute_paths(sample_config)
+        check_consistency(global_config, sample_config)
+        if "output" not in sample_config:
+            sample_config["output"] = os.path.splitext(
+                    os.path.basename(sample_config_file))[0]
+        working_dir = os.path.abspath(sample_config["output"])
+        if working_dir in working_dirs:
+            sys.exit("Error: two samples have output {}, outputs must be "
+                    "unique in a batch".format(sample_config["output"]))
+        working_dirs.add(working_dir)
+        jobs.append((sample_config, working_dir))
+    if parallel_samples is None:
+        parallel_samples = len(jobs)
+    parallel_samples = max(1, min(parallel_samples, len(jobs), threads))
+    for sample_config, working_dir in jobs:
+        sample_config.setdefault("threads", resources.split(threads,
+            parallel_samples))
+        sample_config.setdefault("memory", resources.split(allocation.memory,
+            parallel_samples))
+    return jobs, parallel_samples
+
+
+def write_plans(global_config, sample_configs, plan_file, allocation=None,
+        parallel_samples=None):
+    """ writes the execution plan of the samples (json if plan_file ends in
+    .json, a Makefile otherwise) instead of running them. With more than one
+    sample each plan is named after its sample (e.g., plan.sample1.json)
+    and runs in the working directory the sample would have in a batch"""
+    if len(sample_configs) == 1:
+        with open(sample_configs[0]) as sample_config_handle:
+            sample_config = yaml.load(sample_config_handle)
+        _absolute_paths(sample_config)
+        check_consistency(global_config, sample_config)
+        jobs = [(sample_config, os.getcwd())]
+    else:
+        jobs, parallel_samples = _batch_jobs(global_config, sample_configs,
+                allocation, parallel_samples)
+    for sample_config, working_dir in jobs:
+        sample_plan_file = plan_file
+        if len(jobs) > 1:
+            base, extension = os.path.splitext(plan_file)
+            if extension != ".json":
+                base, extension = plan_file, ""
+            sample_plan_file = "{}.{}{}".format(base,
+                    sample_config["output"], extension)
+        sample_plan = plan.compile_plan(global_config, sample_config,
+                working_dir, allocation)
+        sample_plan.write(sample_plan_file)
+        print("plan of sample {}: {} tasks written to {}".format(
+            sample_plan.sample, len(sample_plan.tasks), sample_plan_file))
+    return 0
+
+
+def _run_sample(global_config, sample_config, working_dir, resume):
+    """ runs the pipeline of one sample of a batch in its working directory,
+    its output (and the one of the programs it runs) goes to {output}.log"""
+    sample_config["workdir"] = common.RunDir(working_dir, True).path
+    with open(os.path.join(working_dir, "{}.log".format(
+        sample_config["output"])), "a") as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+    try:
+        run_analys(global_config, sample_config, resume)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def _absolute_paths(sample_config):
+    """ makes the relative paths of a sample config absolute, as the sample
+    does not run in the current directory"""
+    def absolute(path):
+        if path is None or os.path.isabs(path):
+            return path
+        return os.path.abspath(path)
+    for library, libraryData in sample_config.get("libraries", {}).items():
+        for pair in ["pair1", "pair2"]:
+            if pair in libraryData:
+                libraryData[pair] = absolute(libraryData[pair])
+    for key in ["reference", "adapters"]:
+        if key in sample_config:
+            sample_config[key] = absolute(sample_config[key])
+
+
+def run_analys(global_config, sample_config, resume=False, allocation=None):
     """ check that user specified commands are supported by this pipeline and 
     that all commands I am going to run are available either via PATH or 
     via global config"""
     # check that what I am going to run is available on the path and on the 
     # global config
     common._check_pipeline(sample_config, global_config)
+    # threads and memory (MB) the steps share, unless set in the sample config
+    resources.grant(sample_config, allocation)
+    # the folder the steps work in, they never change the current directory
+    run_dir = common.run_dir(sample_config)
+    sample_config["workdir"] = run_dir.path
     pipeline = sample_config["pipeline"] # pipeline/analysis to be executed
-    # this stopped to --> workgetattr(__import__(command), "run")
-    command_fn = getattr(globals()[pipeline], "run")
-    command_fn(global_config, sample_config)
+    # the pipeline module (and what it needs) is imported only now
+    command_fn = registry.pipeline_function(pipeline)
+    # every completed step is journaled, with resume the completed steps are
+    # replayed and the pipeline continues from the first unfinished one
+    step_journal = journal.Journal(run_dir.join(journal.journal_file_name(
+        sample_config)), resume)
+    # resources used by every program run, for the reports
+    common.start_profile(run_dir.join(common.profile_file_name(
+        sample_config)), resume)
+    command_fn(global_config, sample_config, journal=step_journal)
 
 
 def check_consistency(global_config, sample_config):
@@ -89,7 +272,28 @@ if __name__ == '__main__':
     parser.add_argument('--global-config', help=("configuration file "
             "containing paths to tools"), type=str)
     parser.add_argument('--sample-config', help=("configuration file "
-            "containing sample information"), type=str)
+            "containing sample information, with more than one (or a glob "
+            "pattern) the samples are run together, each one in a folder "
+            "named after its output"), type=str, nargs="+")
+    parser.add_argument('--threads', type=int, default=None,
+            help=("threads the pipeline (or the samples of a batch) can use "
+            "(default: the ones of the SLURM job or cgroup, otherwise all "
+            "the cores)"))
+    parser.add_argument('--memory', type=str, default=None,
+            help=("memory the pipeline (or the samples of a batch) can use, "
+            "e.g., 64G (default: the one of the SLURM job or cgroup, "
+            "otherwise the memory of the node)"))
+    parser.add_argument('--parallel-samples', type=int, default=None,
+            help=("number of samples of a batch run at the same time "
+            "(default: as many as the threads allow)"))
+    parser.add_argument('--plan', type=str, default=None, metavar="FILE",
+            help=("do not run anything, write to FILE the commands of every "
+            "step with their inputs, outputs, threads, memory and "
+            "dependencies: as json if FILE ends in .json, as a Makefile "
+            "otherwise"))
+    parser.add_argument('--resume', action='store_true', default=False,
+            help=("continue an interrupted run from the first step not "
+            "completed according to the journal ({output}.journal)"))
     args = parser.parse_args()
 
     main(args)
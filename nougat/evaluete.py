@@ -1,45 +1,141 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, yaml, glob
-import subprocess
-import pandas as pd
 import re
 import shutil
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from nougat import common, align
-from itertools import groupby
-from collections import OrderedDict
-
-def run(global_config, sample_config):
+import itertools
+from nougat import common, align, assembly_stats, fasta, resources, plan
+from nougat import journal as step_journal
+
+# contigs whose composition is computed at once when adding GC to QAtools
+QA_GC_BATCH = 4096
+
+def run(global_config, sample_config, journal=None):
+    if journal is None:
+        journal = step_journal.Journal()
+    sample_config = journal.replay(sample_config)
     sorted_libraries_by_insert = \
             common._sort_libraries_by_insert(sample_config)
     _check_libraries(sorted_libraries_by_insert)
 
-    computeAssemblyStats(sample_config)
+    sample_config = journal.run_step("contig_stats", sample_config,
+            _computeAssemblyStatsStep, sample_config)
     # filter out short contigs
-    sample_config = _build_new_reference(sample_config)
+    sample_config = journal.run_step("reference", sample_config,
+            _build_new_reference, sample_config)
+    for command in _tools(sample_config):
+        """with this I pick up at run time the correct function in the \
+                current module"""
+        command_fn    = getattr(sys.modules[__name__],
+                "_run_{}".format(command))
+        """Update sample config, each command return sample_config and \
+                if necessary it modifies it"""
+        sample_config = journal.run_step(command, sample_config, command_fn,
+                global_config, sample_config, sorted_libraries_by_insert)
+
+
+def _tools(sample_config):
     if "tools" in sample_config:
         """If so, execute them one after the other in the specified order \
                 (might not work)"""
-        for command in sample_config["tools"]:
-            """with this I pick up at run time the correct function in the \
-                    current module"""
-            command_fn    = getattr(sys.modules[__name__],
-                    "_run_{}".format(command))
-            """Update sample config, each command return sample_config and \
-                    if necessary it modifies it"""
-            sample_config = command_fn(global_config, sample_config,
-                    sorted_libraries_by_insert)
-    else:
-        #run default pipeline for QC
-        sample_config = _run_align(global_config, sample_config,
-                sorted_libraries_by_insert)
-        sample_config = _run_qaTools(global_config, sample_config,
-                sorted_libraries_by_insert)
-        sample_config = _run_FRC(global_config, sample_config,
-                sorted_libraries_by_insert)
+        return sample_config["tools"]
+    #run default pipeline for QC
+    return ["align", "qaTools", "FRC"]
+
+
+def plan_steps(global_config, sample_config, run_plan):
+    """ adds to run_plan the tasks run() would execute, without touching
+    the filesystem"""
+    sorted_libraries_by_insert = \
+            common._sort_libraries_by_insert(sample_config)
+    _check_libraries(sorted_libraries_by_insert)
+    reference = os.path.abspath(sample_config["reference"])
+    ctg = re.sub("scf.fasta$", "ctg.fasta", reference)
+    scf = re.sub("ctg.fasta$", "scf.fasta", reference)
+    run_plan.add("contig_stats", "contig_stats", run_plan.workdir,
+            [plan.python_call("evaluete", "computeAssemblyStats", {
+            "reference": reference, "genomeSize": sample_config["genomeSize"],
+            "minCtgLength": sample_config.get("minCtgLength", 1000)})],
+            inputs=sorted(set([ctg, scf])),
+            outputs=[os.path.join("contig_stats", "contiguity.out"),
+            os.path.join("contig_stats", "nx_curve.out")],
+            memory=resources.memory(sample_config))
+    # filter out short contigs
+    threads = resources.threads(sample_config)
+    reference_dir = os.path.join(run_plan.workdir, "reference")
+    new_reference_name = _new_reference_name(reference, reference_dir)
+    run_plan.add("reference", "reference", reference_dir,
+            [plan.python_call("fasta", "filter_fasta", reference,
+            new_reference_name, _min_contig_length(sample_config),
+            processes=threads)], inputs=[reference],
+            outputs=[new_reference_name], threads=threads,
+            memory=resources.memory(sample_config))
+    sample_config["reference"] = new_reference_name
+    for command in _tools(sample_config):
+        plan_fn = getattr(sys.modules[__name__], "_plan_{}".format(command))
+        sample_config = plan_fn(global_config, sample_config,
+                sorted_libraries_by_insert, run_plan)
+    return run_plan
+
+
+def _plan_align(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    if "reference" not in sample_config:
+        print("reference sequence not provided, skypping alignment step.")
+        return sample_config
+    sample_config["alignments"] = align.plan_alignments(global_config,
+            sample_config, sorted_libraries_by_insert, run_plan, "align")
+    return sample_config
+
+
+def _plan_BUSCO(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    program = global_config["Tools"]["BUSCO"]["bin"]
+    options = global_config["Tools"]["BUSCO"]["options"]
+    output = sample_config["output"]
+    run_plan.add("BUSCO", "BUSCO", "BUSCO", [plan.shell(_BUSCO_command(
+        program, options, sample_config), "BUSCO.stdOut", "BUSCO.stdErr",
+        "a")], inputs=[sample_config["reference"]],
+        outputs=[os.path.join("run_{}".format(output),
+        "short_summary_{}".format(output))],
+        threads=resources.threads(sample_config),
+        memory=resources.memory(sample_config))
+    return sample_config
+
+
+def _plan_FRC(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    program = global_config["Tools"]["FRC"]["bin"]
+    output = sample_config["output"]
+    run_plan.add("FRC", "FRC", "FRCurve", [plan.shell(_FRC_command(program,
+        sample_config), "FRC.stdOut", "FRC.stdErr", "a"),
+        plan.python_call("evaluete", "plotFRCurve", output)],
+        inputs=[alignment[1] for alignment in sample_config["alignments"]],
+        outputs=["{}_FRC.png".format(output)],
+        memory=resources.memory(sample_config))
+    return sample_config
+
+
+def _plan_qaTools(global_config, sample_config, sorted_libraries_by_insert,
+        run_plan):
+    program = global_config["Tools"]["qaTools"]["bin"]
+    BAMfile = sample_config["alignments"][0][1]
+    QA_cov_file = "{}.cov".format(os.path.basename(BAMfile))
+    QA_GC_file = "{}.gc".format(QA_cov_file)
+    run_plan.add("qaTools", "qaTools", "QAstats", [plan.shell(
+        _qaTools_command(program, BAMfile), "QAtools.stdOut",
+        "QAtools.stdErr", "a"), plan.python_call("evaluete",
+        "add_GC_content", QA_cov_file, sample_config["reference"],
+        QA_GC_file), plan.python_call("evaluete", "plotQA", QA_GC_file)],
+        inputs=[BAMfile, sample_config["reference"]],
+        outputs=[QA_cov_file, QA_GC_file],
+        memory=resources.memory(sample_config))
+    return sample_config
+
+
+def _computeAssemblyStatsStep(sample_config):
+    computeAssemblyStats(sample_config)
+    return sample_config
 
 
 def _run_align(global_config, sample_config,sorted_libraries_by_insert):
@@ -48,20 +144,19 @@ def _run_align(global_config, sample_config,sorted_libraries_by_insert):
                 "Please provide a reference if you are intrested in aligning",
                 "the reads against a reference")
         return sample_config
-    if not os.path.exists("alignments"):
-        os.makedirs("alignments")
-    os.chdir("alignments")
+    alignments_dir = common.run_dir(sample_config).subdir("alignments")
     sorted_libraries_by_insert =  align._align_reads(global_config,
-            sample_config,  sorted_libraries_by_insert) # align reads
+            sample_config,  sorted_libraries_by_insert,
+            alignments_dir) # align reads
     sorted_alignments_by_insert = align._merge_bam_files(global_config,
-            sample_config, sorted_libraries_by_insert) # merge alignments
+            sample_config, sorted_libraries_by_insert,
+            alignments_dir) # merge alignments
     sorted_alignments_by_insert = align.picard_CGbias(global_config,
             sample_config,sorted_alignments_by_insert) # compute picard stats
     sorted_alignments_by_insert = align.picard_collectInsertSizeMetrics(
             global_config, sample_config,sorted_alignments_by_insert)
     sorted_alignments_by_insert = align.picard_markDuplicates(global_config,
             sample_config,sorted_alignments_by_insert)
-    os.chdir("..")
     sample_config["alignments"] = sorted_alignments_by_insert
     return sample_config
 
@@ -84,7 +179,7 @@ def _check_libraries(sorted_libraries_by_insert):
     return
 
 
-def _build_new_reference(sample_config):
+def _min_contig_length(sample_config):
     minCtgLength = 500
     if "minCtgLength" in sample_config:
         minCtgLength = sample_config["minCtgLength"]
@@ -93,105 +188,89 @@ def _build_new_reference(sample_config):
                     "values will complicate the job of valiadation tools and "
                     "make results difficult to interpret. For mammalian "
                     "genomes minCtgLength > 1Kbp is strongly suggested")
+    return minCtgLength
+
+
+def _new_reference_name(reference, reference_dir):
+    new_reference_name = os.path.basename(reference)
+    if new_reference_name.endswith(".gz"): # aligners want plain fasta
+        new_reference_name = new_reference_name[:-len(".gz")]
+    return os.path.join(reference_dir, new_reference_name)
+
+
+def _build_new_reference(sample_config):
+    minCtgLength = _min_contig_length(sample_config)
     reference = sample_config["reference"]
-    reference_dir = os.path.abspath("reference")
-    if not os.path.exists(reference_dir):
-        os.makedirs(reference_dir)
-    os.chdir(reference_dir)
-    new_reference_name = os.path.abspath(os.path.basename(reference))
+    reference_dir = common.run_dir(sample_config).subdir("reference").path
+    new_reference_name = _new_reference_name(reference, reference_dir)
     if os.path.exists(new_reference_name):
         sample_config["reference"] = new_reference_name
-        os.chdir("..")
         return sample_config # already created the new reference
-    with open(new_reference_name, "w") as new_ref_fd:
-        with open(reference, "r") as ref_fd:
-            fasta_header = ref_fd.readline()
-            sequence  = ""
-            for line in ref_fd:
-                line = line
-                if line.startswith(">"):
-                    if len(sequence) >= minCtgLength:
-                        new_ref_fd.write(fasta_header)
-                        new_ref_fd.write(sequence)
-                    sequence = ""
-                    fasta_header = line
-                else:
-                    sequence+=line
-            if len(sequence) >= minCtgLength:
-                new_ref_fd.write(fasta_header)
-                new_ref_fd.write(sequence)
+    fasta.filter_fasta(reference, new_reference_name, minCtgLength,
+            processes=resources.threads(sample_config))
     sample_config["reference"] = new_reference_name
-    os.chdir("..")
     return sample_config
 
 
 def _run_BUSCO(global_config, sample_config, sorted_alignments_by_insert):
     program = global_config["Tools"]["BUSCO"]["bin"]
     options = global_config["Tools"]["BUSCO"]["options"]
-    main_dir = os.getcwd()
-    BUSCOfolder = os.path.join(main_dir, "BUSCO")
-    if not os.path.exists(BUSCOfolder):
-        os.makedirs(BUSCOfolder)
-    os.chdir(BUSCOfolder)
+    BUSCO_dir = common.run_dir(sample_config).subdir("BUSCO")
+    BUSCOfolder = BUSCO_dir.path
 
     BUSCO_data_path = sample_config["BUSCODataPath"]
     if not os.path.exists(BUSCO_data_path):
         raise IOError("Path to the BUSCO data set does not exist!")
 
-    reference = sample_config["reference"]
     output = sample_config["output"]
-    threads = sample_config.get("threads", 16)
-    command = [program, "-l", BUSCO_data_path, "-in", "{}".format(reference), "-o", "{}".format(output), 
-            "-c", "{}".format(threads)]
-    command.extend(options)
+    command = _BUSCO_command(program, options, sample_config)
     common.print_command(command)
 
     outfile = os.path.join(BUSCOfolder, "run_{}".format(output), 
             "short_summary_{}".format(output))
     if not common.check_dryrun(sample_config) and not os.path.exists(outfile):
-        stdOut = open("BUSCO.stdOut", "a")
-        stdErr = open("BUSCO.stdErr", "a")
-        return_value = subprocess.call(command, stdout=stdOut, stderr=stdErr) 
+        return_value = BUSCO_dir.run(command, stdout="BUSCO.stdOut",
+                stderr="BUSCO.stdErr", mode="a").returncode
         if not return_value == 0:
             sys.exit("Error running BUSCO")
-    os.chdir("..")
+    return sample_config
+
+def _BUSCO_command(program, options, sample_config):
+    command = [program, "-l", sample_config["BUSCODataPath"], "-in",
+            "{}".format(sample_config["reference"]), "-o",
+            "{}".format(sample_config["output"]), "-c",
+            "{}".format(resources.threads(sample_config))]
+    command.extend(options)
+    return command
+
 
 def _run_FRC(global_config, sample_config, sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    FRCurveFolder = os.path.join(os.getcwd(), "FRCurve")
-    if not os.path.exists(FRCurveFolder):
-        os.makedirs(FRCurveFolder)
-    os.chdir("FRCurve")
+    FRCurve_dir = common.run_dir(sample_config).subdir("FRCurve")
     program=global_config["Tools"]["FRC"]["bin"]
 
-    genomeSize = sample_config["genomeSize"]
-    reference = sample_config["reference"]
     output = sample_config["output"]
-    alignments = sample_config["alignments"]
+    command = _FRC_command(program, sample_config)
+    common.print_command(command)
+    if not common.check_dryrun(sample_config) and not FRCurve_dir.exists(
+            "{}_FRC.png".format(output)):
+        returnValue = FRCurve_dir.run(command, stdout="FRC.stdOut",
+                stderr="FRC.stdErr", mode="a").returncode
+        if not returnValue == 0:
+            sys.exit("error, while running FRCurve: {}".format(command))
+        plotFRCurve(FRCurve_dir.join(output))
+    return sample_config
 
+
+def _FRC_command(program, sample_config):
+    alignments = sample_config["alignments"]
     peBam = alignments[0][1]
-    peInsert = alignments[0][0]
-    peMinInsert = int(peInsert - peInsert*0.60)
-    peMaxInsert = int(peInsert + peInsert*0.60)
     command = [program, "--pe-sam", peBam, "--pe-max-insert", "5000"]
     if len(alignments) > 1:
         mpBam = alignments[1][1]
-        mpInsert = alignments[1][0]
-        mpMinInsert = int(mpInsert - mpInsert*0.50)
-        mpMaxInsert = int(mpInsert + mpInsert*0.50)
         command += ["--mp-sam", mpBam, "--mp-max-insert", "25000"]
-    command += [ "--genome-size", "{}".format(genomeSize), "--output", output]
-    common.print_command(command)
-    if not common.check_dryrun(sample_config) and not os.path.exists(
-            "{}_FRC.png".format(output)):
-        stdOut = open("FRC.stdOut", "a")
-        stdErr = open("FRC.stdErr", "a")
-        returnValue = subprocess.call(command , stdout=stdOut , stderr=stdErr)
-        if not returnValue == 0:
-            sys.exit("error, while running FRCurve: {}".format(command))
-        plotFRCurve(output)
-    os.chdir("..")
-    return sample_config
+    command += [ "--genome-size", "{}".format(sample_config["genomeSize"]),
+            "--output", sample_config["output"]]
+    return command
 
 
 def plotFRCurve(output):
@@ -200,6 +279,8 @@ def plotFRCurve(output):
             "HIGH_SINGLE_MP_FRC", "HIGH_SINGLE_PE_FRC", "HIGH_SPAN_MP_FRC",
             "HIGH_SPAN_PE_FRC", "LOW_COV_PE_FRC", "LOW_NORM_COV_PE_FRC",
             "STRECH_MP_FRC", "STRECH_PE_FRC"]
+    import pandas as pd
+    plt = common.pyplot()
     for name in names:
         FRC_data = pd.io.parsers.read_csv("{}{}.txt".format(output, name),
                 sep=' ', header=None)
@@ -217,84 +298,73 @@ def plotFRCurve(output):
 
 
 def _run_qaTools(global_config, sample_config, sorted_libraries_by_insert):
-    mainDir = os.getcwd()
-    qaToolsFolder = os.path.join(os.getcwd(), "QAstats")
-    if not os.path.exists(qaToolsFolder):
-        os.makedirs(qaToolsFolder)
-    os.chdir("QAstats")
+    qaTools_dir = common.run_dir(sample_config).subdir("QAstats")
     program=global_config["Tools"]["qaTools"]["bin"]
 
-    genomeSize = sample_config["genomeSize"]
     reference = sample_config["reference"]
-    output = sample_config["output"]
-    alignments = sample_config["alignments"][0]
-    BAMfile = alignments[1]
+    BAMfile = sample_config["alignments"][0][1]
 
-    command = ["{}".format(program),  "-m",  "-q", "0", "-i",  BAMfile,
-            "{}.cov".format(os.path.basename(BAMfile))]
+    command = _qaTools_command(program, BAMfile)
     common.print_command(command)
+    QA_cov_file = qaTools_dir.join("{}.cov".format(os.path.basename(BAMfile)))
     if not common.check_dryrun(sample_config) and not os.path.exists(
-            "{}.cov".format(os.path.basename(BAMfile))):
-        stdOut = open("QAtools.stdOut", "a")
-        stdErr = open("QAtools.stdErr", "a")
-        returnValue = subprocess.call(command , stdout=stdOut , stderr=stdErr)
+            QA_cov_file):
+        returnValue = qaTools_dir.run(command, stdout="QAtools.stdOut",
+                stderr="QAtools.stdErr", mode="a").returncode
         if not returnValue == 0:
             sys.exit("error, while running QAtools: {}".format(command))
         #now add GC content
-        QAtools_dict = {}
-        header = ""
-        with open( "{}.cov".format(os.path.basename(BAMfile)), "r") as QA_csv:
-            header = QA_csv.readline().rstrip()
-            for line in QA_csv:
-                line = line.strip().split("\t")
-                QAtools_dict[line[0]] = [line[1],line[2],line[3]]
-        QA_GC_file = "{}.cov.gc".format(os.path.basename(BAMfile))
-        with open(QA_GC_file, "w") as QA_GC_fd:
-            QA_GC_fd.write("{}\tGCperc\n".format(header))
-            with open(reference, "r") as ref_fd:
-                fasta_raw_header = ref_fd.readline().strip()
-                fasta_raw_header = fasta_raw_header.split(" ")[0]
-                fasta_raw_header = fasta_raw_header.split("\t")[0]
-                fasta_header = fasta_raw_header.split(">")[1]
-                sequence = ""
-                for line in ref_fd:
-                    line = line.strip()
-                    if line.startswith(">"):
-                        GC = computeGC(sequence)
-                        if fasta_header not in QAtools_dict:
-                            sys.exit("error while parsing QAcompute output: "
-                                    "probably some wired contig name is "
-                                    "present in your assmebly file")
-                        QA_GC_fd.write("{}\t{}\t{}\t{}\t{}\n".format(
-                            fasta_header, QAtools_dict[fasta_header][0],
-                            QAtools_dict[fasta_header][1],
-                            QAtools_dict[fasta_header][2], GC))
-                        sequence = ""
-                        fasta_raw_header = line.split(" ")[0]
-                        fasta_raw_header = fasta_raw_header.split("\t")[0]
-                        fasta_header = fasta_raw_header.split(">")[1]
-                    else:
-                        sequence+=line
-                GC = computeGC(sequence)
+        QA_GC_file = "{}.gc".format(QA_cov_file)
+        add_GC_content(QA_cov_file, reference, QA_GC_file)
+        plotQA(QA_GC_file)
+    return sample_config
+
+
+def _qaTools_command(program, BAMfile):
+    return ["{}".format(program),  "-m",  "-q", "0", "-i",  BAMfile,
+            "{}.cov".format(os.path.basename(BAMfile))]
+
+
+def add_GC_content(QA_cov_file, reference, QA_GC_file):
+    """ writes the QAtools coverage table with the GC content of each contig
+    of reference as last column"""
+    QAtools_dict = {}
+    header = ""
+    with open(QA_cov_file, "r") as QA_csv:
+        header = QA_csv.readline().rstrip()
+        for line in QA_csv:
+            line = line.strip().split("\t")
+            QAtools_dict[line[0]] = [line[1],line[2],line[3]]
+    with open(QA_GC_file, "w") as QA_GC_fd:
+        QA_GC_fd.write("{}\tGCperc\n".format(header))
+        records = common.read_fasta(reference)
+        while True:
+            batch = list(itertools.islice(records, QA_GC_BATCH))
+            if not batch:
+                break
+            GCs = assembly_stats.batch_composition(
+                    [record.sequence for record in batch]).gc_fraction
+            for record, GC in zip(batch, GCs):
+                fasta_header = record.name
                 if fasta_header not in QAtools_dict:
-                    sys.exit("error while parsing QAcompute output: probably "
-                            "some wired contig name is present in your "
-                            "assmebly file")
-                QA_GC_fd.write("{}\t{}\t{}\t{}\t{}\n".format(fasta_header,
-                    QAtools_dict[fasta_header][0],
+                    sys.exit("error while parsing QAcompute output: "
+                            "probably some wired contig name is present "
+                            "in your assmebly file")
+                QA_GC_fd.write("{}\t{}\t{}\t{}\t{}\n".format(
+                    fasta_header, QAtools_dict[fasta_header][0],
                     QAtools_dict[fasta_header][1],
                     QAtools_dict[fasta_header][2], GC))
-        plotQA(QA_GC_file)
-    os.chdir("..")
-    return sample_config
 
 
 def plotQA(QA_GC_file):
-    #QA_GC_file="lib_500.bam.cov.gc"
+    #QA_GC_file="lib_500.bam.cov.gc", the plots are written next to it
     import shutil as sh
-    sh.copy(QA_GC_file, "Contigs_Cov_SeqLen_GC.csv")
-    QA_data = pd.io.parsers.read_csv("Contigs_Cov_SeqLen_GC.csv",
-            sep='\t', header=0)
+    import pandas as pd
+    plt = common.pyplot()
+    folder = os.path.dirname(QA_GC_file)
+    sh.copy(QA_GC_file, os.path.join(folder, "Contigs_Cov_SeqLen_GC.csv"))
+    QA_data = pd.io.parsers.read_csv(os.path.join(folder,
+        "Contigs_Cov_SeqLen_GC.csv"), sep='\t', header=0)
     GCperc = QA_data['GCperc'].tolist()
     MedianCov = QA_data['Median_Cov'].tolist()
     SeqLen = QA_data['Seq_len'].tolist()
@@ -308,7 +378,7 @@ def plotQA(QA_GC_file):
     plt.xlabel('%GC')
     plt.ylabel('Coverage')
     plotname = "GC_vs_Coverage.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
     # GC_vs_median eliminate outliers
     plt.plot(GCperc, MedianCov, 'or')
@@ -317,7 +387,7 @@ def plotQA(QA_GC_file):
     plt.xlabel('%GC')
     plt.ylabel('Coverage')
     plotname = "GC_vs_Coverage_noOutliers.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
 
     #Coverage Distribution Histogram
@@ -326,7 +396,7 @@ def plotQA(QA_GC_file):
     plt.ylabel('Frequency')
     plt.title('Coverage Distribution')
     plotname = "Coverage_distribution.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
     #Coverage Distribution Histogram eliminate outliers
     n, bins, patches = plt.hist(MedianCov, 100, facecolor='g',
@@ -335,7 +405,7 @@ def plotQA(QA_GC_file):
     plt.ylabel('Frequency')
     plt.title('Coverage Distribution')
     plotname = "Coverage_distribution_noOutliers.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
 
     #Median Cov vs Sequence Length
@@ -344,7 +414,7 @@ def plotQA(QA_GC_file):
     plt.xlabel('Median Coverage')
     plt.ylabel('Contig Length (Kbp)')
     plotname = "MedianCov_vs_CtgLength.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
     #Median Cov vs Sequence Length eliminate outliers
     plt.plot(MedianCov, map(lambda x: x/1000, SeqLen), 'ro')
@@ -353,7 +423,7 @@ def plotQA(QA_GC_file):
     plt.xlabel('Median Coverage')
     plt.ylabel('Contig Length (Kbp)')
     plotname = "MedianCov_vs_CtgLength_noOutliers.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
 
     #GC content vs Contig length
@@ -362,25 +432,19 @@ def plotQA(QA_GC_file):
     plt.xlabel('%GC')
     plt.ylabel('Contig Length (Kbp)')
     plotname = "GC_vs_CtgLength.png"
-    plt.savefig(plotname)
+    plt.savefig(os.path.join(folder, plotname))
     plt.clf()
     return 0
 
 
 def computeGC(sequence):
-    gcCount = len(re.findall("[GC]", sequence)) + len(
-            re.findall("[gc]", sequence))
-    totalBaseCount = len(re.findall("[GCTA]", sequence)) + len(
-            re.findall("[gcta]", sequence))
-    gcFraction = float(gcCount) / totalBaseCount
-    return gcFraction
+    return assembly_stats.base_composition(sequence).gc_fraction
 
 
 def computeAssemblyStats(sample_config):
 
-    outfile = os.path.join("contig_stats", "contiguity.out")
-    if not os.path.exists("contig_stats"):
-        os.makedirs("contig_stats")
+    stats_dir = common.run_dir(sample_config).subdir("contig_stats")
+    outfile = stats_dir.join("contiguity.out")
     minlength = sample_config.get("minCtgLength", 1000)
     sequence = sample_config["reference"]
     genomesize = sample_config["genomeSize"]
@@ -388,64 +452,12 @@ def computeAssemblyStats(sample_config):
     ctg = re.sub("scf.fasta$", "ctg.fasta", sequence)
     scf = re.sub("ctg.fasta$", "scf.fasta", sequence)
 
-    def asm_stats(sequence):
-        stats = OrderedDict()
-        stats["assembly type"] = "" 
-        stats["# sequences"] = 0 
-        stats["assembly length"] = 0
-        stats["trim shorter than(bp)"] = minlength
-        stats["# trimmed sequences"] = 0 
-        stats["trimmed assembly length"] = 0
-        stats["N50"] = 0 
-        stats["N80"] = 0 
-        stats["NG50"] = 0 
-        stats["NG80"] = 0
-        stats["longest seq"] = 0
-        sequence_lengths = []
-
-        with open(sequence, "r") as seq_file:
-            # Groupby iterator. Should work for fasta of any column width 
-            fai = groupby(seq_file, lambda x: x.startswith(">"))
-            while True:
-                try:
-                    _, header = next(fai)
-                    _, sequence = next(fai)
-                except StopIteration:
-                    break
-                # Collect fasta sequence stats
-                seq_len = sum([len(i.strip()) for i in sequence])
-                sequence_lengths.append(seq_len)
-                stats["# sequences"] += 1
-                stats["assembly length"] += seq_len
-                if seq_len > minlength:
-                    stats["# trimmed sequences"] += 1
-                    stats["trimmed assembly length"] += seq_len
-                if seq_len > stats["longest seq"]:
-                    stats["longest seq"] = seq_len
-
-        sequence_lengths = sorted(sequence_lengths, reverse=True)
-        test_sum = 0
-        for sequence in sequence_lengths:
-            test_sum += sequence
-            if stats["assembly length"] * 0.5 < test_sum and stats["N50"] is 0:
-                stats["N50"] = sequence
-            if stats["assembly length"] * 0.8 < test_sum and stats["N80"] is 0:
-                stats["N80"] = sequence
-            if genomesize * 0.5 < test_sum and stats["NG50"] is 0:
-                stats["NG50"] = sequence
-            if genomesize * 0.8 < test_sum and stats["NG80"] is 0:
-                stats["NG80"] = sequence
-
-        return stats
-
-    ctg_stats = asm_stats(ctg)
-    ctg_stats["assembly type"] = "contigs"
-    scf_stats = asm_stats(scf)
-    scf_stats["assembly type"] = "scaffolds"
-
-    with open(outfile, "w") as out:
-        out.write('\t'.join(ctg_stats.keys()))
-        out.write('\n')
-        for asm in [ctg_stats, scf_stats]:
-            out.write('\t'.join(map(str, asm.values())))
-            out.write('\n')
+    ctg_stats = assembly_stats.compute_assembly_stats(ctg, minlength,
+            genomesize)
+    scf_stats = ctg_stats
+    if scf != ctg:
+        scf_stats = assembly_stats.compute_assembly_stats(scf, minlength,
+                genomesize)
+    assemblies = [("contigs", ctg_stats), ("scaffolds", scf_stats)]
+    assembly_stats.write_contiguity(outfile, assemblies)
+    assembly_stats.write_nx_curve(stats_dir.join("nx_curve.out"), assemblies)
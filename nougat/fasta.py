@@ -0,0 +1,431 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import io
+import gzip
+import mmap
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from nougat import common, cache
+
+IUPAC_COMPLEMENTS = {
+    "A": "T",
+    "T": "A",
+    "G": "C",
+    "C": "G",
+    "Y": "R",
+    "R": "Y",
+    "W": "W",
+    "S": "S",
+    "K": "M",
+    "M": "K",
+    "D": "H",
+    "H": "D",
+    "V": "B",
+    "B": "V",
+    "N": "N"
+}
+
+
+def _complement_table():
+    """ translation table complementing every IUPAC code in both cases,
+    any other byte becomes N"""
+    table = bytearray(b"N" * 256)
+    for base, complement in IUPAC_COMPLEMENTS.items():
+        table[ord(base)] = ord(complement)
+        table[ord(base.lower())] = ord(complement.lower())
+    return bytes(table)
+
+_COMPLEMENT = _complement_table()
+
+# filter_fasta splits plain inputs in byte ranges of at least this size
+FILTER_SPLIT_SIZE = 64 * 1024 * 1024
+FILTER_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class FastaIndexEntry(namedtuple("FastaIndexEntry", ["name", "length",
+        "offset", "linebases", "linewidth"])):
+    """ one line of a .fai index: sequence name and length, byte offset of
+    the first base, bases per line and bytes per line"""
+    __slots__ = ()
+
+    def byte_offset(self, position):
+        """ offset in the file of the base at 0-based position"""
+        if self.linebases == 0:
+            return self.offset
+        return self.offset + (position // self.linebases) * self.linewidth \
+                + position % self.linebases
+
+
+def index_file_name(fasta):
+    return "{}.fai".format(fasta)
+
+
+def lengths_file_name(fasta):
+    return "{}.lengths".format(fasta)
+
+
+def build_fasta_index(fasta, index=None):
+    """ writes a samtools faidx compatible index of fasta and returns its
+    entries (an OrderedDict name -> FastaIndexEntry). As in samtools all the
+    lines of a sequence but the last must have the same length."""
+    if index is None:
+        index = index_file_name(fasta)
+    entries = OrderedDict()
+    with open(fasta, "rb") as fasta_fd:
+        offset = 0
+        current = None
+        last_line = False # a line shorter than linebases has been seen
+        for line in fasta_fd:
+            if line.startswith(b">"):
+                if current is not None:
+                    entries[current[0]] = FastaIndexEntry(*current)
+                fields = line[1:].split()
+                name = fields[0].decode("utf-8", "replace") if fields else ""
+                if name in entries:
+                    raise ValueError("sequence {} present more than once in "
+                            "{}".format(name, fasta))
+                current = [name, 0, offset + len(line), 0, 0]
+                last_line = False
+            elif current is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases > 0:
+                    if current[3] == 0:
+                        current[3] = bases
+                        current[4] = len(line)
+                    elif last_line or bases > current[3]:
+                        raise ValueError("different line length in sequence "
+                                "{} of {}".format(current[0], fasta))
+                    current[1] += bases
+                if bases < current[3] or len(line) != current[4]:
+                    last_line = True
+            offset += len(line)
+        if current is not None:
+            entries[current[0]] = FastaIndexEntry(*current)
+    with open(index, "w") as index_fd:
+        for entry in entries.values():
+            index_fd.write("\t".join(map(str, entry)))
+            index_fd.write("\n")
+    return entries
+
+
+def load_fasta_index(fasta, index=None):
+    """ reads the .fai index of fasta, (re)building it when missing or older
+    than fasta"""
+    if index is None:
+        index = index_file_name(fasta)
+    if not os.path.exists(index) or \
+            os.path.getmtime(index) < os.path.getmtime(fasta):
+        return build_fasta_index(fasta, index)
+    entries = OrderedDict()
+    with open(index, "r") as index_fd:
+        for line in index_fd:
+            fields = line.rstrip("\n").split("\t")
+            entries[fields[0]] = FastaIndexEntry(fields[0],
+                    *[int(field) for field in fields[1:5]])
+    return entries
+
+
+def complement(sequence):
+    """ complement of a bytes-like sequence (bytes, bytearray, memoryview),
+    case is preserved and non IUPAC characters become N"""
+    return memoryview(sequence).tobytes().translate(_COMPLEMENT)
+
+
+def reverse_complement(sequence):
+    """ reverse complement of a bytes-like sequence"""
+    return memoryview(sequence).tobytes()[::-1].translate(_COMPLEMENT)
+
+
+def reverse_complement_batch(sequences):
+    """ reverse complements a list of fragments with a single translation of
+    their concatenation, returns a list of bytes in the same order"""
+    lengths = [len(sequence) for sequence in sequences]
+    reversed_all = reverse_complement(b"".join(sequences))
+    fragments = []
+    end = len(reversed_all)
+    for length in lengths:
+        fragments.append(reversed_all[end - length:end])
+        end -= length
+    return fragments
+
+
+class FastaFile(object):
+    """ random access to an indexed fasta file.
+
+    The file is memory mapped read-only, so only the pages holding the
+    requested bases are read from disk and no sequence is kept in memory.
+    fetch returns a memoryview over the mapped file whenever the region lies
+    on a single line (i.e., always for one-line-per-sequence files). On
+    python 2, where mmap objects do not export a buffer, the region is copied
+    out of the map instead."""
+
+    def __init__(self, fasta, index=None):
+        self.fasta = fasta
+        self.index = load_fasta_index(fasta, index)
+        self._fd = open(fasta, "rb")
+        if os.path.getsize(fasta) > 0:
+            self._map = mmap.mmap(self._fd.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            self._view = None # python 2 mmap, sliced directly
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def lengths(self):
+        """ returns a dictionary sequence name -> length"""
+        return OrderedDict((name, entry.length) for name, entry in
+                self.index.items())
+
+    def fetch(self, name, start=0, end=None, strand="+"):
+        """ returns the bases [start, end) (0-based) of sequence name as a
+        memoryview, reverse complemented if strand is '-'"""
+        entry = self.index[name]
+        if end is None or end > entry.length:
+            end = entry.length
+        start = max(start, 0)
+        if start >= end:
+            return memoryview(b"")
+        first, last = entry.byte_offset(start), entry.byte_offset(end - 1) + 1
+        if self._view is not None:
+            region = self._view[first:last]
+        else:
+            region = memoryview(self._map[first:last])
+        if start // entry.linebases != (end - 1) // entry.linebases:
+            region = memoryview(region.tobytes().translate(None, b"\r\n"))
+        if strand == "-":
+            region = memoryview(reverse_complement(region))
+        return region
+
+    def close(self):
+        if hasattr(self._view, "release"):
+            self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                pass # slices still referenced, closed when collected
+        self._fd.close()
+
+
+class _FastaWriter(object):
+    """ buffered fasta output keeping track of the .fai entry and length of
+    every record written. Everything is written under temporary names and
+    renamed to output, its .fai and .lengths only by close(commit=True)"""
+
+    def __init__(self, output, line_width):
+        self.output = output
+        self.line_width = line_width
+        self.compressed = output.endswith(".gz")
+        self.temporary = cache.temporary_name(output)
+        if self.compressed:
+            self._fd = gzip.open(self.temporary, "wb")
+        else:
+            self._fd = io.open(self.temporary, "wb",
+                    buffering=FILTER_BUFFER_SIZE)
+        self.offset = 0
+        self.entries = OrderedDict()
+
+    def _add(self, header, length):
+        header_line = ">{}\n".format(header).encode("utf-8")
+        self._fd.write(header_line)
+        self.offset += len(header_line)
+        name = common.FastaRecord(header, length, None).name
+        linebases = min(self.line_width, length)
+        linewidth = linebases + 1 if length > 0 else 0
+        self.entries[name] = FastaIndexEntry(name, length, self.offset,
+                linebases, linewidth)
+        self.offset += _wrapped_size(length, self.line_width)
+
+    def write(self, header, sequence):
+        self._add(header, len(sequence))
+        _write_wrapped(self._fd, sequence, self.line_width)
+
+    def write_wrapped(self, header, length, body_fd):
+        """ copies an already wrapped sequence of length bases from body_fd"""
+        self._add(header, length)
+        _copy_bytes(body_fd, self._fd, _wrapped_size(length, self.line_width))
+
+    def close(self, commit=True):
+        self._fd.close()
+        if not commit:
+            os.remove(self.temporary)
+            return
+        temporaries = [lengths_file_name(self.temporary)]
+        outputs = [lengths_file_name(self.output)]
+        with open(temporaries[0], "w") as lengths_fd:
+            for entry in self.entries.values():
+                lengths_fd.write("{}\t{}\n".format(entry.name, entry.length))
+        if not self.compressed: # a .fai needs uncompressed (or bgzip) data
+            temporaries.append(index_file_name(self.temporary))
+            outputs.append(index_file_name(self.output))
+            with open(temporaries[-1], "w") as index_fd:
+                for entry in self.entries.values():
+                    index_fd.write("\t".join(map(str, entry)))
+                    index_fd.write("\n")
+        # output last, its existence tells the filter is complete
+        cache.commit_outputs(temporaries + [self.temporary],
+                outputs + [self.output])
+
+
+def _wrapped_size(length, line_width):
+    """ bytes taken by length bases wrapped every line_width bases"""
+    return length + (length + line_width - 1) // line_width
+
+
+def _write_wrapped(fd, sequence, line_width):
+    view = memoryview(sequence)
+    for start in range(0, len(view), line_width):
+        fd.write(view[start:start + line_width])
+        fd.write(b"\n")
+
+
+def _copy_bytes(source, destination, size):
+    while size > 0:
+        block = source.read(min(size, FILTER_BUFFER_SIZE))
+        if not block:
+            raise IOError("unexpected end of file")
+        destination.write(block)
+        size -= len(block)
+
+
+class _RangeReader(object):
+    """ file-like view of the bytes [start, end) of a file"""
+
+    def __init__(self, fd, start, end):
+        self._fd = fd
+        self._fd.seek(start)
+        self._left = end - start
+
+    def read(self, size):
+        data = self._fd.read(min(size, self._left))
+        self._left -= len(data)
+        return data
+
+
+def _fasta_ranges(fasta, parts):
+    """ splits fasta in at most parts byte ranges, each one starting with
+    '>' so that it can be parsed on its own"""
+    size = os.path.getsize(fasta)
+    boundaries = [0]
+    with open(fasta, "rb") as fasta_fd:
+        for part in range(1, parts):
+            # a header starts right after a newline, look from one byte before
+            scanned = max(size * part // parts, boundaries[-1] + 1) - 1
+            fasta_fd.seek(scanned)
+            tail = b""
+            boundary = None
+            while boundary is None:
+                block = fasta_fd.read(FILTER_BUFFER_SIZE)
+                if not block:
+                    break
+                found = (tail + block).find(b"\n>")
+                if found != -1:
+                    boundary = scanned - len(tail) + found + 1
+                tail = block[-1:]
+                scanned += len(block)
+            if boundary is None:
+                break
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if end > start]
+
+
+def _filter_range(job):
+    """ filters the records of a byte range of fasta writing their wrapped
+    sequences (no header) to part, returns the number of records in the
+    range and (position in range, header, length) of the kept ones"""
+    fasta, start, end, min_length, line_width, part = job
+    kept = []
+    records = 0
+    with open(fasta, "rb") as fasta_fd, \
+            io.open(part, "wb", buffering=FILTER_BUFFER_SIZE) as part_fd:
+        for record in common._parse_fasta(_RangeReader(fasta_fd, start, end),
+                False, common.FASTA_CHUNK_SIZE):
+            if record.length >= min_length:
+                kept.append((records, record.header, record.length))
+                _write_wrapped(part_fd, record.sequence, line_width)
+            records += 1
+    return records, kept
+
+
+def _new_header(rename, position, header):
+    if rename is None:
+        return header
+    return rename.format(position)
+
+
+def filter_fasta(fasta, output, min_length=0, rename=None, processes=1,
+        line_width=common.FASTA_LINE_WIDTH):
+    """ writes to output the records of fasta at least min_length bp long,
+    together with output.fai (unless output is gzipped) and a name -> length
+    table in output.lengths, in a single streaming pass. The files are
+    renamed in place once complete, output last.
+
+    fasta can be gzip/bgzip compressed, output is gzipped when it ends with
+    .gz. If rename is given (e.g. "contig{}") records are named after their
+    1-based position in fasta. Plain inputs larger than FILTER_SPLIT_SIZE are
+    split at '>' boundaries and the ranges filtered by processes workers.
+    Returns an OrderedDict name -> length of the kept records."""
+    writer = _FastaWriter(output, line_width)
+    parts = 1
+    if processes > 1 and not common.is_gzipped(fasta):
+        parts = min(processes, os.path.getsize(fasta) // FILTER_SPLIT_SIZE)
+    completed = False
+    try:
+        if parts <= 1:
+            for position, record in enumerate(common.read_fasta(fasta), 1):
+                if record.length >= min_length:
+                    writer.write(_new_header(rename, position, record.header),
+                            record.sequence)
+        else:
+            _filter_fasta_parallel(fasta, writer, min_length, rename, parts)
+        completed = True
+    finally:
+        writer.close(commit=completed)
+    return OrderedDict((name, entry.length) for name, entry in
+            writer.entries.items())
+
+
+def _filter_fasta_parallel(fasta, writer, min_length, rename, parts):
+    ranges = _fasta_ranges(fasta, parts)
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(
+        os.path.abspath(writer.output)))
+    try:
+        jobs = [(fasta, start, end, min_length, writer.line_width,
+            os.path.join(work_dir, "part{}".format(i)))
+            for i, (start, end) in enumerate(ranges)]
+        pool = multiprocessing.Pool(len(jobs))
+        try:
+            results = pool.map(_filter_range, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        position = 1
+        for job, (records, kept) in zip(jobs, results):
+            with io.open(job[-1], "rb",
+                    buffering=FILTER_BUFFER_SIZE) as part_fd:
+                for index, header, length in kept:
+                    writer.write_wrapped(_new_header(rename, position + index,
+                        header), length, part_fd)
+            os.remove(job[-1])
+            position += records
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import copy
+import json
+import time
+from nougat import common
+
+
+def journal_file_name(sample_config):
+    return "{}.journal".format(sample_config.get("output", "sample"))
+
+
+def config_delta(before, after):
+    """ top level sample_config keys changed by a step and the text it
+    appended to the commands log"""
+    delta = dict((key, value) for key, value in after.items()
+            if key != "commands" and (key not in before or
+            before[key] != value))
+    removed = [key for key in before if key not in after]
+    commands = after.get("commands", "")
+    logged = before.get("commands", "")
+    if commands.startswith(logged):
+        commands = commands[len(logged):]
+    return delta, removed, commands
+
+
+class Journal(object):
+    """ append-only log of the completed pipeline steps.
+
+    After every step a json line with the sample_config delta, the commands
+    logged, the outputs and the timings is appended and flushed to disk. With
+    resume the existing journal is read: replay() applies the deltas of the
+    completed steps to a fresh sample_config and done() tells which steps can
+    be skipped. A Journal without path records nothing."""
+
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.completed = []
+        if path is not None and resume and os.path.exists(path):
+            with open(path, "r") as journal_fd:
+                for line in journal_fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break # last line cut by a crash
+                    if entry.get("status") == "done":
+                        self.completed.append(entry)
+        elif path is not None and os.path.exists(path):
+            os.rename(path, "{}.{}".format(path, int(time.time())))
+        self._done = set(entry["step"] for entry in self.completed)
+
+    def done(self, step):
+        return step in self._done
+
+    def replay(self, sample_config):
+        """ applies to sample_config the changes of the completed steps"""
+        for entry in self.completed:
+            print("resuming: step {} already completed".format(entry["step"]))
+            sample_config.update(copy.deepcopy(entry["delta"]))
+            for key in entry.get("removed", []):
+                sample_config.pop(key, None)
+            sample_config["commands"] = sample_config.get("commands", "") + \
+                    entry.get("commands", "")
+        return sample_config
+
+    def started(self, step):
+        self._append({"step": step, "status": "started",
+            "time": time.time()})
+
+    def record(self, step, delta, removed=(), commands="", start=None,
+            end=None, outputs=()):
+        """ appends the completion of step, outputs are the files it wrote
+        besides the ones referenced in delta"""
+        if end is None:
+            end = time.time()
+        self._append({"step": step, "status": "done", "delta": delta,
+            "removed": list(removed), "commands": commands,
+            "outputs": list(outputs) + _paths(delta), "start": start,
+            "end": end, "wall": None if start is None else end - start})
+        self._done.add(step)
+
+    def run_step(self, step, sample_config, command_fn, *args):
+        """ calls command_fn(*args), which returns the updated sample_config,
+        and records it, unless step is already completed"""
+        if self.done(step):
+            return sample_config
+        before = copy.deepcopy(sample_config)
+        start = time.time()
+        self.started(step)
+        common.set_profile_step(step)
+        sample_config = command_fn(*args)
+        if not isinstance(sample_config, dict):
+            sys.exit("error: step {} did not return the sample config".format(
+                step))
+        self.record_step(step, before, sample_config, start)
+        return sample_config
+
+    def record_step(self, step, before, after, start=None, outputs=()):
+        """ records step computing its delta from the sample_config before
+        and after running it"""
+        delta, removed, commands = config_delta(before, after)
+        self.record(step, delta, removed, commands, start, outputs=outputs)
+
+    def _append(self, entry):
+        if self.path is None:
+            return
+        with open(self.path, "a") as journal_fd:
+            journal_fd.write(json.dumps(entry, sort_keys=True))
+            journal_fd.write("\n")
+            journal_fd.flush()
+            os.fsync(journal_fd.fileno())
+
+
+def _paths(value):
+    """ existing files and folders referenced by a delta"""
+    if isinstance(value, dict):
+        return [path for item in value.values() for path in _paths(item)]
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in _paths(item)]
+    if isinstance(value, str) and os.path.isabs(value) and \
+            os.path.exists(value):
+        return [value]
+    return []
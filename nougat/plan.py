@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import copy
+import json
+from collections import namedtuple, OrderedDict
+from nougat import registry, resources
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+class Task(namedtuple("Task", ["name", "step", "workdir", "commands",
+        "inputs", "outputs", "files", "threads", "memory", "needs"])):
+    """ a unit of work of a plan: shell commands run one after the other in
+    workdir, the files they read and write, the files written before
+    running them (path -> content, e.g., assembler configurations), the
+    threads and memory (MB) they are granted and the names of the tasks
+    they wait for"""
+    __slots__ = ()
+
+
+class Plan(object):
+    """ the execution graph of a sample, built without touching the
+    filesystem.
+
+    Tasks are added in execution order; a task depends on the tasks it is
+    explicitly said to need and on the ones writing any of its inputs, so
+    that the graph can be run by any scheduler (the Makefile export by make
+    -j) and gives the same results as a sequential run."""
+
+    def __init__(self, sample_config, workdir=None):
+        self.sample = sample_config.get("output", "sample")
+        self.pipeline = sample_config.get("pipeline")
+        self.workdir = os.path.abspath(workdir or os.getcwd())
+        self.tasks = []
+        self._writers = {} # output -> name of the task writing it
+
+    def add(self, name, step, workdir, commands, inputs=(), outputs=(),
+            files=None, threads=1, memory=None, needs=()):
+        """ adds a task, workdir is relative to the plan folder, inputs and
+        outputs are relative to workdir. Returns the task name"""
+        workdir = os.path.normpath(os.path.join(self.workdir, workdir))
+        inputs = [os.path.normpath(os.path.join(workdir, path)) for path in
+                inputs if path is not None]
+        outputs = [os.path.normpath(os.path.join(workdir, path)) for path in
+                outputs]
+        files = OrderedDict((os.path.normpath(os.path.join(workdir, path)),
+            content) for path, content in (files or {}).items())
+        needs = list(needs)
+        for path in inputs:
+            writer = self._writers.get(path)
+            if writer is not None and writer not in needs:
+                needs.append(writer)
+        for path in list(outputs) + list(files):
+            self._writers[path] = name
+        self.tasks.append(Task(name, step, workdir, [_command_string(command)
+            for command in commands], inputs, outputs, files, threads,
+            memory, needs))
+        return name
+
+    def to_dict(self):
+        return OrderedDict([("sample", self.sample),
+            ("pipeline", self.pipeline),
+            ("workdir", self.workdir),
+            ("threads", max([task.threads for task in self.tasks] or [0])),
+            ("memory", max([task.memory or 0 for task in self.tasks] or [0])),
+            ("tasks", [OrderedDict(zip(Task._fields, task)) for task in
+                self.tasks])])
+
+    def write_json(self, path):
+        with open(path, "w") as plan_fd:
+            json.dump(self.to_dict(), plan_fd, indent=2)
+            plan_fd.write("\n")
+
+    def write_makefile(self, path):
+        """ one phony target per task, named after it, and an all target;
+        make -j N runs the independent tasks together"""
+        names = [task.name for task in self.tasks]
+        with open(path, "w") as makefile:
+            makefile.write("# execution plan of sample {} (pipeline {})\n"
+                    "SHELL := /bin/bash\n\n".format(self.sample,
+                    self.pipeline))
+            makefile.write(".PHONY: all {}\n\n".format(" ".join(names)))
+            makefile.write("all: {}\n\n".format(" ".join(names)))
+            for task in self.tasks:
+                makefile.write("# {} threads, {} MB\n".format(task.threads,
+                    task.memory))
+                makefile.write("{}: {}\n".format(task.name,
+                    " ".join(task.needs)).rstrip() + "\n")
+                recipe = ["mkdir -p {}".format(quote(task.workdir))]
+                for path, content in task.files.items():
+                    recipe.append("printf '%s\\n' {} > {}".format(" ".join(
+                        quote(line) for line in
+                        content.rstrip("\n").split("\n")), quote(path)))
+                recipe.extend("cd {} && {}".format(quote(task.workdir),
+                    command) for command in task.commands)
+                for line in recipe:
+                    # make expands $ in recipes
+                    makefile.write("\t{}\n".format(line.replace("$", "$$")))
+                makefile.write("\n")
+
+    def write(self, path):
+        """ writes the plan as json if path ends in .json, as a Makefile
+        otherwise"""
+        if path.endswith(".json"):
+            self.write_json(path)
+        else:
+            self.write_makefile(path)
+
+
+def _command_string(command):
+    if isinstance(command, (list, tuple)):
+        return " ".join(str(part) for part in command if part is not None)
+    return command
+
+
+def shell(command, stdout=None, stderr=None, mode="w"):
+    """ command (a list or a string) as a shell line redirecting its output
+    the way common.run_command does"""
+    command = _command_string(command)
+    if "|" in command and (stdout is not None or stderr is not None):
+        command = "({})".format(command) # the whole pipeline is redirected
+    redirect = ">>" if mode == "a" else ">"
+    if stdout is not None:
+        command = "{} {} {}".format(command, redirect, stdout)
+    if stderr is not None:
+        command = "{} 2{} {}".format(command, redirect, stderr)
+    return command
+
+
+def python_call(module, function, *args, **kwargs):
+    """ shell line calling a nougat function, for the steps the pipeline
+    runs in process (e.g., filtering or plotting)"""
+    arguments = [repr(arg) for arg in args] + ["{}={!r}".format(key, value)
+            for key, value in sorted(kwargs.items())]
+    return "{} -c {}".format(quote(sys.executable), quote(
+        "from nougat import {0}; {0}.{1}({2})".format(module, function,
+        ", ".join(arguments))))
+
+
+def compile_plan(global_config, sample_config, workdir=None, allocation=None):
+    """ resolves every step the pipeline of sample_config would run into a
+    Plan, sample_config is not modified"""
+    sample_config = copy.deepcopy(sample_config)
+    resources.grant(sample_config, allocation)
+    sample_config.setdefault("commands", "")
+    run_plan = Plan(sample_config, workdir or sample_config.get("workdir"))
+    plan_steps = registry.pipeline_function(sample_config["pipeline"],
+            "plan_steps")
+    plan_steps(global_config, sample_config, run_plan)
+    return run_plan
@@ -0,0 +1,33 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import importlib
+from collections import OrderedDict
+
+# pipeline (as named in the Pipelines section of the global config) -> module
+# with its run(global_config, sample_config, journal) function and steps.
+# Modules are imported only when their pipeline runs, so that validating a
+# config does not load the analysis and plotting libraries.
+PIPELINES = OrderedDict([
+    ("QCcontrol", "nougat.QCcontrol"),
+    ("assemble",  "nougat.assemble"),
+    ("evaluete",  "nougat.evaluete"),
+    ])
+
+
+def register(pipeline, module):
+    """ adds a pipeline implemented outside nougat, module is the name of a
+    module importable when the pipeline runs"""
+    PIPELINES[pipeline] = module
+
+
+def pipeline_module(pipeline):
+    """ imports (on first use) and returns the module of pipeline"""
+    if pipeline not in PIPELINES:
+        sys.exit("Error: pipeline {} has no implementation, implemented "
+                "pipelines are: {}".format(pipeline, list(PIPELINES)))
+    return importlib.import_module(PIPELINES[pipeline])
+
+
+def pipeline_function(pipeline, function="run"):
+    return getattr(pipeline_module(pipeline), function)
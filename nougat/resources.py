@@ -0,0 +1,269 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import re
+import tempfile
+import threading
+import multiprocessing
+from collections import namedtuple
+
+# memory (MB) left to the pipeline itself and to the page cache
+MEMORY_RESERVE = 1024
+# share of a memory grant given to a JVM heap (the JVM needs some more)
+JAVA_HEAP_FRACTION = 0.75
+MIN_JAVA_HEAP = 512
+# share of a memory grant used by the samtools sort buffers (one per thread)
+SORT_MEMORY_FRACTION = 0.75
+MIN_SORT_MEMORY = 64
+
+_MEMORY_UNITS = {"K": 1.0 / 1024, "M": 1, "G": 1024, "T": 1024 * 1024}
+_allocation = None
+
+
+class Allocation(namedtuple("Allocation", ["cpus", "memory", "source"])):
+    """ CPUs and memory (MB) the pipeline can use, source tells where they
+    were read from (cli, slurm, cgroup or node)"""
+    __slots__ = ()
+
+
+def parse_memory(memory):
+    """ memory in MB from a number of MB or a string such as 16G or 500M"""
+    if memory is None or isinstance(memory, (int, float)):
+        return memory
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", memory.upper())
+    if not match:
+        raise ValueError("invalid memory size {}".format(memory))
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2) or "M"])
+
+
+def detect_allocation(cpus=None, memory=None):
+    """ the CPUs and memory of this run: the ones given (e.g., on the command
+    line), otherwise the ones of the SLURM job, otherwise the cgroup limits,
+    otherwise the whole node. The result is remembered and returned by the
+    following calls without arguments."""
+    global _allocation
+    if cpus is None and memory is None and _allocation is not None:
+        return _allocation
+    sources = []
+    for source, detect_cpus in [("cli", lambda: cpus), ("slurm", _slurm_cpus),
+            ("cgroup", _cgroup_cpus), ("node", _node_cpus)]:
+        found = detect_cpus()
+        if found:
+            cpus = found
+            sources.append(source)
+            break
+    memory = parse_memory(memory)
+    for source, detect_memory in [("cli", lambda: memory),
+            ("slurm", lambda: _slurm_memory(cpus)),
+            ("cgroup", _cgroup_memory), ("node", _node_memory)]:
+        found = detect_memory()
+        if found:
+            memory = found
+            if source != "cli":
+                # the allocation also holds this process and the OS caches
+                memory = max(MIN_JAVA_HEAP, memory - MEMORY_RESERVE)
+            sources.append(source)
+            break
+    _allocation = Allocation(int(cpus), int(memory),
+            "/".join(sorted(set(sources))))
+    return _allocation
+
+
+def grant(sample_config, allocation=None):
+    """ gives the sample the threads and memory of the allocation, unless
+    its config already asks for some"""
+    if allocation is None:
+        allocation = detect_allocation()
+    sample_config.setdefault("threads", allocation.cpus)
+    sample_config.setdefault("memory", allocation.memory)
+    return sample_config
+
+
+def threads(sample_config):
+    """ threads granted to a step"""
+    if sample_config.get("threads"):
+        return int(sample_config["threads"])
+    return detect_allocation().cpus
+
+
+def memory(sample_config):
+    """ memory (MB) granted to a step"""
+    if sample_config.get("memory"):
+        return parse_memory(sample_config["memory"])
+    return detect_allocation().memory
+
+
+def split(total, parts):
+    """ share of total for each of parts programs run at the same time"""
+    return max(1, int(total) // max(1, parts))
+
+
+def java_heap(memory):
+    """ -Xmx option of a JVM allowed to use memory MB"""
+    return "-Xmx{}m".format(max(MIN_JAVA_HEAP, int(memory *
+        JAVA_HEAP_FRACTION)))
+
+
+def sort_memory(memory, threads):
+    """ samtools sort -m value (memory per thread) for a sort allowed to use
+    memory MB with threads threads"""
+    return "{}M".format(max(MIN_SORT_MEMORY, int(memory *
+        SORT_MEMORY_FRACTION / max(1, threads))))
+
+
+class ThreadBudget(object):
+    """ threads shared by the programs a step runs at the same time (e.g.,
+    the alignments of its libraries): acquire waits until enough of the
+    threads asked for are free, release gives back some or all of them"""
+
+    def __init__(self, threads):
+        self.threads = max(1, threads)
+        self.free = self.threads
+        self._condition = threading.Condition()
+
+    def acquire(self, threads, minimum=None):
+        """ takes threads (at most the whole budget), or as many as are free
+        once at least minimum (by default all of them) are. Returns how
+        many were taken"""
+        threads = max(0, min(threads, self.threads))
+        if minimum is None or minimum > threads:
+            minimum = threads
+        with self._condition:
+            while self.free < minimum:
+                self._condition.wait()
+            threads = min(threads, self.free)
+            self.free -= threads
+        return threads
+
+    def release(self, threads):
+        with self._condition:
+            self.free += threads
+            self._condition.notify_all()
+
+    def grant(self, threads, minimum=None):
+        """ context manager holding the threads acquired until its end"""
+        return _Grant(self, threads, minimum)
+
+
+class _Grant(object):
+
+    def __init__(self, budget, threads, minimum=None):
+        self.budget = budget
+        self.threads = threads
+        self.minimum = minimum
+
+    def __enter__(self):
+        self.threads = self.budget.acquire(self.threads, self.minimum)
+        return self
+
+    def shrink(self, threads):
+        """ gives back all but threads of the ones held"""
+        threads = min(threads, self.threads)
+        self.budget.release(self.threads - threads)
+        self.threads = threads
+
+    def __exit__(self, *exc_info):
+        self.budget.release(self.threads)
+        self.threads = 0
+
+
+def local_tmp_dir():
+    """ node-local folder for temporary files (e.g., the sort spills):
+    SNIC_TMP (UPPMAX jobs), TMPDIR, otherwise the system default"""
+    for variable in ["SNIC_TMP", "TMPDIR"]:
+        folder = os.environ.get(variable)
+        if folder and os.path.isdir(folder):
+            return folder
+    return tempfile.gettempdir()
+
+
+def _slurm_cpus():
+    for variable in ["SLURM_CPUS_PER_TASK", "SLURM_CPUS_ON_NODE"]:
+        value = os.environ.get(variable, "")
+        if value.isdigit():
+            return int(value)
+    return None
+
+
+def _slurm_memory(cpus):
+    per_node = os.environ.get("SLURM_MEM_PER_NODE", "")
+    if per_node.isdigit() and int(per_node) > 0:
+        return int(per_node)
+    per_cpu = os.environ.get("SLURM_MEM_PER_CPU", "")
+    if per_cpu.isdigit() and int(per_cpu) > 0:
+        return int(per_cpu) * cpus
+    return None
+
+
+def _cgroup_path(controller):
+    """ folder of the cgroup of this process for controller (v1) or of its
+    unified cgroup (v2)"""
+    try:
+        with open("/proc/self/cgroup") as cgroup_fd:
+            for line in cgroup_fd:
+                hierarchy, controllers, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0" and controllers == "":
+                    return os.path.join("/sys/fs/cgroup", path.lstrip("/"))
+                if controller in controllers.split(","):
+                    return os.path.join("/sys/fs/cgroup", controllers,
+                            path.lstrip("/"))
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _read_cgroup(controller, names):
+    path = _cgroup_path(controller)
+    for folder in [path, os.path.join("/sys/fs/cgroup", controller),
+            "/sys/fs/cgroup"]:
+        if folder is None:
+            continue
+        for name in names:
+            try:
+                with open(os.path.join(folder, name)) as value_fd:
+                    return value_fd.read().split()
+            except (IOError, OSError):
+                continue
+    return None
+
+
+def _cgroup_cpus():
+    quota = _read_cgroup("cpu", ["cpu.max"])
+    if quota is None:
+        quota = _read_cgroup("cpu", ["cpu.cfs_quota_us"])
+        period = _read_cgroup("cpu", ["cpu.cfs_period_us"])
+        if quota is None or period is None:
+            return None
+        quota = quota + period
+    if quota[0] in ("max", "-1"):
+        return None
+    return max(1, int(int(quota[0]) / int(quota[1])))
+
+
+def _cgroup_memory():
+    limit = _read_cgroup("memory", ["memory.max", "memory.limit_in_bytes"])
+    if limit is None or not limit[0].isdigit():
+        return None
+    limit = int(limit[0]) // (1024 * 1024)
+    node = _node_memory()
+    if node and limit >= node:
+        return None # no limit, v1 reports a huge number
+    return limit
+
+
+def _node_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _node_memory():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
@@ -0,0 +1,191 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import sys
+import copy
+import time
+import traceback
+import multiprocessing
+from collections import namedtuple
+from nougat import common
+from nougat import journal as step_journal
+
+# seconds between two checks of the running steps
+POLL_INTERVAL = 1
+
+
+class Step(namedtuple("Step", ["name", "needs", "provides", "state",
+        "threads"])):
+    """ a pipeline step: the resources it needs and provides (labels such as
+    "reads" or "reference"), the sample_config keys it sets and the number
+    of threads it uses (None if it can use as many as it is given)"""
+    __slots__ = ()
+
+
+def dependencies(steps):
+    """ returns for each step the set of indices of the previous steps it
+    must wait for: the ones providing something it needs, needing something
+    it provides or setting the same sample_config keys, so that running the
+    steps in any order compatible with these constraints is the same as
+    running them one after the other"""
+    depends_on = []
+    for i, step in enumerate(steps):
+        depends_on.append(set(j for j, previous in enumerate(steps[:i])
+            if set(previous.provides) & set(step.needs)
+            or set(previous.needs) & set(step.provides)
+            or set(previous.provides) & set(step.provides)
+            or set(previous.state) & set(step.state)))
+    return depends_on
+
+
+def run_steps(steps, run_step, global_config, sample_config, threads,
+        journal=None):
+    """ runs the steps calling run_step(name, global_config, sample_config),
+    which returns the updated sample_config.
+
+    Independent steps run at the same time in separate processes (plots and
+    the profile step are per process state, the working directory is not)
+    as long as their threads fit in the threads budget; steps with threads
+    None share what is left of it through sample_config["threads"]. The
+    memory of the run (sample_config["memory"]) is split in proportion to
+    the threads, so that steps running together never ask for more than it.
+    Only the keys a step declares in state and the keys it sets in the
+    libraries (e.g. their "alignment") are copied back, and the commands
+    each step logs are appended in step order, so the final sample_config
+    is the one of a sequential run. A step whose process dies (e.g., killed
+    for its memory) fails the run as a step exiting with an error does.
+    Steps completed according to journal are skipped, the others are
+    recorded in it as soon as they finish."""
+    if journal is None:
+        journal = step_journal.Journal()
+    steps = [step for step in steps if not journal.done(step.name)]
+    if len(steps) <= 1 or threads <= 1:
+        for step in steps:
+            before = copy.deepcopy(sample_config)
+            start = time.time()
+            journal.started(step.name)
+            common.set_profile_step(step.name)
+            sample_config = run_step(step.name, global_config, sample_config)
+            journal.record_step(step.name, before, sample_config, start)
+        return sample_config
+
+    depends_on = dependencies(steps)
+    pending = list(range(len(steps)))
+    running = {} # step index -> threads given
+    started = {} # step index -> start time
+    processes = {} # step index -> (process, result connection)
+    done = set()
+    commands = [""] * len(steps)
+    memory = sample_config.get("memory")
+    try:
+        while pending or running:
+            ready = [i for i in pending if depends_on[i] <= done]
+            free = threads - sum(running.values())
+            scalable = len([i for i in ready if steps[i].threads is None])
+            for i in ready:
+                if steps[i].threads is None:
+                    given = max(1, free // scalable)
+                    scalable -= 1
+                else:
+                    given = min(steps[i].threads, threads)
+                if given > free:
+                    continue
+                step_config = copy.deepcopy(sample_config)
+                if steps[i].threads is None:
+                    step_config["threads"] = given
+                if memory:
+                    step_config["memory"] = max(1, memory * given // threads)
+                print("starting step {} ({} threads)".format(steps[i].name,
+                    given))
+                receiver, sender = multiprocessing.Pipe(False)
+                process = multiprocessing.Process(target=_execute,
+                        args=((run_step, steps[i], global_config,
+                        step_config), sender))
+                process.start()
+                sender.close()
+                processes[i] = (process, receiver)
+                pending.remove(i)
+                running[i] = given
+                started[i] = time.time()
+                journal.started(steps[i].name)
+                free -= given
+            i, (error, state, libraries, step_commands) = _finished(
+                    processes)
+            del running[i]
+            if error is not None:
+                sys.exit("step {} failed: {}".format(steps[i].name, error))
+            sample_config.update(state)
+            if libraries and "libraries" not in state:
+                for library, library_state in libraries.items():
+                    sample_config["libraries"][library].update(library_state)
+                state = dict(state, libraries=copy.deepcopy(
+                    sample_config["libraries"]))
+            commands[i] = step_commands
+            journal.record(steps[i].name, state, commands=step_commands,
+                    start=started[i])
+            done.add(i)
+    finally:
+        for process, receiver in processes.values():
+            process.terminate()
+            process.join()
+            receiver.close()
+    sample_config["commands"] = sample_config.get("commands", "") + \
+            "".join(commands)
+    return sample_config
+
+
+def _finished(processes):
+    """ waits for one of the step processes to end, removes it and returns
+    its index and (error, state, libraries, commands)"""
+    while True:
+        for i, (process, receiver) in list(processes.items()):
+            # the result is read before joining, a large one fills the pipe
+            alive = process.is_alive()
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = None
+            elif alive:
+                continue
+            else:
+                result = None
+            process.join()
+            receiver.close()
+            del processes[i]
+            if result is None:
+                result = ("process ended with exit code {}".format(
+                    process.exitcode), None, None, None)
+            return i, result
+        time.sleep(POLL_INTERVAL)
+
+
+def _execute(job, sender):
+    """ runs a step in its own process and sends back its result"""
+    sender.send(_run_job(job))
+    sender.close()
+
+
+def _run_job(job):
+    """ runs a step, returns (error, state, libraries, commands), libraries
+    are the keys set in each library"""
+    run_step, step, global_config, sample_config = job
+    logged = len(sample_config.get("commands", ""))
+    libraries = copy.deepcopy(sample_config.get("libraries", {}))
+    common.set_profile_step(step.name)
+    try:
+        sample_config = run_step(step.name, global_config, sample_config)
+    except SystemExit as exit:
+        return str(exit), None, None, None
+    except Exception:
+        return traceback.format_exc(), None, None, None
+    state = dict((key, sample_config[key]) for key in step.state
+            if key in sample_config)
+    library_state = {}
+    for library, libraryInfo in sample_config.get("libraries", {}).items():
+        before = libraries.get(library, {})
+        changed = dict((key, value) for key, value in libraryInfo.items()
+                if key not in before or before[key] != value)
+        if changed and library in libraries:
+            library_state[library] = changed
+    return None, state, library_state, \
+            sample_config.get("commands", "")[logged:]
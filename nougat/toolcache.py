@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+from collections import namedtuple, OrderedDict
+from nougat import common, cache
+
+# seconds a program is given to print its version
+VERSION_TIMEOUT = 10
+# options tried, in order, to make a program print its version
+VERSION_OPTIONS = ["--version", "-v", "-version"]
+# PATH/global config combinations remembered by the cache
+CACHE_ENTRIES = 16
+
+_VERSION = re.compile(r"\d+\.\d+")
+
+
+class Tool(namedtuple("Tool", ["binary", "path", "version", "mtime"])):
+    """ a program the pipeline runs: the name it is called by, the file it
+    resolves to, the version it reports (None if it does not tell) and the
+    modification time of the file"""
+    __slots__ = ()
+
+
+def cache_file_name():
+    """ the per-user tool cache: NOUGAT_TOOL_CACHE if set, otherwise
+    nougat/tools.json in XDG_CACHE_HOME (by default ~/.cache)"""
+    if os.environ.get("NOUGAT_TOOL_CACHE"):
+        return os.environ["NOUGAT_TOOL_CACHE"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "nougat", "tools.json")
+
+
+def cache_key(global_config):
+    """ what the resolution of a binary depends on: PATH, PICARD_HOME and
+    the global config"""
+    description = {"PATH": os.environ.get("PATH", ""),
+            "PICARD_HOME": os.environ.get("PICARD_HOME", ""),
+            "config": json.dumps(global_config, sort_keys=True, default=str)}
+    return hashlib.sha1(json.dumps(description,
+        sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def probe_version(path):
+    """ the first line with a version number (e.g., 1.9 or 0.7.17-r1188)
+    printed by the program with one of VERSION_OPTIONS, None if it does not
+    tell (or is not an executable, e.g., a jar)"""
+    if not os.path.isfile(path) or not os.access(path, os.X_OK):
+        return None
+    for option in VERSION_OPTIONS:
+        with tempfile.TemporaryFile() as output, \
+                open(os.devnull, "r") as devnull:
+            common.run_command([path, option], stdout=output, stderr=output,
+                    stdin=devnull, timeout=VERSION_TIMEOUT)
+            output.seek(0)
+            text = output.read(64 * 1024).decode("utf-8", "replace")
+        for line in text.splitlines():
+            if _VERSION.search(line):
+                return " ".join(line.split())[:100]
+    return None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class ToolResolver(object):
+    """ finds the binaries the pipeline runs as common.which does and
+    probes their version, remembering both in a per-user cache.
+
+    Entries are kept under cache_key(global_config), so a different PATH,
+    PICARD_HOME or global config starts from scratch, and an entry is only
+    reused while the file it points to keeps its mtime: a cached binary
+    costs a single stat instead of a walk over PATH and a version probe.
+    The cache is shared by all the runs of the user, save() merges with
+    what the others wrote meanwhile and never fails the run."""
+
+    def __init__(self, global_config, path=None):
+        self.path = path or cache_file_name()
+        self.key = cache_key(global_config)
+        entry = self._load().get(self.key, {})
+        # binary -> path, version, mtime
+        self._tools = dict(entry.get("tools", {}))
+        self._changed = False
+        self.resolved = OrderedDict() # binary -> Tool, in resolution order
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as cache_fd:
+                data = json.load(cache_fd)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def resolve(self, binary):
+        """ the Tool of binary, None if it cannot be found"""
+        cached = self._tools.get(binary)
+        if cached is not None:
+            path, version, mtime = cached
+            if mtime is not None and _mtime(path) == mtime:
+                self.resolved[binary] = Tool(binary, path, version, mtime)
+                return self.resolved[binary]
+        path = common.which(binary)
+        if path is None:
+            if self._tools.pop(binary, None) is not None:
+                self._changed = True
+            return None
+        path = os.path.abspath(path)
+        tool = Tool(binary, path, probe_version(path), _mtime(path))
+        self._tools[binary] = [tool.path, tool.version, tool.mtime]
+        self._changed = True
+        self.resolved[binary] = tool
+        return tool
+
+    def save(self):
+        """ writes the cache if something was resolved again"""
+        if not self._changed:
+            return
+        data = self._load()
+        data[self.key] = {"time": time.time(), "tools": self._tools}
+        for key in sorted(data, key=lambda key: data[key].get("time", 0)
+                if isinstance(data[key], dict) else 0)[:-CACHE_ENTRIES]:
+            del data[key] # the least recently written
+        try:
+            folder = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            temporary = cache.temporary_name(self.path)
+            with open(temporary, "w") as cache_fd:
+                json.dump(data, cache_fd, sort_keys=True)
+            os.rename(temporary, self.path)
+            self._changed = False
+        except (IOError, OSError):
+            print("warning: cannot write the tool cache {}".format(self.path))
+
+    def versions(self):
+        """ version of each resolved binary, keyed by its file name as the
+        profile names tools"""
+        return dict((os.path.basename(tool.path), tool.version) for tool in
+                self.resolved.values())
@@ -6,9 +6,8 @@ import argparse
 import itertools
 import re
 import shutil
-from nougat import common, align, pdf
+from nougat import common, pdf
 from nougat.pdf.theme import colors, DefaultTheme
-from nougat.pdf.peakdetect import peakdet
 
 
 def main(args):
@@ -373,10 +372,23 @@ def _run_qc_report(global_config, sample_config):
             dest = os.path.join(os.getcwd(), "kmergenie")
             if not os.path.exists(dest):
                 shutil.copytree(kmerdir, dest)
+
+    profile = os.path.join(currentDir, common.profile_file_name(sample_config))
+    resource_usage = common.resource_usage_table([(sampleName, profile)])
+    if resource_usage is not None:
+        doc.add_pagebreak()
+        doc.add_header("Resource Usage", pdf.H2)
+        doc.add_paragraph("Wall time, CPU time (user and system), peak "
+                "memory, bytes read and written and size of the input files "
+                "of the programs run by each step. The full profile, one line "
+                "per program run, is in the report directory.")
+        doc.add_table(resource_usage, TABLE_WIDTH)
     doc.render(PDFtitle)
     
     # Copy the pipeline files and commands run to the report directory
     filesToCopy = glob.glob(currentDir+"/{}_QCcontrol.*".format(sampleName))
+    if os.path.exists(profile):
+        filesToCopy.append(profile)
     for cfile in filesToCopy:
         shutil.copyfile(cfile, os.path.join(reportDir, os.path.basename(cfile)))
 
@@ -9,7 +9,7 @@ import shutil
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
-from nougat import common
+from nougat import common, assembly_stats
 from nougat import pdf
 from nougat.pdf.theme import colors, DefaultTheme
 
@@ -175,11 +175,10 @@ def collect_results_and_report(validation_sample_dir, assemblies_sample_dir,
         stat_file = os.path.join(validation_sample_dir, assembler,
                 "contig_stats", "contiguity.out")
         source_stats.append((stat_file, assembler))
-        with open(stat_file, "r") as sf:
-            for line in sf:
-                if line.startswith("scaffolds"):
-                    sl = line.strip().split("\t")
-                    asm_stats.extend([sl[1], sl[4], sl[8], sl[9], sl[10], sl[2], sl[6]])
+        contiguity = assembly_stats.read_contiguity(stat_file)
+        if "scaffolds" in contiguity:
+            asm_stats.extend(assembly_stats.report_row(
+                contiguity["scaffolds"]))
         contig_stats.append(asm_stats)
     contig_stats = sorted(contig_stats, key=lambda x: x[0])
 
@@ -229,15 +228,26 @@ def collect_results_and_report(validation_sample_dir, assemblies_sample_dir,
     for bdir in BUSCO_dirs:
         shutil.copytree(bdir[0], os.path.join(BUSCO_target, bdir[1]))
 
+    # resources used by the assembly and evaluation runs
+    profiles = [("assembly", profile) for profile in sorted(glob.glob(
+        os.path.join(assemblies_sample_dir, "*.profile.tsv")))]
+    for assembler in assemblers_assemblies:
+        profiles.extend(("{} evaluation".format(assembler), profile) for
+                profile in sorted(glob.glob(os.path.join(validation_sample_dir,
+                assembler, "*.profile.tsv"))))
+
     #### now I can produce the report
     write_report(sample_folder, sample, assemblers_assemblies, picturesQA,
-            FRC_to_print, min_contig_length, contig_stats, BUSCO, BUSCO_lineage[0])
+            FRC_to_print, min_contig_length, contig_stats, BUSCO, BUSCO_lineage[0],
+            profiles)
     return
 
 
 def write_report(sample_folder, sample, assemblers,
-        picturesQA, FRCname, min_contig_length, contig_stats, BUSCO, BUSCO_lineage):
-    """This function produces a pdf report """
+        picturesQA, FRCname, min_contig_length, contig_stats, BUSCO, BUSCO_lineage,
+        profiles=()):
+    """This function produces a pdf report, profiles are the (run, profile
+    file) pairs summarised in the resource usage table"""
     # TODO: Build my own report generation function, with blackjack 
     # and markdown. In fact, forget the blackjack.
 
@@ -478,6 +488,16 @@ def write_report(sample_folder, sample, assemblers,
     doc.add_spacer()
     doc.add_paragraph("BUSCO lineage: {}".format(BUSCO_lineage))
     doc.add_table(BUSCO_table, TABLE_WIDTH)
+
+    resource_usage = common.resource_usage_table(profiles)
+    if resource_usage is not None:
+        doc.add_pagebreak()
+        doc.add_header("Resource Usage", pdf.H2)
+        doc.add_paragraph("Wall time, CPU time (user and system), peak "
+                "memory, bytes read and written and size of the input files "
+                "of the programs run by each step of the assembly and of the "
+                "evaluation of every assembler.")
+        doc.add_table(resource_usage, TABLE_WIDTH)
     doc.render(PDFtitle)
     return 0
 
@@ -10,7 +10,6 @@ setup(name='nougat',
     url='https://github.com/SciLifeLab/NouGAT',
     scripts=['nougat/deNovo_pipeline.py'],
     packages=['nougat'],
-    namespace_packages=["nougat"],
 
     entry_points={
         'console_scripts': [
@@ -0,0 +1,25 @@
+from __future__ import absolute_import
+import unittest
+from nougat import align
+
+
+class BwaMemSortCommandTest(unittest.TestCase):
+
+    def threads(self, threads):
+        command = align._bwa_mem_sort_command("bwa", "samtools", "r1.fq",
+                "r2.fq", "missing.fasta", threads, 16000, "lib.bam", "lib")
+        bwa_mem, samtools_sort = [part.split() for part in
+                command.split(" | ")]
+        return (int(bwa_mem[bwa_mem.index("-t") + 1]),
+                int(samtools_sort[samtools_sort.index("-@") + 1]))
+
+    def test_threads_within_grant(self):
+        for threads in [2, 3, 8, 16]:
+            bwa_threads, sort_threads = self.threads(threads)
+            self.assertEqual(bwa_threads + sort_threads, threads)
+            self.assertTrue(bwa_threads >= sort_threads)
+        self.assertEqual(self.threads(1), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import assemble, cache, common
+
+
+class AssemblyFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.assembly = os.path.join(self.folder, "spades")
+        os.mkdir(self.assembly)
+        self.sample_config = {"output": "sample"}
+        self.step = cache.StepCache(["spades"], manifest=self.assembly +
+                cache.STEP_CACHE_SUFFIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, *names):
+        for name in names:
+            with open(os.path.join(self.assembly, name), "w") as fasta_fd:
+                fasta_fd.write(">ctg1\nACGT\n")
+
+    def check(self):
+        assemble._check_assembly_folder(self.step, "spades",
+                self.sample_config, self.assembly)
+
+    def moved(self):
+        return not os.path.exists(self.assembly) and len([name for name in
+            os.listdir(self.folder) if name.startswith("spades.stale.")]) == 1
+
+    def test_adopt_earlier_assembly(self):
+        self.write("sample.ctg.fasta", "sample.scf.fasta")
+        self.check()
+        self.assertTrue(os.path.isdir(self.assembly))
+        self.assertTrue(self.step.done())
+
+    def test_move_partial_assembly(self):
+        self.write("sample.ctg.fasta")
+        self.check()
+        self.assertTrue(self.moved())
+
+    def test_move_incomplete_assembly(self):
+        self.check()
+        self.assertTrue(self.moved())
+
+    def test_save_assembly(self):
+        self.write("contigs.fasta", "scaffolds.fasta")
+        assembly_dir = common.RunDir(self.assembly)
+        self.assertNotEqual(assemble._save_assembly(assembly_dir, [
+            ("contigs.fasta", "sample.ctg.fasta"),
+            ("missing.fasta", "sample.scf.fasta")]), 0)
+        self.assertEqual(sorted(os.listdir(self.assembly)),
+                ["contigs.fasta", "scaffolds.fasta"])
+        self.assertEqual(assemble._save_assembly(assembly_dir, [
+            ("contigs.fasta", "sample.ctg.fasta"),
+            ("scaffolds.fasta", "sample.scf.fasta")], "mv"), 0)
+        self.assertEqual(sorted(os.listdir(self.assembly)),
+                ["sample.ctg.fasta", "sample.scf.fasta"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import common
+try:
+    from nougat import assembly_stats
+except ImportError: # numpy missing
+    assembly_stats = None
+
+
+@unittest.skipIf(assembly_stats is None, "numpy is not installed")
+class AssemblyStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.folder, "assembly.fasta")
+        with open(self.fasta, "w") as fasta_fd:
+            fasta_fd.write(">ctg1\nACGTACGTAC\nGCNN\n>ctg2 x\nacgtAC\n"
+                    ">ctg3\nGGGGG\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stats(self):
+        stats = assembly_stats.compute_assembly_stats(self.fasta,
+                genome_size=50)
+        self.assertEqual(stats.lengths.tolist(), [14, 6, 5])
+        self.assertEqual((stats.N(50), stats.L(50)), (14, 1))
+        self.assertEqual((stats.N(80), stats.L(80)), (6, 2))
+        self.assertEqual((stats.NG(50), stats.LG(50)), (5, 3))
+        self.assertEqual((stats.NG(80), stats.LG(80)), (0, 0))
+        self.assertEqual((stats.gaps, stats.gc, stats.acgt), (2, 15, 23))
+
+    def test_stats_cache(self):
+        names, lengths, composition = assembly_stats.scan_assembly(
+                self.fasta)
+        self.assertEqual(names, ["ctg1", "ctg2", "ctg3"])
+        cache_file = assembly_stats.stats_cache_name(self.fasta)
+        self.assertTrue(os.path.exists(cache_file))
+        # a hit does not parse the assembly
+        read_fasta = common.read_fasta
+        common.read_fasta = None
+        try:
+            cached = assembly_stats.scan_assembly(self.fasta)
+        finally:
+            common.read_fasta = read_fasta
+        self.assertEqual(cached[0], names)
+        self.assertEqual(cached[1].tolist(), lengths.tolist())
+        self.assertEqual(cached[2].iupac(), composition.iupac())
+        with open(self.fasta, "a") as fasta_fd:
+            fasta_fd.write(">ctg4\nTT\n")
+        self.assertEqual(assembly_stats.scan_assembly(self.fasta)[1].tolist(),
+                [14, 6, 5, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
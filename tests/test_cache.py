@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import cache
+
+
+def write(path, text):
+    with open(path, "w") as file_fd:
+        file_fd.write(text)
+
+
+class StepCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.reads = os.path.join(self.folder, "reads.fastq")
+        self.output = os.path.join(self.folder, "reads.bam")
+        write(self.reads, "@r1\nACGT\n+\nIIII\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def step(self, command=("bwa", "mem", "-t", "8")):
+        return cache.StepCache(list(command), inputs=[self.reads],
+                outputs=[self.output])
+
+    def test_hit(self):
+        self.assertFalse(self.step().done())
+        write(self.output, "bam")
+        self.step().record()
+        self.assertTrue(os.path.exists(self.output + cache.STEP_CACHE_SUFFIX))
+        self.assertTrue(self.step().done())
+        # the threads a step ran with do not change its outputs
+        self.assertTrue(self.step(("bwa", "mem", "-t", "2")).done())
+
+    def test_miss(self):
+        write(self.output, "bam")
+        self.step().record()
+        self.assertFalse(self.step(("bwa", "mem", "-k", "19")).done())
+        write(self.reads, "@r1\nACGA\n+\nIIII\n")
+        self.assertFalse(self.step().done())
+
+    def test_changed_output(self):
+        write(self.output, "bam")
+        self.step().record()
+        write(self.output, "truncated")
+        self.assertFalse(self.step().done())
+        self.step().forget()
+        self.assertFalse(os.path.exists(self.step().manifest))
+
+    def test_commit_outputs(self):
+        temporary = cache.temporary_name(self.output)
+        self.assertEqual(os.path.dirname(temporary), self.folder)
+        write(temporary, "bam")
+        cache.commit_outputs([temporary], [self.output])
+        self.assertFalse(os.path.exists(temporary))
+        self.assertTrue(os.path.exists(self.output))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+from __future__ import absolute_import
+import os
+import gzip
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from nougat import common
+
+FASTA = (b">ctg1 first contig\r\nACGTAC\r\nGTA\r\n>ctg2\n>ctg3 last\nNNNN\n"
+        b"acgt\nA")
+RECORDS = [("ctg1 first contig", b"ACGTACGTA"), ("ctg2", b""),
+        ("ctg3 last", b"NNNNacgtA")]
+
+
+class ReadFastaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.folder, "reads.fasta")
+        with open(self.fasta, "wb") as fasta_fd:
+            fasta_fd.write(FASTA)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def read(self, fasta, **kwargs):
+        return [(record.header, None if record.sequence is None else
+            bytes(record.sequence)) for record in common.read_fasta(fasta,
+            **kwargs)]
+
+    def test_chunk_boundaries(self):
+        # headers, line ends and sequences split anywhere between chunks
+        for chunk_size in range(1, len(FASTA) + 2):
+            self.assertEqual(self.read(self.fasta, chunk_size=chunk_size),
+                    RECORDS)
+
+    def test_lengths_only(self):
+        records = list(common.read_fasta(self.fasta, lengths_only=True,
+            chunk_size=5))
+        self.assertEqual([(record.name, record.length, record.sequence) for
+            record in records], [("ctg1", 9, None), ("ctg2", 0, None),
+            ("ctg3", 9, None)])
+
+    def test_gzip(self):
+        compressed = self.fasta + ".gz"
+        with gzip.open(compressed, "wb") as fasta_fd:
+            fasta_fd.write(FASTA)
+        self.assertTrue(common.is_gzipped(compressed))
+        self.assertFalse(common.is_gzipped(self.fasta))
+        self.assertEqual(self.read(compressed, chunk_size=7), RECORDS)
+
+    def test_write_read(self):
+        output = os.path.join(self.folder, "written.fasta")
+        with open(output, "wb") as fasta_fd:
+            for header, sequence in RECORDS:
+                common.write_fasta_record(fasta_fd, header, sequence, 4)
+        with open(output, "rb") as fasta_fd:
+            self.assertEqual(fasta_fd.read().split(b"\n")[:4],
+                    [b">ctg1 first contig", b"ACGT", b"ACGT", b"A"])
+        self.assertEqual(self.read(output), RECORDS)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _interrupt(signal_number, frame):
+    raise Interrupted()
+
+
+def _run_timed(slots, log):
+    common._process_slots = slots
+    common.run_command("echo start $(date +%s.%N) >> {0}; sleep 0.3; "
+            "echo end $(date +%s.%N) >> {0}".format(log))
+
+
+def _hold_slot(slots):
+    with slots.slot():
+        time.sleep(60)
+
+
+class RunCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.slots = common._process_slots
+
+    def tearDown(self):
+        common._process_slots = self.slots
+        shutil.rmtree(self.folder)
+
+    def test_interrupted_wait(self):
+        pid_file = os.path.join(self.folder, "pid")
+        handler = signal.signal(signal.SIGALRM, _interrupt)
+        signal.setitimer(signal.ITIMER_REAL, 0.5)
+        try:
+            with self.assertRaises(Interrupted):
+                common.run_command("echo $$ > {}; exec sleep 30".format(
+                    pid_file))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+        with open(pid_file) as pid_fd:
+            pid = int(pid_fd.read())
+        with self.assertRaises(OSError):
+            os.kill(pid, 0) # killed and reaped
+
+    def test_slots_across_processes(self):
+        slots = common._ProcessSlots(os.path.join(self.folder, "slots"), 1)
+        log = os.path.join(self.folder, "log")
+        processes = [multiprocessing.Process(target=_run_timed,
+            args=(slots, log)) for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        with open(log) as log_fd:
+            events = [line.split() for line in log_fd]
+        self.assertEqual(len(events), 6)
+        events.sort(key=lambda event: float(event[1]))
+        self.assertEqual([event[0] for event in events],
+                ["start", "end"] * 3)
+
+    def test_slot_of_killed_process(self):
+        slots = common._ProcessSlots(os.path.join(self.folder, "slots"), 1)
+        holder = multiprocessing.Process(target=_hold_slot, args=(slots,))
+        holder.start()
+        time.sleep(0.5)
+        os.kill(holder.pid, signal.SIGKILL)
+        holder.join()
+        with slots.slot() as slot:
+            self.assertEqual(slot, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
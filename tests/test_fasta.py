@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import common, fasta
+
+RECORDS = [("ctg1 first contig", b"ACGTACGTAC" * 5 + b"GGC"),
+        ("ctg2", b"TTTTNNNNac"),
+        ("ctg3 last", b"A")]
+
+
+def write_fasta(path, records, line_width):
+    with open(path, "wb") as fasta_fd:
+        for header, sequence in records:
+            common.write_fasta_record(fasta_fd, header, sequence, line_width)
+
+
+class FastaFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.folder, "contigs.fasta")
+        write_fasta(self.fasta, RECORDS, 7)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read_fasta(self):
+        records = list(common.read_fasta(self.fasta, chunk_size=16))
+        self.assertEqual([(record.header, bytes(record.sequence)) for record
+            in records], RECORDS)
+        self.assertEqual(records[0].name, "ctg1")
+        lengths = [record.length for record in common.read_fasta(self.fasta,
+            lengths_only=True, chunk_size=16)]
+        self.assertEqual(lengths, [len(sequence) for header, sequence in
+            RECORDS])
+
+    def test_index(self):
+        entries = fasta.build_fasta_index(self.fasta)
+        self.assertEqual(list(entries), ["ctg1", "ctg2", "ctg3"])
+        with open(fasta.index_file_name(self.fasta)) as index_fd:
+            first = index_fd.readline().split("\t")
+        # name, length, offset, bases and bytes per line as samtools faidx
+        self.assertEqual(first, ["ctg1", "53", "19", "7", "8\n"])
+        self.assertEqual(fasta.load_fasta_index(self.fasta), entries)
+
+    def test_fetch(self):
+        with fasta.FastaFile(self.fasta) as contigs:
+            self.assertEqual(contigs.lengths(), dict((header.split()[0],
+                len(sequence)) for header, sequence in RECORDS))
+            for header, sequence in RECORDS:
+                name = header.split()[0]
+                self.assertEqual(contigs.fetch(name).tobytes(), sequence)
+                for start, end in [(0, 1), (2, 9), (6, 8), (5, 30)]:
+                    self.assertEqual(contigs.fetch(name, start,
+                        end).tobytes(), sequence[start:end])
+            self.assertEqual(contigs.fetch("ctg2", 6, 10, "-").tobytes(),
+                    b"gtNN")
+            self.assertEqual(contigs.fetch("ctg2", 5, 5).tobytes(), b"")
+
+    def test_filter_fasta(self):
+        output = os.path.join(self.folder, "filtered.fasta")
+        kept = fasta.filter_fasta(self.fasta, output, min_length=5,
+                rename="contig{}")
+        self.assertEqual(list(kept.items()), [("contig1", 53),
+            ("contig2", 10)])
+        self.assertEqual(sorted(os.listdir(self.folder)), ["contigs.fasta",
+            "filtered.fasta", "filtered.fasta.fai", "filtered.fasta.lengths"])
+        with fasta.FastaFile(output) as contigs:
+            self.assertEqual(contigs.fetch("contig2").tobytes(),
+                    RECORDS[1][1])
+
+    def test_filter_fasta_parallel(self):
+        split_size = fasta.FILTER_SPLIT_SIZE
+        fasta.FILTER_SPLIT_SIZE = 20
+        try:
+            output = os.path.join(self.folder, "filtered.fasta")
+            kept = fasta.filter_fasta(self.fasta, output, processes=3)
+        finally:
+            fasta.FILTER_SPLIT_SIZE = split_size
+        self.assertEqual(list(kept), ["ctg1", "ctg2", "ctg3"])
+        self.assertEqual([(record.header, bytes(record.sequence)) for record
+            in common.read_fasta(output)], RECORDS)
+
+    def test_filter_fasta_failure(self):
+        output = os.path.join(self.folder, "filtered.fasta")
+        with self.assertRaises(IOError):
+            fasta.filter_fasta(os.path.join(self.folder, "missing.fasta"),
+                    output)
+        self.assertEqual(os.listdir(self.folder), ["contigs.fasta"])
+
+
+if __name__ == "__main__":
+    unittest.main()
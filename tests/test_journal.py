@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import journal
+
+
+def _add_contigs(sample_config, contigs):
+    sample_config["contigs"] = contigs
+    sample_config.pop("reads", None)
+    sample_config["commands"] = sample_config.get("commands", "") + "abyss\n"
+    return sample_config
+
+
+def _forget(sample_config):
+    pass
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "sample.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_config_delta(self):
+        delta, removed, commands = journal.config_delta(
+                {"a": 1, "b": 2, "commands": "x\n"},
+                {"a": 1, "c": 3, "commands": "x\ny\n"})
+        self.assertEqual(delta, {"c": 3})
+        self.assertEqual(removed, ["b"])
+        self.assertEqual(commands, "y\n")
+
+    def test_replay_and_resume(self):
+        steps = journal.Journal(self.path)
+        sample_config = {"output": "sample", "reads": ["r1"]}
+        sample_config = steps.run_step("assemble", dict(sample_config),
+                _add_contigs, dict(sample_config), "/tmp/contigs.fa")
+        self.assertTrue(steps.done("assemble"))
+        with open(self.path, "a") as journal_fd:
+            journal_fd.write('{"step": "evaluate", "status": "do') # crash
+
+        resumed = journal.Journal(self.path, resume=True)
+        self.assertTrue(resumed.done("assemble"))
+        self.assertFalse(resumed.done("evaluate"))
+        replayed = resumed.replay({"output": "sample", "reads": ["r1"]})
+        self.assertEqual(replayed, sample_config)
+        calls = []
+        self.assertIs(resumed.run_step("assemble", replayed, calls.append,
+            "ran"), replayed)
+        self.assertEqual(calls, [])
+
+        journal.Journal(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(len(os.listdir(self.folder)), 1)
+
+    def test_step_without_sample_config(self):
+        steps = journal.Journal(self.path)
+        with self.assertRaises(SystemExit):
+            steps.run_step("BUSCO", {}, _forget, {})
+        self.assertFalse(steps.done("BUSCO"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from nougat import plan
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plan = plan.Plan({"output": "sample", "pipeline": "QCcontrol"},
+                self.folder)
+        self.plan.add("trim", "trimmomatic", "trim", [["touch", "r1.trimmed.fq"]],
+                inputs=["../r1.fq"], outputs=["r1.trimmed.fq"])
+        self.plan.add("count", "kmergenie", "count",
+                ["echo $((6 * 7)) > count.txt"],
+                inputs=["../trim/r1.trimmed.fq"], outputs=["count.txt"],
+                files={"reads.txt": "r1.trimmed.fq\n"})
+        self.plan.add("report", "report", ".", [["cat", "count/count.txt"]],
+                needs=["trim"])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_dependencies(self):
+        self.assertEqual([task.needs for task in self.plan.tasks], [[],
+            ["trim"], ["trim"]])
+        self.assertEqual(self.plan.tasks[1].inputs, [os.path.join(
+            self.folder, "trim", "r1.trimmed.fq")])
+        self.assertEqual(list(self.plan.tasks[1].files), [os.path.join(
+            self.folder, "count", "reads.txt")])
+        self.assertEqual(self.plan.tasks[0].commands, ["touch r1.trimmed.fq"])
+
+    def test_makefile_escaping(self):
+        makefile = os.path.join(self.folder, "Makefile")
+        self.plan.write(makefile)
+        with open(makefile) as makefile_fd:
+            text = makefile_fd.read()
+        self.assertIn("count: trim\n", text)
+        self.assertIn("echo $$((6 * 7)) > count.txt", text)
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["make", "-f", makefile, "count"],
+                    cwd=self.folder, stdout=devnull, stderr=devnull)
+        with open(os.path.join(self.folder, "count", "count.txt")) as count:
+            self.assertEqual(count.read(), "42\n")
+        with open(os.path.join(self.folder, "count", "reads.txt")) as reads:
+            self.assertEqual(reads.read(), "r1.trimmed.fq\n")
+
+    def test_shell(self):
+        self.assertEqual(plan.shell(["bwa", "index", None, "ref.fa"],
+            stdout="bwa.stdOut", mode="a"), "bwa index ref.fa >> bwa.stdOut")
+        self.assertEqual(plan.shell("a | b", stderr="b.err"),
+                "(a | b) 2> b.err")
+
+
+if __name__ == "__main__":
+    unittest.main()
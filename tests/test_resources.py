@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+import threading
+import unittest
+from nougat import resources
+
+
+class ResourcesTest(unittest.TestCase):
+
+    def tearDown(self):
+        resources._allocation = None
+
+    def test_parse_memory(self):
+        self.assertEqual(resources.parse_memory("16G"), 16384)
+        self.assertEqual(resources.parse_memory("500mb"), 500)
+        self.assertEqual(resources.parse_memory("1.5G"), 1536)
+        self.assertEqual(resources.parse_memory(2048), 2048)
+        self.assertIsNone(resources.parse_memory(None))
+        with self.assertRaises(ValueError):
+            resources.parse_memory("lots")
+
+    def test_allocation_split(self):
+        allocation = resources.Allocation(16, 64000, "cli")
+        self.assertEqual(resources.split(allocation.cpus, 3), 5)
+        self.assertEqual(resources.split(2, 4), 1)
+        sample_config = resources.grant({"threads": 4}, allocation)
+        self.assertEqual(sample_config, {"threads": 4, "memory": 64000})
+        self.assertEqual(resources.threads(sample_config), 4)
+        self.assertEqual(resources.memory({"memory": "2G"}), 2048)
+
+    def test_detect_allocation_from_cli(self):
+        allocation = resources.detect_allocation(cpus=8, memory="32G")
+        self.assertEqual(allocation, (8, 32768, "cli"))
+        self.assertIs(resources.detect_allocation(), allocation)
+
+
+class ThreadBudgetTest(unittest.TestCase):
+
+    def test_acquire(self):
+        budget = resources.ThreadBudget(8)
+        self.assertEqual(budget.acquire(6), 6)
+        self.assertEqual(budget.acquire(6, minimum=2), 2)
+        self.assertEqual(budget.free, 0)
+        budget.release(8)
+        self.assertEqual(budget.acquire(20), 8)
+
+    def test_acquire_waits(self):
+        budget = resources.ThreadBudget(4)
+        budget.acquire(3)
+        taken = []
+        waiting = threading.Thread(target=lambda: taken.append(
+            budget.acquire(4, minimum=2)))
+        waiting.start()
+        waiting.join(0.1)
+        self.assertEqual(taken, [])
+        budget.release(3)
+        waiting.join(5)
+        self.assertEqual(taken, [4])
+
+    def test_grant_shrink(self):
+        budget = resources.ThreadBudget(8)
+        with self.assertRaises(RuntimeError):
+            with budget.grant(8) as grant:
+                self.assertEqual(budget.free, 0)
+                grant.shrink(2)
+                self.assertEqual((grant.threads, budget.free), (2, 6))
+                grant.shrink(4)
+                self.assertEqual((grant.threads, budget.free), (2, 6))
+                raise RuntimeError("step failed")
+        self.assertEqual(budget.free, 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
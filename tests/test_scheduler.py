@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+import os
+import signal
+import unittest
+from nougat import scheduler
+
+STEPS = [scheduler.Step("trim", needs=["reads"], provides=["reads"],
+        state=["trim"], threads=1),
+    scheduler.Step("align", needs=["reads", "reference"], provides=[],
+        state=["alignments"], threads=None),
+    scheduler.Step("count", needs=["reads"], provides=[], state=["count"],
+        threads=None)]
+
+
+def run_step(name, global_config, sample_config):
+    sample_config["commands"] += "{}\n".format(name)
+    if name == "trim":
+        sample_config["trim"] = True
+    elif name == "align":
+        for library, libraryInfo in sample_config["libraries"].items():
+            libraryInfo["alignment"] = "{}.bam".format(library)
+        sample_config["alignments"] = os.getpid()
+    elif name == "count" and sample_config.get("kill"):
+        os.kill(os.getpid(), signal.SIGKILL)
+    else:
+        sample_config["count"] = os.getpid()
+    return sample_config
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def sample_config(self):
+        return {"commands": "", "libraries": {"lib1": {"insert": 200},
+            "lib2": {"insert": 5000}}}
+
+    def test_dependencies(self):
+        self.assertEqual(scheduler.dependencies(STEPS), [set(), set([0]),
+            set([0])])
+
+    def test_parallel_like_sequential(self):
+        sequential = scheduler.run_steps(STEPS, run_step, {},
+                self.sample_config(), 1)
+        parallel = scheduler.run_steps(STEPS, run_step, {},
+                self.sample_config(), 4)
+        self.assertNotEqual(parallel["alignments"], os.getpid())
+        for config in [sequential, parallel]:
+            self.assertEqual(config["commands"], "trim\nalign\ncount\n")
+            self.assertTrue(config["trim"])
+            self.assertEqual(config["libraries"]["lib2"],
+                    {"insert": 5000, "alignment": "lib2.bam"})
+
+    def test_killed_step(self):
+        sample_config = dict(self.sample_config(), kill=True)
+        with self.assertRaises(SystemExit) as failure:
+            scheduler.run_steps(STEPS, run_step, {}, sample_config, 4)
+        self.assertIn("step count failed", str(failure.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
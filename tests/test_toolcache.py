@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+from nougat import toolcache
+
+
+class ToolResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.bin = os.path.join(self.folder, "bin")
+        os.mkdir(self.bin)
+        self.tool = os.path.join(self.bin, "nougat-test-aligner")
+        with open(self.tool, "w") as tool_fd:
+            tool_fd.write("#!/bin/sh\necho 'aligner 0.7.17-r1188'\n")
+        os.chmod(self.tool, 0o755)
+        os.utime(self.tool, (1000000000, 1000000000))
+        self.cache = os.path.join(self.folder, "cache", "tools.json")
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = os.pathsep.join([self.bin, self.path])
+        self.probe_version = toolcache.probe_version
+        self.probed = []
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        toolcache.probe_version = self.probe_version
+        shutil.rmtree(self.folder)
+
+    def resolve(self, global_config=None):
+        resolver = toolcache.ToolResolver(global_config or {}, self.cache)
+        tool = resolver.resolve("nougat-test-aligner")
+        resolver.save()
+        return tool
+
+    def count_probes(self):
+        def probe_version(path):
+            self.probed.append(path)
+            return self.probe_version(path)
+        toolcache.probe_version = probe_version
+
+    def test_resolve_and_cache(self):
+        tool = self.resolve()
+        self.assertEqual((tool.path, tool.version), (self.tool,
+            "aligner 0.7.17-r1188"))
+        self.assertTrue(os.path.exists(self.cache))
+        self.count_probes()
+        self.assertEqual(self.resolve(), tool)
+        self.assertEqual(self.probed, [])
+
+    def test_changed_binary(self):
+        self.resolve()
+        self.count_probes()
+        os.utime(self.tool, (1000000100, 1000000100))
+        self.assertEqual(self.resolve().mtime, 1000000100)
+        self.assertEqual(self.probed, [self.tool])
+        # another global config does not use the entries of this one
+        self.resolve({"Tools": {}})
+        self.assertEqual(self.probed, [self.tool, self.tool])
+
+    def test_missing_binary(self):
+        os.remove(self.tool)
+        self.assertIsNone(self.resolve())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,50 +1,47 @@
 import sys, os, yaml, glob
 import subprocess
 import argparse
-from collections import Counter, OrderedDict
-from itertools import combinations
+from collections import OrderedDict
+import heapq
 import pandas as pd
 import csv
 import re
+import multiprocessing
+import numpy as np
+from nougat import common, fasta, assembly_stats
 
-reverse_complements = {
-    "A": "T",
-    "T": "A",
-    "G": "C",
-    "C": "G",
-    "Y": "R",
-    "R": "Y",
-    "W": "W",
-    "S": "S",
-    "K": "M",
-    "M": "K",
-    "D": "H",
-    "H": "D",
-    "V": "B",
-    "B": "V",
-    "N": "N"
-}
+reverse_complements = fasta.IUPAC_COMPLEMENTS
 ambigous = [base for base in reverse_complements.keys() if base not in ["A", "T", "C", "G"]]
 
+# consensus canvas: one byte per map position, EMPTY where no contig is placed
+EMPTY = ord("n")
+AMBIGOUS_TABLE = np.zeros(256, dtype=bool)
+AMBIGOUS_TABLE[[ord(base) for base in ambigous]] = True
+_consensus_contigs = None # FastaFile used by _paste_map
+
 def main(args):
     workingDir = os.getcwd()
     assembly = args.assembly
     minCtgLength = args.min_contig
     if args.only_reference:
-        assembly = _build_new_reference(assembly, minCtgLength)
+        assembly = _build_new_reference(assembly, minCtgLength, args.threads)
         return
 
-    (contigsLengthDict, contigsSequencesDict) = _compute_assembly_stats(assembly, args.genome_size)
+    contigsLengthDict = _compute_assembly_stats(assembly, args.genome_size)
     if args.only_stats:
         return
 
+    # contigs are read on demand through the .fai index of the assembly
+    contigs = fasta.FastaFile(assembly)
     placement, gaps_overlaps = parse_report(args.opgen_report) 
     if args.find_problems_in_maps:
-        print("Finding problems by extracting overlaping contigs, please inspect ovl/*.fasta files!")
-        find_problems_in_maps(placement, contigsLengthDict, contigsSequencesDict)
+        print("Finding problems by extracting overlaping contigs, please inspect overlaps.fasta!")
+        find_problems_in_maps(placement, contigsLengthDict, contigs)
+        contigs.close()
         return
 
-    produce_consensus(placement, gaps_overlaps, contigsLengthDict, contigsSequencesDict, args.output, args.place_last)
+    produce_consensus(placement, gaps_overlaps, contigsLengthDict, contigs, args.output, args.place_last, args.threads)
+    contigs.close()
     return
 
 
@@ -76,7 +73,7 @@ def parse_report(opgen_report):
     return (placement, gaps_overlaps)
 
 
-def produce_consensus(placement, gaps_overlaps, contigsLengthDict, contigsSequencesDict, output, place_last):
+def produce_consensus(placement, gaps_overlaps, contigsLengthDict, contigs, output, place_last, threads=1):
     # I need a list with one element for each base in my map. THe problem is that
     # the OpGen report does not tell the length of the maps, therefore I need to 
     # find the maximum limit between the placments part and the gapped part
@@ -120,86 +117,125 @@ def produce_consensus(placement, gaps_overlaps, contigsLengthDict, contigsSequen
                     Maps_length[Map] = Map_End
 
     # now Maps_length contains the lenght of the Maps... thank you so much OpGen!!!!!
+    place_last = place_last or ""
+    jobs = []
+    for Map in Maps_length:
+        hits = MapsToContigs.get(Map, []) # contigs aligning to this map
+        reordered_tigs = [ctg for ctg in hits if ctg[2].split("_")[0] not in place_last]
+        last_tigs = [ctg for ctg in hits if ctg[2].split("_")[0] in place_last]
+        reordered_tigs.extend(last_tigs)
+        jobs.append((Map, Maps_length[Map], reordered_tigs))
+
+    # maps are independent: with more than one thread each map is pasted by
+    # a worker process that opens its own view of the assembly
+    if threads > 1:
+        pool = multiprocessing.Pool(threads, _init_consensus_worker, (contigs.fasta,))
+        canvases = pool.imap(_paste_map, jobs)
+    else:
+        _init_consensus_worker(contigs)
+        pool = None
+        canvases = (_paste_map(job) for job in jobs)
+
     multipleHittedPositions = 0
     rescuedBases = 0
     conflictingBases = 0
-
-    for Map in Maps_length:
-        Maps[Map] = ["n"] * Maps_length[Map] # Start with a blank canvas
-        print "now working with Map {}".format(Map)
-        if MapsToContigs[Map] is not None: # if this map has some contigs aligning
-            reordered_tigs = [ctg for ctg in MapsToContigs[Map] if ctg[2].split("_")[0] not in place_last]
-            last_tigs = [ctg for ctg in MapsToContigs[Map] if ctg[2].split("_")[0] in place_last]
-            reordered_tigs.extend(last_tigs)
-
-            for hit in reordered_tigs:
-                start_on_Map = hit[0] - 1
-                end_on_Map = hit[1] - 1
-                Ctg = hit[2]
-                start_on_Ctg = hit[3] - 1
-                end_on_Ctg = hit[4] - 1
-                orientation = hit[5]
-                #extract the seuqence
-                sequence = contigsSequencesDict[Ctg][start_on_Ctg:end_on_Ctg]
-                if orientation == '-1':
-                    sequence = revcom(contigsSequencesDict[Ctg][end_on_Ctg:start_on_Ctg:-1])
-                letters = list(sequence)
-                index = start_on_Map
-
-                #Start pasting the contig onto the canvas
-                for base in letters:
-                    if len(Maps[Map]) <= index:
-                        Maps[Map].append("n")
-                    if Maps[Map][index] is not "n":
-                        #For recordkeeping purposes, we'll overwrite any sequence
-                        multipleHittedPositions += 1
-                        if Maps[Map][index].title() in ambigous and base.title() not in ambigous:
-                            rescuedBases += 1
-                        elif Maps[Map][index].title() == base.title():
-                            pass
-                        elif Maps[Map][index].title() in ambigous and base.title() in ambigous:
-                            pass
-                        else:
-                            conflictingBases += 1
-                        Maps[Map][index] = base.title()
-                    else:
-                        Maps[Map][index] = base.title()
-                    index += 1
-    #print hit
+    with open("{}.fasta".format(output), "w") as final_assembly:
+        for Map, canvas, hitted, rescued, conflicting in canvases:
+            multipleHittedPositions += hitted
+            rescuedBases += rescued
+            conflictingBases += conflicting
+            print_contig(final_assembly, output, canvas)
+    if pool is not None:
+        pool.close()
+        pool.join()
     print "Positions in the map covered more than once {}".format(multipleHittedPositions)
     print "Rescued bases {}".format(rescuedBases)
     print "Conflicting bases {}".format(conflictingBases)
-    print_contigs(Maps, output)
+
+
+def _init_consensus_worker(assembly):
+    global _consensus_contigs
+    if isinstance(assembly, fasta.FastaFile):
+        _consensus_contigs = assembly
+    else:
+        _consensus_contigs = fasta.FastaFile(assembly)
+
+
+def _paste_map(job):
+    """ pastes the contigs placed on a map onto a byte canvas (one uint8 per
+    base, EMPTY where nothing is placed), later contigs overwrite earlier
+    ones. Returns the map, its sequence and the number of positions covered
+    more than once, rescued (ambiguous base replaced by a non-ambiguous one)
+    and conflicting (different non-ambiguous bases)."""
+    Map, Map_length, hits = job
+    print "now working with Map {}".format(Map)
+    canvas = np.empty(Map_length, dtype=np.uint8)
+    canvas.fill(EMPTY)
+    multipleHittedPositions = 0
+    rescuedBases = 0
+    conflictingBases = 0
+    #extract the seuqences, reverse hits are complemented all at once
+    sequences = []
+    reverse_hits = []
+    for hit in hits:
+        Ctg = hit[2]
+        start_on_Ctg = hit[3] - 1
+        end_on_Ctg = hit[4] - 1
+        if hit[5] == '-1':
+            reverse_hits.append(len(sequences))
+            sequences.append(_consensus_contigs.fetch(Ctg, start_on_Ctg + 1, end_on_Ctg + 1).tobytes())
+        else:
+            sequences.append(_consensus_contigs.fetch(Ctg, start_on_Ctg, end_on_Ctg).tobytes())
+    complemented = revcom_batch([sequences[i] for i in reverse_hits])
+    for i, sequence in zip(reverse_hits, complemented):
+        sequences[i] = sequence
+
+    for hit, sequence in zip(hits, sequences):
+        start_on_Map = hit[0] - 1
+        bases = np.frombuffer(sequence.upper(), dtype=np.uint8)
+        end_on_Map = start_on_Map + len(bases)
+        if end_on_Map > len(canvas):
+            extension = np.empty(end_on_Map - len(canvas), dtype=np.uint8)
+            extension.fill(EMPTY)
+            canvas = np.concatenate([canvas, extension])
+
+        #Start pasting the contig onto the canvas
+        window = canvas[start_on_Map:end_on_Map]
+        covered = window != EMPTY
+        window_ambigous = AMBIGOUS_TABLE[window]
+        multipleHittedPositions += int(np.count_nonzero(covered))
+        rescuedBases += int(np.count_nonzero(covered & window_ambigous & ~AMBIGOUS_TABLE[bases]))
+        conflictingBases += int(np.count_nonzero(covered & ~window_ambigous & (window != bases)))
+        window[:] = bases
+    return (Map, canvas.tobytes(), multipleHittedPositions, rescuedBases, conflictingBases)
 
 
 def revcom(s):
-    return complement(s)
+    return fasta.reverse_complement(s)
+
+
+def revcom_batch(fragments):
+    return fasta.reverse_complement_batch(fragments)
 
 
 def complement(s):
-    letters = list(s)
-    complemented = []
-    for base in letters:
-        if base.title() in reverse_complements.keys():
-            complemented.append(reverse_complements[base.title()])
-        else:
-            complemented.append("N")
-    return ''.join(complemented)
+    return fasta.complement(s)
 
 
-def print_contigs(Maps, output):
-    with open("{}.fasta".format(output), "w") as final_assembly:
-        for Map, sequence in Maps.iteritems():
-            final_assembly.write(">{}\n".format(output))
-            final_assembly.write("{}\n".format("".join(sequence)))
+def print_contig(final_assembly, output, sequence):
+    final_assembly.write(">{}\n".format(output))
+    final_assembly.write("{}\n".format(sequence))
 
 
-def find_problems_in_maps(placement, contigsLengthDict, contigsSequencesDict):
+def find_problems_in_maps(placement, contigsLengthDict, contigs,
+        overlaps_fasta="overlaps.fasta"):
     """ The idea is to output the sequences of contig overlaps, this might
         tell us something about the quality of this process. Are we mixing apples
         in with the oranges? Very WIP!
+        All the overlap sequences are written to overlaps_fasta, which is
+        indexed with a .fai.
     """
-    Map_contigs = OrderedDict()
+    Map_contigs = OrderedDict() # Map -> list of placements on it
     with open(placement, 'rb') as csvfile:
         opgenCSV = csv.reader(csvfile, delimiter='\t')
         #Chromosome, Start, End, Contig, Start, End, Orientation
@@ -208,78 +244,71 @@ def find_problems_in_maps(placement, contigsLengthDict, contigsSequencesDict):
             if len(row) > 0:
                 (Map, Map_Start, Map_End, Contig, Ctg_Start, Ctg_End, Orientation) = \
                     (row[0], int(row[1]), int(row[2]), row[3], int(row[4]), int(row[5]), row[6])
-                Map_contigs[(Map_Start, Map_End)] = [Ctg_Start, Ctg_End, Contig.split()[0], Orientation]
-
-    if not os.path.exists("ovl"):
-        os.mkdir("ovl")
-    # All combinations of contigs (without replacement) sorted from left to right on the map.
-    for combo in combinations(Map_contigs.keys(), 2):
-        l_map, r_map = combo
-        l_contig = Map_contigs[l_map] # contig starting leftmost
-        r_contig = Map_contigs[r_map] # contig starting rightmost
-
-        # l0(   r0(     l1)   r1)
-        # Note, enveloping overlaps should be pruned before this.
-        if l_map[1] > r_map[0] and l_map[0] < r_map[1]:
-            ovl_len = min(l_map[1], r_map[1])- r_map[0]
-            l_ovl = [l_contig[1] - ovl_len, l_contig[1], l_contig[2], l_contig[3]]
-            r_ovl = [r_contig[0], r_contig[0] + ovl_len, r_contig[2], r_contig[3]]
-
-            for ovl in [l_ovl, r_ovl]:
-                start_on_ctg = ovl[0]
-                end_on_ctg = ovl[1]
-                ctg_name = ovl[2]
-                orientation = ovl[3]
-
-                sequence = contigsSequencesDict[ctg_name][start_on_ctg:end_on_ctg]
-                if orientation == '-1':
-                    sequence = revcom(contigsSequencesDict[ctg_name][end_on_ctg:start_on_ctg:-1])
-                ovl_name = "{}-{}_{}".format(r_map[0], l_map[1], ctg_name)
-                with open("ovl/{}.fasta".format(ovl_name), "w") as overlap:
-                    overlap.write(">{}\n".format(ovl_name))
-                    overlap.write(sequence)
+                Map_contigs.setdefault(Map, []).append((Map_Start, Map_End,
+                    [Ctg_Start, Ctg_End, Contig.split()[0], Orientation]))
+
+    written = set()
+    with open(overlaps_fasta, "wb") as overlaps:
+        for Map, placements in Map_contigs.items():
+            for l_map, r_map, l_contig, r_contig in _overlapping_placements(placements):
+                # l0(   r0(     l1)   r1)
+                # Note, enveloping overlaps should be pruned before this.
+                ovl_len = min(l_map[1], r_map[1])- r_map[0]
+                l_ovl = [l_contig[1] - ovl_len, l_contig[1], l_contig[2], l_contig[3]]
+                r_ovl = [r_contig[0], r_contig[0] + ovl_len, r_contig[2], r_contig[3]]
+
+                for ovl in [l_ovl, r_ovl]:
+                    start_on_ctg = ovl[0]
+                    end_on_ctg = ovl[1]
+                    ctg_name = ovl[2]
+                    orientation = ovl[3]
+
+                    if orientation == '-1':
+                        sequence = revcom(contigs.fetch(ctg_name, start_on_ctg + 1, end_on_ctg + 1).tobytes())
+                    else:
+                        sequence = contigs.fetch(ctg_name, start_on_ctg, end_on_ctg)
+                    ovl_name = "{}_{}-{}_{}".format(Map, r_map[0], l_map[1], ctg_name)
+                    if ovl_name in written:
+                        ovl_name = "{}_{}".format(ovl_name, len(written))
+                    written.add(ovl_name)
+                    common.write_fasta_record(overlaps, ovl_name, sequence)
+    fasta.build_fasta_index(overlaps_fasta)
+
+
+def _overlapping_placements(placements):
+    """ sweeps the placements of one map, (start, end, contig) tuples, from
+    left to right keeping a heap of the ones still open. Yields
+    (l_map, r_map, l_contig, r_contig) for every overlapping pair, l being the
+    placement starting first, in O(n log n + overlaps)."""
+    placements = sorted(placements, key=lambda placement: placement[:2])
+    active = [] # heap of (end, index) of placements not closed yet
+    for index, (start, end, contig) in enumerate(placements):
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, l_index in active:
+            l_start, l_end, l_contig = placements[l_index]
+            if l_start < end:
+                yield (l_start, l_end), (start, end), l_contig, contig
+        heapq.heappush(active, (end, index))
 
 
 def _compute_assembly_stats(assembly, genomeSize):
     stats_file_name = ".".join([assembly, "statistics", "txt"])
-    contigsLengthDict = {}
-    contigsSequencesDict = {}
-    contigsLength = []
-    totalLength = 0
-    numContigs = 0
     maxContigLength = 0
     N50 = 0
     N80 = 0
-    numNs = 0
-
-    with open(assembly, "r") as ref_fd:
-        fasta_header = ref_fd.readline()
-        header = (fasta_header.split(">")[1]).rstrip()
-        sequence = ""
-        for line in ref_fd:
-            if line.startswith(">"):
-                contigsLength.append(len(sequence))
-                contigsLengthDict[header] = len(sequence)
-                contigsSequencesDict[header] = sequence
-                totalLength += len(sequence)
-                numContigs += 1
-                counter = Counter(sequence)
-                numNs += (counter['n'] + counter['N'])
-                sequence = ""
-                header = (line.split(">")[1]).rstrip()
-            else:
-                sequence+=line.rstrip()
-        contigsLength.append(len(sequence))
-        contigsLengthDict[header] = len(sequence)
-        contigsSequencesDict[header] = sequence
-        totalLength += len(sequence)
-        numContigs  += 1
-        counter = Counter(sequence)
-        numNs += (counter['n'] + counter['N'])
+
+    # served by the sidecar stats cache when the assembly did not change
+    names, lengths, composition = assembly_stats.scan_assembly(assembly)
+    contigsLength = lengths.tolist()
+    contigsLengthDict = dict(zip(names, contigsLength))
+    totalLength = sum(contigsLength)
+    numContigs = len(contigsLength)
+    numNs = int(composition.n)
 
     if os.path.exists(stats_file_name):
         print "assembly stast file {} already created".format(stats_file_name)
-        return (contigsLengthDict, contigsSequencesDict)
+        return contigsLengthDict
 
     percentageNs = float(numNs)/totalLength
     contigsLength.sort()
@@ -308,15 +337,15 @@ def _compute_assembly_stats(assembly, genomeSize):
         stats_file_name_fd.write("N80 : {}\n".format(N80))
         stats_file_name_fd.write("percentageNs : {}\n".format(percentageNs))
 
-    return (contigsLengthDict, contigsSequencesDict)
+    return contigsLengthDict
 
 
-def _build_new_reference(assembly, minCtgLength):
-    match_expr = re.compile("(\S+)\.(scf|ctg)\.(fasta|fa)$", re.IGNORECASE)
+def _build_new_reference(assembly, minCtgLength, threads=1):
+    match_expr = re.compile("(\S+)\.(scf|ctg)\.(fasta|fa)(\.gz)?$", re.IGNORECASE)
     new_assembly_name = os.path.basename(assembly)
     match_res = re.match(match_expr, new_assembly_name)
     try:
-        (basename, type, extention) = match_res.groups()
+        (basename, type, extention, compressed) = match_res.groups()
     except ValueError, AttributeError:
         print("The assembly name is not valid: {}".format(new_assembly_name))
         return new_assembly_name
@@ -328,24 +357,8 @@ def _build_new_reference(assembly, minCtgLength):
         print "assembly {} already created".format(new_assembly_name)
         return new_assembly_name
 
-    contigID = 1
-    with open(new_assembly_name, "w") as new_ref_fd:
-        with open(assembly, "r") as ref_fd:
-            fasta_header = ref_fd.readline()
-            sequence = ""
-            for line in ref_fd:
-                line = line
-                if line.startswith(">"):
-                    if len(sequence) >= minCtgLength:
-                        new_ref_fd.write(">contig{}\n".format(contigID))
-                        new_ref_fd.write(sequence)
-                    sequence = ""
-                    contigID += 1
-                else:
-                    sequence+=line
-            if len(sequence) >= minCtgLength:
-                new_ref_fd.write(">contig{}".format(contigID))
-                new_ref_fd.write(sequence)
+    fasta.filter_fasta(assembly, new_assembly_name, minCtgLength,
+            rename="contig{}", processes=threads)
     return new_assembly_name
 
 
@@ -369,6 +382,8 @@ if __name__ == '__main__':
             default="opgen_scaffolded_assembly", type=str)
     parser.add_argument('--place-last', 
             help="Place contigs with this prefix last on the consensus sequence", type=str)
+    parser.add_argument('--threads', help="number of worker processes (maps processed in parallel, assembly filtering)",
+            default=1, type=int)
     args = parser.parse_args()
     if args.genome_size == 0:
         print "genome size must be specified"
@@ -1,11 +1,13 @@
 import sys, os, yaml, glob
 import subprocess
 import argparse
+import multiprocessing
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 import shutil as sh
+from nougat import assembly_stats
 
 
 def main(args):
@@ -28,12 +30,13 @@ def main(args):
     os.chdir("LaTeX")
     #produce latex document
     latex_document = _latexHeader(outputName, assemblers)
-    assemblyStats = []
+    #compute assembly statistics, one assembler per worker
+    jobs = []
     for assembler in assemblers:
-        #compute assembly statistics
         assemblySeq = os.path.join(assemblies_dir, assembler, "{}.scf.fasta".format(outputName))
         if os.path.exists(assemblySeq):
-            assemblyStats.append(computeAssemblyStats(assembler, assemblySeq, minContigLength, genomeSize))
+            jobs.append((assembler, assemblySeq, minContigLength, genomeSize))
+    assemblyStats = _computeAllAssemblyStats(jobs, args.processes)
    
     latex_document = _insert_stat_table(latex_document, assemblyStats)
     #now copy QAstast
@@ -154,51 +157,30 @@ def _plotFRCurve(outputName, FRCurves):
 
 
 def computeAssemblyStats(assembler,sequence, minlenght, genomeSize):
-    contigsLength       = []
-    Contigs_TotalLength = 0
-    Contigs_longLength  = 0
-    numContigs      = 0
-    numLongContigs  = 0
-    with open(sequence, "r") as ref_fd:
-        fasta_header     = ref_fd.readline()
-        sequence         = ""
-        for line in ref_fd:
-            line = line
-            if line.startswith(">"):
-                Contigs_TotalLength += len(sequence)
-                contigsLength.append(len(sequence))
-                if len(sequence) >= minlenght:
-                    numLongContigs      += 1
-                    Contigs_longLength  += len(sequence)
-                numContigs += 1
-                sequence    = ""
-            else:
-                sequence+=line
-        Contigs_TotalLength += len(sequence)
-        contigsLength.append(len(sequence))
-        if len(sequence) >= minlenght:
-            numLongContigs      += 1
-            Contigs_longLength  += len(sequence)
-        numContigs += 1
-
-    contigsLength.sort()
-    contigsLength.reverse()
-    
-    teoN50 = genomeSize * 0.5
-    teoN80 = genomeSize * 0.8
-    testSum = 0
-    N50 = 0
-    N80 = 0
-    maxContigLength   = contigsLength[0]
-    for con in contigsLength:
-        testSum += con
-        if teoN50 < testSum:
-            if N50 == 0:
-                N50 = con
-        if teoN80 < testSum:
-            N80 = con
-            break
-    return [assembler,numContigs, numLongContigs, N50, N80, maxContigLength, Contigs_TotalLength, Contigs_longLength]
+    stats = assembly_stats.compute_assembly_stats(sequence, minlenght,
+            genomeSize)
+    return [assembler] + assembly_stats.report_row(stats.contiguity())
+
+
+def _computeAssemblyStatsJob(job):
+    return computeAssemblyStats(*job)
+
+
+def _computeAllAssemblyStats(jobs, processes=None):
+    """ computes the stats of every (assembler, sequence, minlenght,
+    genomeSize) job in a pool of processes (default: one per CPU), rows are
+    returned in the order of jobs"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return [_computeAssemblyStatsJob(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_computeAssemblyStatsJob, jobs)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _insert_QA_figure(latex_document, pictures, caption):
@@ -351,6 +333,7 @@ if __name__ == '__main__':
     parser.add_argument('--output',         type=str, required=True, help="output header used to store all results (i.e., output.scf.fasta)")
     parser.add_argument('--genomeSize',     type=int, required=True, help="expected genome size (same as specified in the validation phase)")
     parser.add_argument('--minContigLength',type=int, default=2000, help="minimum contig length (usually the same used to validate assembly). Default value set to 2000")
+    parser.add_argument('--processes',      type=int, default=None, help="maximum number of assemblies whose statistics are computed in parallel. Default one per CPU")
     args = parser.parse_args()
     
     main(args)